@@ -1,4 +1,11 @@
+import base64
+import hashlib
+import io
+import json
+import os
 import sys
+import time
+from datetime import datetime
 from web import create_app
 from web.models import get_db
 
@@ -10,24 +17,474 @@ def init_db():
     from web.models.state import State
     import web.models.attached_file
     import web.models.user
+    import web.models.version_stamp
+    import web.models.issue_event
+    from web.models.search import create_search_index
+    from web.models.migrations import LATEST_VERSION, set_version
 
     db = get_db()
     db.create_all()
-    db.session.add(State('Open', 1))
-    db.session.add(State('Closed', 99))
+    create_search_index()
+    with db.engine.begin() as connection:
+        set_version(connection, LATEST_VERSION)
+    State('Open', 1).add()
+    State('Closed', 99).add()
+
+def migrate_db():
+    """Migrates database to the latest schema.
+
+    Returns:
+        A list of applied (version, description).
+    """
+
+    from web.models.migrations import migrate
+
+    return migrate(get_db().engine)
+
+def backfill_comment_counters():
+    """Recomputes denormalized comment counters of all issues."""
+
+    db = get_db()
+    db.session.execute(
+            'UPDATE issue SET'
+            ' comment_count = (SELECT COUNT(*) FROM comment WHERE comment.issue_id = issue.id),'
+            ' last_comment_at = (SELECT MAX(pub_date) FROM comment WHERE comment.issue_id = issue.id)')
     db.session.commit()
 
-if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print("Usage: python dbutil.py ACTION (supported action: 'create')") # TODO: support migrate
+def backfill_state_counters():
+    """Recomputes denormalized issue counters of all states."""
+
+    from web.models.issue import VERSION_KEY
+    from web.models.version_stamp import VersionStamp
+
+    db = get_db()
+    db.session.execute(
+            'UPDATE state SET issue_count = (SELECT COUNT(*) FROM issue WHERE issue.state_id = state.id)')
+    # cached counts are keyed by version of issue list.
+    VersionStamp.bump(VERSION_KEY)
+    db.session.commit()
+
+def move_attached_files_to_file_system(batch_size=100):
+    """Moves attached files from database to file system.
+
+    Files are moved in batches and each batch is committed,
+    so this can be interrupted and resumed at any time.
+
+    Args:
+        batch_size (int): number of files per transaction.
+
+    Returns:
+        Number of moved files.
+    """
+
+    from web.models.attached_file import AttachedFile
+
+    db = get_db()
+    moved = 0
+    while True:
+        attached_files = AttachedFile.query \
+            .filter(AttachedFile.storage == 'database') \
+            .order_by(AttachedFile.id.asc()) \
+            .limit(batch_size) \
+            .all()
+        if not attached_files:
+            break
+        for attached_file in attached_files:
+            attached_file.move_to_file_system()
+        db.session.commit()
+        moved += len(attached_files)
+    return moved
+
+def _parse_datetime(value):
+    """Parses ISO 8601 datetime written by 'export'. None if empty."""
+
+    if not value:
+        return None
+    return datetime.fromisoformat(value.rstrip('Z'))
+
+def _to_user_row(record):
+    from web.models.user import User
+
+    if 'hashed_password' in record:
+        hashed_password = record['hashed_password'].encode('ascii')
+    else:
+        # slow. export hashed passwords if possible.
+        hashed_password = User(record['id'], record['name'], record['password']).hashed_password
+    return {'id': record['id'], 'name': record['name'], 'hashed_password': hashed_password}
+
+def _to_issue_row(record, version, now):
+    return {'id': record['id'],
+            'subject': record['subject'],
+            'state_id': record['state_id'],
+            'comment_count': 0,
+            'version': version,
+            'updated_at': _parse_datetime(record.get('updated_at')) or now}
+
+def _to_comment_row(record):
+    return {'id': record['id'],
+            'issue_id': record['issue_id'],
+            'user_id': record['user_id'],
+            'pub_date': _parse_datetime(record['pub_date']),
+            'body': record['body']}
+
+def _to_attached_file_row(record, storage):
+    # imported data is not compressed. rows of existing ids may have been.
+    row = {'id': record['id'], 'comment_id': record['comment_id'], 'name': record['name'],
+           'codec': 'identity', 'stored_size': None}
+    if 'data' not in record:
+        # data is already in file system storage. e.g. extracted from 'export --tar'.
+        if storage is None or not storage.exists(record['sha256']):
+            raise ValueError("data of attachment {} is not found".format(record['id']))
+        row.update(storage='filesystem', data=b'', sha256=record['sha256'], size=record['size'])
+        return row
+
+    data = base64.b64decode(record['data'])
+    if storage is None:
+        row.update(storage='database', data=data, sha256=hashlib.sha256(data).hexdigest(), size=len(data))
+    else:
+        (sha256, size, _) = storage.save(io.BytesIO(data))
+        row.update(storage='filesystem', data=b'', sha256=sha256, size=size)
+    return row
+
+def _create_upsert(table, columns):
+    """Creates INSERT statement which updates rows of existing ids,
+    so records exported by 'export --since' can be imported again.
+
+    Args:
+        table (sqlalchemy.Table): table to insert.
+        columns (list): column names.
+    """
+
+    from sqlalchemy import text
+
+    return text('INSERT INTO "{}" ({}) VALUES ({}) ON CONFLICT (id) DO UPDATE SET {}'.format(
+        table.name,
+        ', '.join('"{}"'.format(c) for c in columns),
+        ', '.join(':' + c for c in columns),
+        ', '.join('"{0}" = excluded."{0}"'.format(c) for c in columns if c != 'id')))
+
+def _get_import_checkpoint_key(path):
+    digest = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+    return 'import:' + digest[:24]
+
+def import_ndjson(path, batch_size=5000, out=sys.stdout):
+    """Imports users, issues, comments and attachments from NDJSON file.
+
+    Each line is a JSON object with 'type' ('user', 'issue', 'comment' or
+    'attachment') and columns of the row. Records are inserted in batches
+    by bulk inserts, one transaction per batch. Rows of existing ids are
+    updated. The offset of the last
+    committed line is saved in the same transaction, so an interrupted
+    import resumes from there when run again.
+
+    Args:
+        path (string): path of NDJSON file.
+        batch_size (int): number of records per transaction.
+        out (file-like object): progress is written to this.
+
+    Returns:
+        Number of imported records.
+    """
+
+    from flask import current_app
+    from web.models.issue import Issue, VERSION_KEY as ISSUE_VERSION_KEY
+    from web.models.comment import Comment
+    from web.models.attached_file import AttachedFile
+    from web.models.user import User
+    from web.models.version_stamp import VersionStamp
+    from web.storage import get_file_system_storage
+
+    db = get_db()
+    storage = None
+    if current_app.config.get('ATTACHMENT_STORAGE', 'database') == 'filesystem':
+        storage = get_file_system_storage()
+    checkpoint_key = _get_import_checkpoint_key(path)
+    tables = [('user', User.__table__),
+              ('issue', Issue.__table__),
+              ('comment', Comment.__table__),
+              ('attachment', AttachedFile.__table__)]
+
+    def flush(rows, offset):
+        # tables are inserted in order of foreign keys.
+        for (type, table) in tables:
+            if rows[type]:
+                db.session.execute(_create_upsert(table, rows[type][0].keys()), rows[type])
+                rows[type] = []
+        db.session.execute(
+                'INSERT INTO version_stamp (key, value) VALUES (:key, :offset)'
+                ' ON CONFLICT (key) DO UPDATE SET value = :offset',
+                {'key': checkpoint_key, 'offset': offset})
+        db.session.commit()
+
+    offset = VersionStamp.get_value(checkpoint_key)
+    if offset:
+        out.write('resume from byte {}.\n'.format(offset))
+
+    started_at = time.monotonic()
+    imported = 0
+    in_batch = 0
+    rows = dict((type, []) for (type, _) in tables)
+    version = None
+    now = datetime.utcnow()
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            offset += len(line)
+            if not line.strip():
+                continue
+            record = json.loads(line.decode('utf-8'))
+            type = record['type']
+            if type == 'user':
+                rows[type].append(_to_user_row(record))
+            elif type == 'issue':
+                if version is None:
+                    version = VersionStamp.bump(ISSUE_VERSION_KEY)
+                rows[type].append(_to_issue_row(record, version, now))
+            elif type == 'comment':
+                rows[type].append(_to_comment_row(record))
+            elif type == 'attachment':
+                rows[type].append(_to_attached_file_row(record, storage))
+            else:
+                raise ValueError("unknown record type '{}'".format(type))
+
+            in_batch += 1
+            if in_batch >= batch_size:
+                flush(rows, offset)
+                imported += in_batch
+                in_batch = 0
+                version = None
+                elapsed = time.monotonic() - started_at
+                out.write('{} records imported. ({:.0f} records/s)\n'.format(
+                    imported, imported / elapsed if elapsed > 0 else 0))
+
+    flush(rows, offset)
+    imported += in_batch
+
+    backfill_comment_counters()
+    backfill_state_counters()
+    db.session.execute('DELETE FROM version_stamp WHERE key = :key', {'key': checkpoint_key})
+    db.session.commit()
+
+    elapsed = time.monotonic() - started_at
+    out.write('{} records imported in {:.1f}s. ({:.0f} records/s)\n'.format(
+        imported, elapsed, imported / elapsed if elapsed > 0 else 0))
+    return imported
+
+def _format_datetime(value):
+    return value.isoformat() + 'Z' if value is not None else None
+
+def _write_record(out, record):
+    out.write(json.dumps(record).encode('utf-8'))
+    out.write(b'\n')
+
+def _write_record_with_data(out, record, stream, chunk_size=48 * 1024):
+    """Writes a record with 'data' encoded in base64 from stream in chunks.
+
+    Args:
+        out (binary file-like object): NDJSON is written to this.
+        record (dict): record without 'data'.
+        stream (file-like object): data to encode.
+        chunk_size (int): max size of a chunk to read.
+    """
+
+    out.write(json.dumps(record)[:-1].encode('utf-8'))
+    out.write(b', "data": "')
+    rest = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        chunk = rest + chunk
+        # encodes only multiples of 3 bytes, so no padding in the middle.
+        size = len(chunk) - len(chunk) % 3
+        out.write(base64.b64encode(chunk[:size]))
+        rest = chunk[size:]
+    out.write(base64.b64encode(rest))
+    out.write(b'"}\n')
+
+def _add_tar_member(tar, name, stream, size):
+    import tarfile
+
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(time.time())
+    tar.addfile(info, stream)
+
+def export_ndjson(out, since=None, tar=None):
+    """Exports users, issues, comments and attachments as NDJSON.
+
+    Rows are fetched as tuples by 'yield_per()' and written one by one,
+    and data of attachments is encoded in chunks, so memory usage does
+    not depend on size of database. All rows are read in one transaction,
+    so the output is a consistent snapshot even while the application is
+    writing. Output can be imported by 'import_ndjson()'.
+
+    Args:
+        out (binary file-like object): NDJSON is written to this.
+        since (datetime): if specified, only issues updated and comments
+            posted at or after this (UTC) are exported. Users are always
+            exported.
+        tar (tarfile.TarFile): if specified, data of attachments are
+            written to this as 'attachments/<aa>/<bb>/<sha256>', the layout
+            of file system storage, instead of base64 in NDJSON.
+
+    Returns:
+        Number of exported records.
+    """
+
+    db = get_db()
+    # pysqlite does not begin transactions for SELECT statements.
+    if not db.session.connection().connection.in_transaction:
+        db.session.execute('BEGIN')
+    try:
+        return _export_rows(db, out, since, tar)
+    finally:
+        db.session.rollback()
+
+def _export_rows(db, out, since, tar):
+    """Writes records of 'export_ndjson()'. Returns number of exported records."""
+
+    from web.models.issue import Issue
+    from web.models.comment import Comment
+    from web.models.attached_file import AttachedFile
+    from web.models.user import User
+    from web.storage import FileSystemStorage
+
+    exported = 0
+    written = set()
+    tar_layout = FileSystemStorage('attachments')
+
+    users = db.session.query(User.id, User.name, User.hashed_password)
+    for (id, name, hashed_password) in users.yield_per(1000):
+        _write_record(out, {'type': 'user', 'id': id, 'name': name,
+                            'hashed_password': hashed_password.decode('ascii')})
+        exported += 1
+
+    issues = db.session.query(Issue.id, Issue.subject, Issue.state_id, Issue.updated_at)
+    if since is not None:
+        issues = issues.filter(Issue.updated_at >= since)
+    for (id, subject, state_id, updated_at) in issues.order_by(Issue.id.asc()).yield_per(1000):
+        _write_record(out, {'type': 'issue', 'id': id, 'subject': subject,
+                            'state_id': state_id, 'updated_at': _format_datetime(updated_at)})
+        exported += 1
+
+    comments = db.session.query(Comment.id, Comment.issue_id, Comment.user_id, Comment.pub_date, Comment.body)
+    if since is not None:
+        comments = comments.filter(Comment.pub_date >= since)
+    for (id, issue_id, user_id, pub_date, body) in comments.order_by(Comment.id.asc()).yield_per(1000):
+        _write_record(out, {'type': 'comment', 'id': id, 'issue_id': issue_id, 'user_id': user_id,
+                            'pub_date': _format_datetime(pub_date), 'body': body})
+        exported += 1
+
+    attached_files = AttachedFile.query.join(Comment, Comment.id == AttachedFile.comment_id)
+    if since is not None:
+        attached_files = attached_files.filter(Comment.pub_date >= since)
+    for attached_file in attached_files.order_by(AttachedFile.id.asc()).yield_per(100):
+        record = {'type': 'attachment', 'id': attached_file.id,
+                  'comment_id': attached_file.comment_id, 'name': attached_file.name}
+        stream = attached_file.open()
+        try:
+            if tar is None:
+                _write_record_with_data(out, record, stream)
+            else:
+                sha256 = attached_file.sha256
+                if sha256 is None:
+                    hash = hashlib.sha256()
+                    for chunk in iter(lambda: stream.read(64 * 1024), b''):
+                        hash.update(chunk)
+                    sha256 = hash.hexdigest()
+                    stream.seek(0)
+                size = attached_file.get_size()
+                if sha256 not in written:
+                    _add_tar_member(tar, tar_layout.get_path(sha256), stream, size)
+                    written.add(sha256)
+                record.update(sha256=sha256, size=size)
+                _write_record(out, record)
+        finally:
+            stream.close()
+        db.session.expunge(attached_file)
+        exported += 1
+
+    return exported
+
+def _parse_args(argv):
+    """Parses command line arguments."""
+
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python dbutil.py', description='Database utility of Zenmai.')
+    actions = parser.add_subparsers(dest='action', metavar='ACTION')
+    actions.add_parser('create', help='create database.')
+    actions.add_parser('migrate', help='migrate database to the latest schema.')
+    actions.add_parser('backfill', help='recompute comment counters of issues and issue counters of states.')
+    offload = actions.add_parser('offload', help='move attached files from database to file system.')
+    offload.add_argument('batch_size', nargs='?', type=int, default=100)
+    prune = actions.add_parser('prune', help='delete old issue events.')
+    prune.add_argument('days', nargs='?', type=int, default=7, help='keep events of these days.')
+    actions.add_parser('reindex', help='rebuild full-text search index.')
+    import_ = actions.add_parser('import', help='import NDJSON file.')
+    import_.add_argument('file')
+    import_.add_argument('batch_size', nargs='?', type=int, default=5000)
+    export = actions.add_parser('export', help='export NDJSON.')
+    export.add_argument('-o', '--output', help='output file. stdout if not specified.')
+    export.add_argument('--since', type=_parse_datetime,
+            help='export only issues updated and comments posted at or after this UTC datetime.')
+    export.add_argument('--tar', action='store_true',
+            help='write a tar archive of NDJSON and attachment files.')
+
+    args = parser.parse_args(argv)
+    if args.action is None:
+        parser.print_help()
         exit()
+    return args
+
+def _export(args):
+    """Runs 'export' action."""
 
+    import tarfile
+    import tempfile
+
+    out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    try:
+        if not args.tar:
+            exported = export_ndjson(out, args.since)
+        else:
+            # size of NDJSON must be known before it is added to tar.
+            with tempfile.TemporaryFile() as ndjson, tarfile.open(fileobj=out, mode='w|') as tar:
+                exported = export_ndjson(ndjson, args.since, tar)
+                size = ndjson.tell()
+                ndjson.seek(0)
+                _add_tar_member(tar, 'zenmai.ndjson', ndjson, size)
+    finally:
+        if args.output:
+            out.close()
+    sys.stderr.write('{} records exported.\n'.format(exported))
+
+if __name__ == '__main__':
+    args = _parse_args(sys.argv[1:])
     app = create_app()
-    action = sys.argv[1]
 
     with app.app_context():
-        if action == 'create':
+        if args.action == 'create':
             init_db()
-        else:
-            print("Unknown action '{}'".format(action))
-
+        elif args.action == 'migrate':
+            for (version, description) in migrate_db():
+                print('migrated to {}: {}'.format(version, description))
+        elif args.action == 'backfill':
+            backfill_comment_counters()
+            backfill_state_counters()
+        elif args.action == 'offload':
+            moved = move_attached_files_to_file_system(args.batch_size)
+            print('{} files moved. run VACUUM to shrink database.'.format(moved))
+        elif args.action == 'prune':
+            from datetime import timedelta
+            from web.models.issue_event import IssueEvent
+            deleted = IssueEvent.prune(datetime.utcnow() - timedelta(days=args.days))
+            print('{} events deleted.'.format(deleted))
+        elif args.action == 'reindex':
+            from web.models.search import rebuild_search_index
+            rebuild_search_index()
+        elif args.action == 'import':
+            import_ndjson(args.file, args.batch_size)
+        elif args.action == 'export':
+            _export(args)
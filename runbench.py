@@ -0,0 +1,317 @@
+"""Run benchmark.
+
+Generates a synthetic dataset, sends requests to main routes through
+Flask's test client and reports latency, throughput and SQL query
+counts per route.
+
+To run benchmark: $ python runbench.py
+To save a baseline: $ python runbench.py -o baseline.json
+To compare with a baseline: $ python runbench.py --compare baseline.json
+
+Generating the default dataset (50k issues, 1M comments) takes a while.
+Use '--db FILE' to keep the dataset and reuse it in later runs.
+"""
+
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import event
+import web
+from web import create_app
+from dbutil import init_db, backfill_comment_counters, backfill_state_counters
+
+BENCH_USER_ID = 'bench'
+BENCH_PASSWORD = 'bench'
+CSRF_TOKEN = 'token'
+
+# (size, weight) of attached files.
+ATTACHMENT_SIZES = [(256, 50), (4 * 1024, 30), (64 * 1024, 15), (512 * 1024, 5)]
+
+def _parse_args(argv):
+    """Parses command line arguments."""
+
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python runbench.py', description='Benchmark of Zenmai.')
+    parser.add_argument('--issues', type=int, default=50000, help='number of issues.')
+    parser.add_argument('--comments', type=int, default=1000000, help='number of comments.')
+    parser.add_argument('--attachments', type=int, default=5000, help='number of attached files.')
+    parser.add_argument('--users', type=int, default=100, help='number of users.')
+    parser.add_argument('--requests', type=int, default=200, help='number of measured requests per route.')
+    parser.add_argument('--warmup', type=int, default=20, help='number of unmeasured requests per route.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--db', help='database file. the dataset is generated only if it does not exist.')
+    parser.add_argument('-o', '--output', help='write results to this JSON file.')
+    parser.add_argument('--compare', help='compare results with this JSON file.')
+    parser.add_argument('--tolerance', type=float, default=20.0,
+            help='percentage of p95 latency increase reported as regression.')
+    return parser.parse_args(argv)
+
+def generate_dataset(args, rand):
+    """Generates a synthetic dataset.
+
+    Issues, comments and users are inserted in bulk through the models.
+    Attached files are created one by one, so they are stored
+    to 'ATTACHMENT_STORAGE' like uploaded files.
+
+    Args:
+        args (argparse.Namespace): command line arguments.
+        rand (random.Random): random number generator.
+    """
+
+    from web.models import get_db
+    from web.models.issue import Issue
+    from web.models.comment import Comment
+    from web.models.attached_file import AttachedFile
+    from web.models.user import User
+    from web.models.version_stamp import VersionStamp
+    from web.models.search import rebuild_search_index
+    from web.password_hasher import hash_password
+
+    db = get_db()
+    batch_size = 10000
+    words = ['issue', 'error', 'crash', 'login', 'page', 'slow', 'database', 'upload',
+             'fix', 'test', 'release', 'user', 'comment', 'search', 'cache', 'index']
+
+    def sentence(n):
+        return ' '.join(rand.choice(words) for _ in range(n))
+
+    # same hash for all users. hashing is slow.
+    hashed_password = hash_password(BENCH_PASSWORD.encode('utf-8'))
+    user_ids = [BENCH_USER_ID] + ['user{}'.format(i) for i in range(1, args.users)]
+    db.session.bulk_insert_mappings(User, [
+            {'id': id, 'name': id, 'hashed_password': hashed_password} for id in user_ids])
+
+    for start in range(0, args.issues, batch_size):
+        db.session.bulk_insert_mappings(Issue, [
+                {'id': id, 'subject': sentence(6), 'state_id': 1 if rand.random() < 0.7 else 2}
+                for id in range(start + 1, min(start + batch_size, args.issues) + 1)])
+        db.session.commit()
+
+    # every issue has at least one comment.
+    pub_date = datetime.utcnow() - timedelta(seconds=args.comments)
+    for start in range(0, args.comments, batch_size):
+        rows = []
+        for id in range(start + 1, min(start + batch_size, args.comments) + 1):
+            issue_id = id if id <= args.issues else rand.randint(1, args.issues)
+            rows.append({'id': id, 'issue_id': issue_id, 'user_id': rand.choice(user_ids),
+                         'pub_date': pub_date + timedelta(seconds=id), 'body': sentence(30)})
+        db.session.bulk_insert_mappings(Comment, rows)
+        db.session.commit()
+
+    sizes = [size for (size, _) in ATTACHMENT_SIZES]
+    weights = [weight for (_, weight) in ATTACHMENT_SIZES]
+    for i in range(args.attachments):
+        size = rand.choices(sizes, weights)[0]
+        data = rand.getrandbits(size * 8).to_bytes(size, 'little')
+        db.session.add(AttachedFile(rand.randint(1, args.comments), 'file{}.bin'.format(i), data))
+        if i % 100 == 99:
+            db.session.commit()
+    db.session.commit()
+
+    backfill_comment_counters()
+    backfill_state_counters()
+    rebuild_search_index()
+    VersionStamp.bump('issues')
+    db.session.commit()
+
+def percentile(values, p):
+    """Returns p-th percentile of sorted values by nearest-rank method."""
+
+    if not values:
+        return None
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+class QueryCounter(object):
+    """Counts SQL statements executed by engines."""
+
+    def __init__(self, engines):
+        self.count = 0
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+def measure(name, send, args, counter):
+    """Sends requests and measures them.
+
+    Args:
+        name (string): route name.
+        send (function): sends a request and returns a response.
+        args (argparse.Namespace): command line arguments.
+        counter (QueryCounter): query counter.
+
+    Returns:
+        A dict of results.
+    """
+
+    for _ in range(args.warmup):
+        send()
+
+    latencies = []
+    queries = 0
+    started = time.perf_counter()
+    for _ in range(args.requests):
+        count = counter.count
+        t = time.perf_counter()
+        res = send()
+        latencies.append(time.perf_counter() - t)
+        queries += counter.count - count
+        if res.status_code >= 400:
+            raise RuntimeError('{} returned {}'.format(name, res.status_code))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    ret = {
+        'requests': len(latencies),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'mean_ms': sum(latencies) / len(latencies) * 1000,
+        'throughput_rps': len(latencies) / elapsed,
+        'queries_per_request': queries / len(latencies),
+    }
+    print('{:<10} p50 {p50_ms:8.2f}ms  p95 {p95_ms:8.2f}ms  p99 {p99_ms:8.2f}ms  '
+          '{throughput_rps:8.1f} req/s  {queries_per_request:6.1f} queries'.format(name, **ret))
+    return ret
+
+def run(app, args, rand):
+    """Runs benchmark of routes.
+
+    Returns:
+        A dict of results per route.
+    """
+
+    from web.models import get_db
+    from web.models.attached_file import AttachedFile
+
+    db = get_db()
+    counter = QueryCounter([e for e in [db.engine, db.get_read_engine()] if e is not None])
+    issues = db.session.execute('SELECT COUNT(*) FROM issue').scalar()
+    attached_file_ids = [row[0] for row in db.session.query(AttachedFile.id)]
+    db.session.commit()
+
+    def new_client(login):
+        client = app.test_client()
+        client.get('/user/login/')  # creates CSRF token.
+        if login:
+            client.post('/user/login/', data={
+                'csrf_token': CSRF_TOKEN, 'user_id': BENCH_USER_ID, 'password': BENCH_PASSWORD})
+        return client
+
+    def finish(res):
+        res.get_data()  # consumes streamed responses.
+        res.close()
+        db.session.remove()
+        return res
+
+    anonymous = new_client(False)
+    logged_in = new_client(True)
+
+    def index():
+        if rand.random() < 0.5:
+            return finish(anonymous.get('/'))
+        return finish(anonymous.get('/?after={}'.format(rand.randint(1, issues))))
+
+    def detail():
+        return finish(anonymous.get('/{}/'.format(rand.randint(1, issues))))
+
+    def download():
+        return finish(anonymous.get('/download/{}/'.format(rand.choice(attached_file_ids))))
+
+    def login():
+        return finish(anonymous.post('/user/login/', data={
+            'csrf_token': CSRF_TOKEN, 'user_id': BENCH_USER_ID, 'password': BENCH_PASSWORD}))
+
+    def comment():
+        return finish(logged_in.post('/{}/'.format(rand.randint(1, issues)), data={
+            'csrf_token': CSRF_TOKEN, 'new_body': 'benchmark comment.'}))
+
+    # reads first. writes invalidate caches.
+    routes = [('index', index), ('detail', detail), ('login', login), ('comment', comment)]
+    if attached_file_ids:
+        routes.insert(2, ('download', download))
+    return {name: measure(name, send, args, counter) for (name, send) in routes}
+
+def compare(results, baseline, tolerance):
+    """Compares results with baseline.
+
+    Returns:
+        True if no regression.
+    """
+
+    ok = True
+    for (name, result) in sorted(results.items()):
+        base = baseline['routes'].get(name)
+        if base is None:
+            continue
+        change = (result['p95_ms'] / base['p95_ms'] - 1) * 100
+        # query counts vary a little with random pages.
+        regressed = change > tolerance or result['queries_per_request'] > base['queries_per_request'] + 0.5
+        ok = ok and not regressed
+        print('{:<10} p95 {:8.2f}ms -> {:8.2f}ms ({:+6.1f}%)  queries {:6.1f} -> {:6.1f}{}'.format(
+            name, base['p95_ms'], result['p95_ms'], change,
+            base['queries_per_request'], result['queries_per_request'],
+            '  REGRESSION' if regressed else ''))
+    return ok
+
+if __name__ == '__main__':
+    args = _parse_args(sys.argv[1:])
+    # workloads are the same sequence whether data is generated or reused.
+    data_rand = random.Random(args.seed)
+    workload_rand = random.Random(args.seed)
+    app = create_app()
+    app.config['FRAGMENT_CACHE_BACKEND'] = 'lru'
+    web.csrf_token_for_testing = CSRF_TOKEN
+
+    work_dir = tempfile.mkdtemp()
+    db_path = os.path.abspath(args.db) if args.db else os.path.join(work_dir, 'bench.db')
+    generate = not os.path.exists(db_path)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + db_path
+    app.config['ATTACHMENT_DIR'] = os.path.splitext(db_path)[0] + '.attachments'
+    app.config['STATIC_BUILD_DIR'] = os.path.join(work_dir, 'static')
+
+    try:
+        with app.app_context():
+            if generate:
+                started = time.perf_counter()
+                init_db()
+                generate_dataset(args, data_rand)
+                print('dataset generated in {:.1f}s.'.format(time.perf_counter() - started))
+
+            # define routing.
+            import web.zenmai
+
+            results = run(app, args, workload_rand)
+
+        report = {
+            'meta': {
+                'created_at': datetime.utcnow().isoformat() + 'Z',
+                'version': app.config['version'],
+                'python': platform.python_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'dataset': {'issues': args.issues, 'comments': args.comments,
+                            'attachments': args.attachments, 'users': args.users},
+                'requests': args.requests,
+                'seed': args.seed,
+            },
+            'routes': results,
+        }
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+        if args.compare:
+            with open(args.compare) as f:
+                if not compare(results, json.load(f), args.tolerance):
+                    sys.exit(1)
+    finally:
+        shutil.rmtree(work_dir)
@@ -4,6 +4,7 @@ To run unit test: $ python runtest.py
 """
 
 import os
+import shutil
 import unittest
 import tempfile
 from flask import g
@@ -13,11 +14,15 @@ from test import ctx
 
 db_fd = None
 db_path = None
+attachment_dir = None
+static_build_dir = None
 
 def init(app):
     """Initialize Unit test."""
 
     app.config['TESTING'] = True
+    app.config['BCRYPT_ROUNDS'] = 4 # fast
+    app.config['USER_CACHE_SIZE'] = 0
 
     # create database.
     global db_fd
@@ -27,6 +32,17 @@ def init(app):
     app.logger.debug('database = ' + app.config['SQLALCHEMY_DATABASE_URI'])
     init_db()
 
+    # create attachment directory.
+    global attachment_dir
+    attachment_dir = tempfile.mkdtemp()
+    app.config['ATTACHMENT_STORAGE'] = 'filesystem'
+    app.config['ATTACHMENT_DIR'] = attachment_dir
+
+    # create directory of fingerprinted static files.
+    global static_build_dir
+    static_build_dir = tempfile.mkdtemp()
+    app.config['STATIC_BUILD_DIR'] = static_build_dir
+
     # define routing.
     import web.zenmai
 
@@ -40,7 +56,11 @@ def finalize(app):
     """Finalize unit test."""
 
     os.close(db_fd)
-    os.unlink(db_path)
+    for path in [db_path, db_path + '-wal', db_path + '-shm']:
+        if os.path.exists(path):
+            os.unlink(path)
+    shutil.rmtree(attachment_dir)
+    shutil.rmtree(static_build_dir)
 
 if __name__ == '__main__':
     app = create_app()
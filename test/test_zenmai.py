@@ -2,14 +2,42 @@
 
 import unittest
 import re
+import asyncio
+import base64
+import gzip
+import hashlib
 import io
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import uuid
+import zlib
+from unittest import mock
 from datetime import datetime, timedelta
 from flask import request, session
+from sqlalchemy.exc import OperationalError
 from . import ctx
 from .zenmai_test_utils import create_issue, create_comment, create_attached_file, create_user, \
                                 login, logout, delete_all_issues
 from web.models.issue import Issue
+from web.models.comment import Comment
+from web.models.attached_file import AttachedFile
+from web.storage import get_file_system_storage
+from dbutil import backfill_comment_counters, backfill_state_counters, move_attached_files_to_file_system, \
+                   import_ndjson, export_ndjson
 from web.models.user import User
+from web.models.state import State
+from web.models.version_stamp import VersionStamp
+from web.models.issue_event import IssueEvent
+from web.models import get_db, migrations
+from web import password_hasher, fragment_cache, events, metrics, static_assets, AUTH_USER_ID_KEY
+from web.exceptions.zen_http_exception import ZenHttpException
+from web.query_budget import query_budget, record_queries
+
+db = get_db()
 
 class ZenmaiTestCase(unittest.TestCase):
     """TestCase class"""
@@ -62,6 +90,86 @@ class ZenmaiTestCase(unittest.TestCase):
         subject_regex = re.compile(r'<a href="/{}/">.*test subject\.test_get_issue_list\..*</a>'.format(issue.id))
         self.assertRegex(data, subject_regex)
 
+    def test_get_issue_list_pagination(self):
+        """Test case of paginated issue list. (HTTP GET)"""
+
+        issues = [create_issue() for i in range(3)]
+        for issue in issues:
+            issue.add()
+
+        res = ctx['TEST_APP'].get('/?after={}&limit=1'.format(issues[0].id))
+        data = res.data.decode('utf-8')
+        self.assertNotIn(issues[0].subject, data)
+        self.assertIn(issues[1].subject, data)
+        self.assertNotIn(issues[2].subject, data)
+        self.assertIn('href="/?before={}&amp;limit=1"'.format(issues[1].id), data)
+        self.assertIn('href="/?after={}&amp;limit=1"'.format(issues[1].id), data)
+
+        res = ctx['TEST_APP'].get('/?before={}&limit=1'.format(issues[1].id))
+        data = res.data.decode('utf-8')
+        self.assertIn(issues[0].subject, data)
+        self.assertNotIn(issues[1].subject, data)
+
+    def test_get_issue_list_by_state(self):
+        """Test case of issues filtered by state. (HTTP GET)"""
+
+        def count(state_id):
+            return db.session.query(State.issue_count).filter(State.id == state_id).scalar()
+
+        backfill_state_counters()
+        (open_count, closed_count) = (count(1), count(2))
+        open_issue = create_issue(state_id=1)
+        open_issue.add()
+        closed_issue = create_issue(state_id=2)
+        closed_issue.add()
+        self.assertEqual((count(1), count(2)), (open_count + 1, closed_count + 1))
+
+        data = ctx['TEST_APP'].get('/?state=2&limit=200').data.decode('utf-8')
+        self.assertIn('<h2>Closed</h2>', data)
+        self.assertIn(closed_issue.subject, data)
+        self.assertNotIn(open_issue.subject, data)
+        self.assertIn('Closed <span class="badge">{}</span>'.format(closed_count + 1), data)
+
+        # state change by comment.
+        with login():
+            ctx['TEST_APP'].post('/{}/'.format(open_issue.id), data={
+                'csrf_token': ctx['CSRF_TOKEN'], 'new_body': 'close.', 'new_state': 2})
+        self.assertEqual((count(1), count(2)), (open_count, closed_count + 2))
+        data = ctx['TEST_APP'].get('/?state=2&limit=200').data.decode('utf-8')
+        self.assertIn(open_issue.subject, data)
+        self.assertIn('Open <span class="badge">{}</span>'.format(open_count), data)
+
+        # counts are only on issue list, whose entity tag includes version of issues.
+        data = ctx['TEST_APP'].get('/{}/'.format(open_issue.id)).data.decode('utf-8')
+        self.assertNotIn('class="badge"', data)
+
+        # counts are cached until issues are changed.
+        with query_budget(2):
+            ctx['TEST_APP'].get('/?state=1')
+
+    def test_comment_counter(self):
+        """Test case of denormalized comment counter."""
+
+        issue = create_issue(comments=[create_comment(), create_comment()])
+        issue.add()
+        self.assertEqual(issue.comment_count, 2)
+
+        comment = create_comment(issue=issue, pub_date=datetime.utcnow() + timedelta(days=2))
+        comment.add()
+        self.assertEqual(issue.comment_count, 3)
+        self.assertEqual(issue.last_comment_at, comment.pub_date)
+
+        res = ctx['TEST_APP'].get('/?after={}&limit=1'.format(issue.id - 1))
+        self.assertIn('(3comments)', res.data.decode('utf-8'))
+
+        # backfill
+        issue.comment_count = 0
+        issue.last_comment_at = None
+        issue.add()
+        backfill_comment_counters()
+        self.assertEqual(issue.comment_count, 3)
+        self.assertEqual(issue.last_comment_at, comment.pub_date)
+
     def test_get_empty_issue_list(self):
         """Test case of no issues. (HTTP GET)"""
 
@@ -89,6 +197,45 @@ class ZenmaiTestCase(unittest.TestCase):
                 state_name=issue.state.name,
                 attached_file_name='test\.txt')
 
+    def test_get_issue_detail_comment_window(self):
+        """Test case of long issue whose middle comments are loaded on demand. (HTTP GET)"""
+
+        app = ctx['APP']
+        (window, page_size) = (app.config.get('COMMENTS_WINDOW'), app.config.get('COMMENTS_PAGE_SIZE'))
+        app.config['COMMENTS_WINDOW'] = 2
+        app.config['COMMENTS_PAGE_SIZE'] = 3
+        try:
+            issue = create_issue(comments=[create_comment() for _ in range(10)])
+            issue.add()
+            fragment_cache.invalidate_issue(issue.id)
+            # ids of issues deleted by other tests may be reused. so count comments of database.
+            ids = [c.id for c in Issue.get_comments(issue.id)]
+            issue.comment_count = len(ids)
+
+            def shown(data):
+                return [int(id) for id in re.findall(r'id="comment-(\d+)"', data)]
+
+            def gap_url(data):
+                match = re.search(r'class="zen-comment-gap">\s*<a [^>]*href="([^"]+)"', data)
+                return match.group(1).replace('&amp;', '&') if match else None
+
+            with query_budget(7):
+                data = ctx['TEST_APP'].get('/{}/'.format(issue.id)).data.decode('utf-8')
+            self.assertEqual(shown(data), ids[:2] + ids[-2:])
+            self.assertIn('show {} more comments'.format(len(ids) - 4), data)
+
+            with query_budget(4):
+                data = ctx['TEST_APP'].get(gap_url(data)).data.decode('utf-8')
+            self.assertEqual(shown(data), ids[2:5])
+
+            data = ctx['TEST_APP'].get(gap_url(data)).data.decode('utf-8')
+            self.assertEqual(shown(data), ids[5:8])
+            if len(ids) == 10:
+                self.assertIsNone(gap_url(data))
+        finally:
+            app.config['COMMENTS_WINDOW'] = window
+            app.config['COMMENTS_PAGE_SIZE'] = page_size
+
     def test_post_issue_detail(self):
         """Test case of issue detail. (HTTP POST)"""
 
@@ -119,6 +266,267 @@ class ZenmaiTestCase(unittest.TestCase):
                     state_name=issue.state.name,
                     attached_file_name='test\.txt')
 
+    def test_issue_events(self):
+        """Test case of events written by changes of issues."""
+
+        last_id = IssueEvent.get_last_id()
+        issue = create_issue(state_id=1)
+        issue.add()
+        with login():
+            ctx['TEST_APP'].post('/{}/'.format(issue.id), data={
+                'csrf_token': ctx['CSRF_TOKEN'], 'new_body': 'test body.test_issue_events', 'new_state': 2})
+            ctx['TEST_APP'].post('/{}/'.format(issue.id), data={
+                'csrf_token': ctx['CSRF_TOKEN'], 'new_body': 'test body.test_issue_events', 'new_state': 2})
+
+        comment_ids = [c.id for c in Issue.get_comments(issue.id)]
+        self.assertEqual(
+                [(e.issue_id, e.type, e.comment_id, e.state_id) for e in IssueEvent.fetch_after(last_id)],
+                [(issue.id, 'issue', None, 1),
+                 (issue.id, 'comment', comment_ids[1], None),
+                 (issue.id, 'state', None, 2),
+                 (issue.id, 'comment', comment_ids[2], None)])
+        self.assertEqual(IssueEvent.fetch_after(last_id, issue_id=-1), [])
+
+        # ids are not reused after all events are pruned.
+        last_id = IssueEvent.get_last_id()
+        IssueEvent.prune(datetime.utcnow() + timedelta(days=1))
+        self.assertEqual(IssueEvent.get_last_id(), 0)
+        create_issue().add()
+        self.assertEqual([e.id for e in IssueEvent.fetch_after(last_id)], [last_id + 1])
+
+    def test_event_stream(self):
+        """Test case of Server-Sent Events of issues."""
+
+        issue = create_issue()
+        issue.add()
+        last_id = IssueEvent.get_last_id()
+        create_comment(issue=issue).add()
+
+        async def read_event(reader):
+            lines = (await reader.readuntil(b'\n\n')).decode('utf-8').splitlines()
+            return dict(line.split(': ', 1) for line in lines if line)
+
+        async def scenario():
+            (server, broker, task) = await events.start(ctx['APP'], '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                (reader, writer) = await asyncio.open_connection('127.0.0.1', port)
+                writer.write('GET /{}/events HTTP/1.1\r\nLast-Event-ID: {}\r\n\r\n'.format(
+                        issue.id, last_id).encode('ascii'))
+                headers = (await reader.readuntil(b'\r\n\r\n')).decode('ascii')
+                self.assertIn('200 OK', headers)
+                self.assertIn('text/event-stream', headers)
+                self.assertEqual(await reader.readuntil(b'\n\n'), b'retry: 3000\n\n')
+
+                # replayed.
+                event = await asyncio.wait_for(read_event(reader), 5)
+                self.assertEqual(event['event'], 'comment')
+                self.assertEqual(json.loads(event['data'])['issue_id'], issue.id)
+
+                # pushed.
+                while broker.last_id is None or broker.last_id < int(event['id']):
+                    await asyncio.sleep(0.01)
+                create_issue().add()  # other issue.
+                create_comment(issue=issue).add()
+                event = await asyncio.wait_for(read_event(reader), 5)
+                self.assertEqual(event['event'], 'comment')
+                self.assertEqual(int(event['id']), IssueEvent.get_last_id())
+                writer.close()
+                await writer.wait_closed()
+
+                (reader, writer) = await asyncio.open_connection('127.0.0.1', port)
+                writer.write(b'GET /no/events HTTP/1.1\r\n\r\n')
+                self.assertIn(b'404 Not Found', await reader.read())
+                writer.close()
+                await writer.wait_closed()
+
+                # unsubscribed when closed.
+                while broker.get_subscriber_count() > 0:
+                    await asyncio.sleep(0.01)
+            finally:
+                task.cancel()
+                server.close()
+                await server.wait_closed()
+
+        async def poll_with_error():
+            broker = events.EventBroker(ctx['APP'])
+            fetch = broker._fetch
+            calls = []
+
+            def fetch_with_error(*args):
+                calls.append(args)
+                if len(calls) == 1:
+                    raise OperationalError('SELECT', {}, Exception('database is locked'))
+                return fetch(*args)
+
+            broker._fetch = fetch_with_error
+            task = asyncio.ensure_future(broker.poll())
+            try:
+                async def wait_for_retry():
+                    while len(calls) < 2 and not task.done():
+                        await asyncio.sleep(0.01)
+
+                await asyncio.wait_for(wait_for_retry(), 5)
+                self.assertFalse(task.done())
+            finally:
+                task.cancel()
+
+        poll_interval = ctx['APP'].config.get('EVENTS_POLL_INTERVAL')
+        ctx['APP'].config['EVENTS_POLL_INTERVAL'] = 0.01
+        try:
+            asyncio.run(scenario())
+            # polling continues after errors.
+            with self.assertLogs(ctx['APP'].logger, 'ERROR'):
+                asyncio.run(poll_with_error())
+        finally:
+            ctx['APP'].config['EVENTS_POLL_INTERVAL'] = poll_interval
+
+    def test_post_large_attached_file_in_chunks(self):
+        """Test case of uploading a file larger than spool size. (HTTP POST)"""
+
+        data = bytes(range(256)) * 1024
+        self.assertGreater(len(data), ctx['APP'].config.get('UPLOAD_SPOOL_SIZE', 64 * 1024))
+        issue = create_issue()
+        issue.add()
+
+        with login():
+            ctx['TEST_APP'].post('/{}/'.format(issue.id), data={
+                'csrf_token': ctx['CSRF_TOKEN'],
+                'new_body': 'test body.test_post_large_attached_file_in_chunks',
+                'file': (io.BytesIO(data), 'large.bin')
+            })
+
+        attached_file = issue.comments[-1].attached_files[0]
+        self.assertEqual(attached_file.size, len(data))
+        self.assertEqual(attached_file.sha256, hashlib.sha256(data).hexdigest())
+        res = ctx['TEST_APP'].get('/download/{}/'.format(attached_file.id))
+        self.assertEqual(res.data, data)
+
+    def test_get_issue_conditional(self):
+        """Test case of conditional GET of issue list and detail. (HTTP GET)"""
+
+        issue = create_issue()
+        issue.add()
+        ctx['TEST_APP'].get('/user/login/') # set CSRF token to session.
+
+        for url in ['/', '/{}/'.format(issue.id)]:
+            res = ctx['TEST_APP'].get(url)
+            etag = res.headers['ETag']
+            self.assertEqual(res.status_code, 200)
+            self.assertIn('Last-Modified', res.headers)
+
+            res = ctx['TEST_APP'].get(url, headers={'If-None-Match': etag})
+            self.assertEqual(res.status_code, 304)
+            self.assertEqual(res.data, b'')
+
+            # modified by new comment.
+            create_comment(issue=issue).add()
+            res = ctx['TEST_APP'].get(url, headers={'If-None-Match': etag})
+            self.assertEqual(res.status_code, 200)
+            self.assertNotEqual(res.headers['ETag'], etag)
+
+            # login user changes page.
+            etag = res.headers['ETag']
+            with login() as (user, _):
+                res = ctx['TEST_APP'].get(url, headers={'If-None-Match': etag})
+                self.assertEqual(res.status_code, 200)
+
+                # so does new name of login user.
+                etag = res.headers['ETag']
+                user.name = 'renamed.test_get_issue_conditional'
+                user.save()
+                res = ctx['TEST_APP'].get(url, headers={'If-None-Match': etag})
+                self.assertEqual(res.status_code, 200)
+                self.assertIn(user.name, res.data.decode('utf-8'))
+
+    def test_fragment_cache(self):
+        """Test case of rendered fragment cache."""
+
+        user = create_user(name='testname.test_fragment_cache')
+        issue = create_issue(comments=[create_comment(user=user)])
+        issue.add()
+        url = '/{}/'.format(issue.id)
+
+        ctx['TEST_APP'].get(url)
+        before = json.loads(ctx['TEST_APP'].get('/stats/').data.decode('utf-8'))['fragment_cache']
+        ctx['TEST_APP'].get(url)
+        after = json.loads(ctx['TEST_APP'].get('/stats/').data.decode('utf-8'))['fragment_cache']
+        self.assertEqual(after['hits'] - before['hits'], 2)
+        self.assertEqual(after['misses'], before['misses'])
+
+        # invalidated by new comment.
+        create_comment(issue=issue, body='new body.test_fragment_cache').add()
+        res = ctx['TEST_APP'].get(url)
+        self.assertIn('new body.test_fragment_cache', res.data.decode('utf-8'))
+
+        # user name is changed.
+        user.name = 'new testname.test_fragment_cache'
+        user.save()
+        res = ctx['TEST_APP'].get(url)
+        self.assertIn('new testname.test_fragment_cache', res.data.decode('utf-8'))
+
+        # eviction.
+        evictions = metrics.get_counters().get('fragment_cache_evictions', 0)
+        backend = fragment_cache.LRUBackend(1)
+        backend.set('a', '1')
+        backend.set('b', '2')
+        self.assertIsNone(backend.get('a'))
+        self.assertEqual(backend.get('b'), '2')
+        self.assertEqual(backend.get_size(), 1)
+        self.assertEqual(metrics.get_counters()['fragment_cache_evictions'], evictions + 1)
+
+        # base class caches nothing.
+        backend = fragment_cache.CacheBackend()
+        backend.set('a', '1')
+        self.assertIsNone(backend.get('a'))
+        self.assertEqual(backend.get_size(), 0)
+
+    def test_query_budget(self):
+        """Test case of numbers of SQL statements per page."""
+
+        comments = [create_comment(attached_files=[create_attached_file(), create_attached_file()])
+                    for _ in range(10)]
+        issue = create_issue(comments=comments)
+        issue.add()
+        fragment_cache.invalidate_issue(issue.id)
+
+        with query_budget(3):
+            self.assertEqual(ctx['TEST_APP'].get('/').status_code, 200)
+        with query_budget(6):
+            self.assertEqual(ctx['TEST_APP'].get('/{}/'.format(issue.id)).status_code, 200)
+        with query_budget(1):
+            self.assertEqual(ctx['TEST_APP'].get('/{}/'.format(issue.id)).status_code, 200)
+        with query_budget(3):
+            res = ctx['TEST_APP'].get('/api/v1/issues/{}/comments/'.format(issue.id))
+            self.assertEqual(len(json.loads(res.data.decode('utf-8'))['items']), 10)
+
+        with self.assertRaises(AssertionError):
+            with query_budget(0):
+                db.session.execute('SELECT 1')
+
+    def test_repeated_queries(self):
+        """Test case of detecting statements repeated by a template."""
+
+        comments = [create_comment() for _ in range(5)]
+        issue = create_issue(comments=comments)
+        issue.add()
+        ids = [c.id for c in comments]
+        db.session.expire_all()
+
+        from flask import render_template_string
+        with ctx['APP'].test_request_context('/'), record_queries() as recorder:
+            render_template_string('{% for id in ids %}\n{{ get(id).user.name }}\n{% endfor %}',
+                    ids=ids, get=lambda id: Comment.query.get(id))
+        repeated = recorder.get_repeated(5)
+        self.assertEqual(len(repeated), 2)
+        self.assertEqual(repeated[0][1], 5)
+        self.assertEqual(repeated[0][2], '<template>:2')
+
+        # detector of requests is on in test mode, even if 'QUERY_DEBUG' is False.
+        self.assertFalse(ctx['APP'].config['QUERY_DEBUG'])
+        self.assertIn('start_recording_queries',
+                      [f.__name__ for f in ctx['APP'].before_request_funcs[None]])
+
     def test_get_no_issue_detail(self):
         """Test case of no issue detail. (HTTP GET)"""
 
@@ -198,6 +606,585 @@ class ZenmaiTestCase(unittest.TestCase):
         data = res.data.decode('utf-8')
         self.assertEqual(data, 'test content of attached file.test_get_download_attached_file.')
 
+        # stream is closed also for HEAD, which reads no body.
+        for (method, stored) in [('GET', False), ('HEAD', False), ('HEAD', True)]:
+            stream = io.BytesIO(b'test')
+            with mock.patch.object(AttachedFile, 'open', return_value=stream), \
+                    mock.patch.object(AttachedFile, 'open_stored', return_value=stream), \
+                    mock.patch.object(AttachedFile, 'get_codec', return_value='deflate' if stored else 'identity'), \
+                    mock.patch.object(AttachedFile, 'get_stored_size', return_value=4):
+                res = ctx['TEST_APP'].open('/download/{}/'.format(attached_file.id), method=method,
+                                           headers={'Accept-Encoding': 'deflate'})
+                res.close()
+            self.assertEqual(res.status_code, 200)
+            self.assertTrue(stream.closed, method)
+
+    def test_get_download_attached_file_range(self):
+        """Test case of downloading a part of attached file. (HTTP GET)"""
+
+        attached_file = create_attached_file(data=b'0123456789')
+        comment = create_comment(attached_files=[attached_file])
+        issue = create_issue(comments=[comment])
+        issue.add()
+        url = '/download/{}/'.format(attached_file.id)
+
+        res = ctx['TEST_APP'].get(url, headers={'Range': 'bytes=2-5'})
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(res.data, b'2345')
+        self.assertEqual(res.headers['Content-Range'], 'bytes 2-5/10')
+        self.assertEqual(res.headers['Content-Length'], '4')
+
+        res = ctx['TEST_APP'].get(url, headers={'Range': 'bytes=20-'})
+        self.assertEqual(res.status_code, 416)
+
+        # conditional request.
+        etag = ctx['TEST_APP'].get(url).headers['ETag']
+        res = ctx['TEST_APP'].get(url, headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+    def test_attached_file_storage(self):
+        """Test case of attached file storages."""
+
+        # deduplication.
+        data = b'test content of attached file.test_attached_file_storage.'
+        attached_files = [create_attached_file(data=data) for i in range(2)]
+        issue = create_issue(comments=[create_comment(attached_files=attached_files)])
+        issue.add()
+        self.assertEqual(attached_files[0].storage, 'filesystem')
+        self.assertEqual(attached_files[0].sha256, attached_files[1].sha256)
+        self.assertEqual(attached_files[0].size, len(data))
+
+        # move from database to file system.
+        ctx['APP'].config['ATTACHMENT_STORAGE'] = 'database'
+        try:
+            attached_file = create_attached_file(data=data)
+            issue = create_issue(comments=[create_comment(attached_files=[attached_file])])
+            issue.add()
+        finally:
+            ctx['APP'].config['ATTACHMENT_STORAGE'] = 'filesystem'
+        self.assertEqual(attached_file.storage, 'database')
+
+        move_attached_files_to_file_system()
+        self.assertEqual(attached_file.storage, 'filesystem')
+        self.assertEqual(attached_file.sha256, attached_files[0].sha256)
+        res = ctx['TEST_APP'].get('/download/{}/'.format(attached_file.id))
+        self.assertEqual(res.data, data)
+
+    def test_attached_file_compression(self):
+        """Test case of compressed attached files."""
+
+        data = b'2017-01-01 00:00:00 INFO test_attached_file_compression.\n' * 1000
+        incompressible = os.urandom(4096)
+        for storage in ['filesystem', 'database']:
+            ctx['APP'].config['ATTACHMENT_STORAGE'] = storage
+            try:
+                attached_files = [create_attached_file(data=data), create_attached_file(data=incompressible)]
+                issue = create_issue(comments=[create_comment(attached_files=attached_files)])
+                issue.add()
+            finally:
+                ctx['APP'].config['ATTACHMENT_STORAGE'] = 'filesystem'
+            (compressed, raw) = attached_files
+            self.assertIn(compressed.codec, ['deflate', 'zstd'])
+            self.assertEqual(compressed.size, len(data))
+            self.assertLess(compressed.stored_size, len(data) / 10)
+            self.assertEqual(compressed.sha256, hashlib.sha256(data).hexdigest())
+            self.assertEqual(raw.codec, 'identity')
+
+            url = '/download/{}/'.format(compressed.id)
+            res = ctx['TEST_APP'].get(url)
+            self.assertEqual(res.data, data)
+            self.assertIsNone(res.headers.get('Content-Encoding'))
+            self.assertEqual(res.headers['Vary'], 'Accept-Encoding')
+            res = ctx['TEST_APP'].get(url, headers={'Range': 'bytes=60000-60009'})
+            self.assertEqual(res.data, data[60000:60010])
+
+            # passed through as is.
+            res = ctx['TEST_APP'].get(url, headers={'Accept-Encoding': 'gzip, ' + compressed.codec})
+            self.assertEqual(res.headers['Content-Encoding'], compressed.codec)
+            self.assertEqual(int(res.headers['Content-Length']), compressed.stored_size)
+            if compressed.codec == 'deflate':
+                self.assertEqual(zlib.decompress(res.data), data)
+            res = ctx['TEST_APP'].get(url, headers={'Accept-Encoding': compressed.codec,
+                                                    'If-None-Match': res.headers['ETag']})
+            self.assertEqual(res.status_code, 304)
+
+            res = ctx['TEST_APP'].get('/download/{}/'.format(raw.id), headers={'Accept-Encoding': 'deflate'})
+            self.assertEqual(res.data, incompressible)
+            self.assertIsNone(res.headers.get('Content-Encoding'))
+
+        # codec is kept when moved to file system.
+        move_attached_files_to_file_system()
+        self.assertEqual(compressed.storage, 'filesystem')
+        self.assertEqual(ctx['TEST_APP'].get('/download/{}/'.format(compressed.id)).data, data)
+
+    def test_response_compression(self):
+        """Test case of compressed responses. (HTTP GET)"""
+
+        issue = create_issue(subject='test subject.test_response_compression.' * 50)
+        issue.add()
+        url = '/{}/'.format(issue.id)
+        plain = ctx['TEST_APP'].get(url)
+        self.assertIsNone(plain.headers.get('Content-Encoding'))
+
+        res = ctx['TEST_APP'].get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(int(res.headers['Content-Length']), len(res.data))
+        self.assertLess(len(res.data), len(plain.data))
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+
+        # not accepted.
+        res = ctx['TEST_APP'].get(url, headers={'Accept-Encoding': 'gzip;q=0'})
+        self.assertIsNone(res.headers.get('Content-Encoding'))
+
+        # small responses.
+        res = ctx['TEST_APP'].get('/api/v1/states/', headers={'Accept-Encoding': 'gzip'})
+        self.assertLess(len(res.data), ctx['APP'].config['COMPRESS_MIN_SIZE'])
+        self.assertIsNone(res.headers.get('Content-Encoding'))
+
+    def test_static_assets(self):
+        """Test case of fingerprinted static files. (HTTP GET)"""
+
+        data = ctx['TEST_APP'].get('/user/login/').data.decode('utf-8')
+        url = re.search(r'href="(/assets/style\.[0-9a-f]{12}\.css)"', data).group(1)
+        with open(os.path.join(ctx['APP'].static_folder, 'style.css'), 'rb') as f:
+            original = f.read()
+
+        res = ctx['TEST_APP'].get(url)
+        self.assertEqual(res.data, original)
+        self.assertEqual(res.mimetype, 'text/css')
+        self.assertEqual(res.headers['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertIsNone(res.headers.get('Content-Encoding'))
+        res.close()
+
+        res = ctx['TEST_APP'].get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(res.data), original)
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        res.close()
+
+        # only fingerprinted names are served.
+        self.assertEqual(ctx['TEST_APP'].get('/assets/style.css').status_code, 404)
+        self.assertEqual(ctx['TEST_APP'].get(url + '.gz').status_code, 404)
+
+        # built files are readable by others as umask permits.
+        build_dir = tempfile.mkdtemp()
+        umask = os.umask(0o022)
+        try:
+            manifest = static_assets.build(ctx['APP'].static_folder, build_dir)
+            path = os.path.join(build_dir, manifest['style.css'])
+            for p in [path, path + '.gz']:
+                self.assertEqual(os.stat(p).st_mode & 0o777, 0o644)
+
+            # files of old versions are deleted.
+            old = os.path.join(build_dir, 'style.0123456789ab.css')
+            other = os.path.join(build_dir, 'other.txt')
+            for p in [old, old + '.gz', other]:
+                open(p, 'wb').close()
+            static_assets.build(ctx['APP'].static_folder, build_dir)
+            self.assertEqual([os.path.exists(p) for p in [old, old + '.gz', other, path, path + '.gz']],
+                             [False, False, True, True, True])
+        finally:
+            os.umask(umask)
+            shutil.rmtree(build_dir)
+
+    def test_search(self):
+        """Test case of search page. (HTTP GET)"""
+
+        comment = create_comment(body='<b>zenmaisearchword</b> in body.')
+        issue = create_issue(subject='subject.test_search', comments=[comment])
+        issue.add()
+        other = create_issue(subject='zenmaisearchsubject.test_search')
+        other.add()
+
+        # comment body.
+        res = ctx['TEST_APP'].get('/search/?q=zenmaisearchword')
+        data = res.data.decode('utf-8')
+        self.assertIn('<a href="/{}/">'.format(issue.id), data)
+        self.assertNotIn('<a href="/{}/">'.format(other.id), data)
+        self.assertIn('&lt;b&gt;<mark>zenmaisearchword</mark>&lt;/b&gt;', data)
+
+        # subject, also after it is changed.
+        other.subject = 'zenmaisearchchanged.test_search'
+        other.add()
+        res = ctx['TEST_APP'].get('/search/?q=zenmaisearchchanged')
+        self.assertIn('<a href="/{}/">'.format(other.id), res.data.decode('utf-8'))
+        res = ctx['TEST_APP'].get('/search/?q=zenmaisearchsubject')
+        self.assertIn('No issues found.', res.data.decode('utf-8'))
+
+        # FTS5 syntax is not interpreted.
+        res = ctx['TEST_APP'].get('/search/?q=%22zenmaisearchword+OR+(')
+        self.assertEqual(res.status_code, 200)
+
+    def test_state_cache(self):
+        """Test case of process-wide state cache."""
+
+        states = State.all()
+        self.assertEqual([state.name for state in states], ['Open', 'Closed'])
+        self.assertIs(State.all(), states)
+        self.assertEqual(State.get(states[0].id).name, 'Open')
+
+        # changed by other process.
+        check_interval = ctx['APP'].config.get('STATE_CACHE_CHECK_INTERVAL')
+        ctx['APP'].config['STATE_CACHE_CHECK_INTERVAL'] = 0
+        try:
+            state = State.query.get(states[0].id)
+            state.name = 'Reopened'
+            VersionStamp.bump('state')
+            db.session.commit()
+            self.assertEqual(State.get(states[0].id).name, 'Reopened')
+
+            state.name = 'Open'
+            state.save()
+            self.assertEqual(State.all()[0].name, 'Open')
+        finally:
+            ctx['APP'].config['STATE_CACHE_CHECK_INTERVAL'] = check_interval
+
+    def test_metrics(self):
+        """Test case of metrics in Prometheus text format."""
+
+        ctx['TEST_APP'].get('/')
+        ctx['TEST_APP'].get('/no/such/page/')
+        res = ctx['TEST_APP'].get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+
+        samples = {}
+        for line in res.data.decode('utf-8').splitlines():
+            if not line.startswith('#'):
+                (name, value) = line.rsplit(' ', 1)
+                samples[name] = float(value)
+        self.assertGreaterEqual(samples['zenmai_http_requests_total{endpoint="index",method="GET",status="200"}'], 1)
+        self.assertGreaterEqual(samples['zenmai_http_requests_total{endpoint="none",method="GET",status="404"}'], 1)
+        self.assertEqual(samples['zenmai_http_request_duration_seconds_count{endpoint="index",method="GET"}'],
+                samples['zenmai_http_request_duration_seconds_bucket{endpoint="index",method="GET",le="+Inf"}'])
+        self.assertGreater(samples['zenmai_sql_queries_total{endpoint="index",method="GET"}'], 0)
+        self.assertGreater(samples['zenmai_http_response_bytes_total{endpoint="index",method="GET"}'], 0)
+        self.assertIn('zenmai_fragment_cache_hits_total', samples)
+
+        # counters of finished threads are kept, but the threads are not.
+        def count_metrics_requests():
+            res = ctx['TEST_APP'].get('/metrics')
+            return sum(float(line.rsplit(' ', 1)[1]) for line in res.data.decode('utf-8').splitlines()
+                       if line.startswith('zenmai_http_requests_total{endpoint="export_metrics"'))
+
+        count = count_metrics_requests()
+        thread = threading.Thread(target=lambda: ctx['TEST_APP'].get('/metrics'))
+        thread.start()
+        thread.join()
+        self.assertEqual(count_metrics_requests(), count + 2)
+        self.assertNotIn(thread, [t for (t, _) in metrics._all_thread_metrics])
+
+    def test_api_issues(self):
+        """Test case of issues API. (HTTP GET)"""
+
+        issues = [create_issue() for i in range(3)]
+        for issue in issues:
+            issue.add()
+
+        # keyset pagination and sparse fieldsets.
+        res = ctx['TEST_APP'].get('/api/v1/issues/?after={}&limit=2&fields=id,subject,state'.format(issues[0].id))
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.mimetype, 'application/json')
+        self.assertEqual(data['items'], [
+            {'id': issues[1].id, 'subject': issues[1].subject, 'state': 'Open'},
+            {'id': issues[2].id, 'subject': issues[2].subject, 'state': 'Open'}])
+        self.assertEqual(data['next_after'], issues[2].id)
+
+        # state which is not cached yet.
+        with mock.patch.object(State, 'get', return_value=None):
+            res = ctx['TEST_APP'].get('/api/v1/issues/{}/?fields=state'.format(issues[0].id))
+        self.assertEqual(json.loads(res.data.decode('utf-8')), {'state': 'Open'})
+
+        # bulk fetch.
+        res = ctx['TEST_APP'].get('/api/v1/issues/?ids={},{}&fields=id'.format(issues[2].id, issues[0].id))
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(data['items'], [{'id': issues[0].id}, {'id': issues[2].id}])
+
+        # errors.
+        res = ctx['TEST_APP'].get('/api/v1/issues/?fields=id,unknown')
+        self.assertEqual(res.status_code, 400)
+        self.assertIn('unknown', json.loads(res.data.decode('utf-8'))['error']['message'])
+        res = ctx['TEST_APP'].get('/api/v1/issues/{}/'.format(issues[2].id + 1))
+        self.assertEqual(res.status_code, 404)
+
+    def test_api_comments(self):
+        """Test case of comments API. (HTTP GET)"""
+
+        attached_file = create_attached_file(name='test.txt', data=b'test.test_api_comments')
+        comment = create_comment(attached_files=[attached_file])
+        issue = create_issue(comments=[comment])
+        issue.add()
+
+        res = ctx['TEST_APP'].get('/api/v1/issues/{}/comments/'.format(issue.id))
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(len(data['items']), 1)
+        self.assertEqual(data['items'][0]['body'], comment.body)
+        self.assertEqual(data['items'][0]['user_name'], comment.user.name)
+        self.assertEqual(data['items'][0]['attached_files'][0]['name'], 'test.txt')
+        self.assertEqual(data['next_after'], None)
+
+        res = ctx['TEST_APP'].get('/api/v1/attachments/{}/?fields=size,download_url'.format(attached_file.id))
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(data, {'size': 22, 'download_url': '/download/{}/'.format(attached_file.id)})
+
+        res = ctx['TEST_APP'].get('/api/v1/states/?fields=name')
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(data['items'], [{'name': 'Open'}, {'name': 'Closed'}])
+
+    def test_import_ndjson(self):
+        """Test case of bulk import from NDJSON."""
+
+        user_id = str(uuid.uuid4())
+        records = [
+            {'type': 'user', 'id': user_id, 'name': 'testname.test_import_ndjson',
+             'hashed_password': User(user_id, 'name', 'test').hashed_password.decode('ascii')},
+            {'type': 'issue', 'id': 100001, 'subject': 'test subject.test_import_ndjson', 'state_id': 1},
+            {'type': 'comment', 'id': 100001, 'issue_id': 100001, 'user_id': user_id,
+             'pub_date': '2017-01-02T03:04:05Z', 'body': 'test body.test_import_ndjson'},
+            {'type': 'attachment', 'id': 100001, 'comment_id': 100001, 'name': 'test.txt',
+             'data': base64.b64encode(b'test content.test_import_ndjson').decode('ascii')},
+            {'type': 'comment', 'id': 100002, 'issue_id': 100001, 'user_id': user_id,
+             'pub_date': '2017-01-03T03:04:05Z', 'body': 'test body 2.test_import_ndjson'},
+        ]
+        lines = [json.dumps(record) + '\n' for record in records]
+        (fd, path) = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            # interrupted by broken record.
+            with open(path, 'w') as f:
+                f.writelines(lines[:4] + ['{broken\n'])
+            with self.assertRaises(ValueError):
+                import_ndjson(path, batch_size=2, out=io.StringIO())
+            self.assertIsNotNone(User.get(user_id))
+
+            # resumed.
+            with open(path, 'w') as f:
+                f.writelines(lines)
+            out = io.StringIO()
+            self.assertEqual(import_ndjson(path, batch_size=2, out=out), 1)
+            self.assertIn('resume from byte', out.getvalue())
+        finally:
+            os.unlink(path)
+
+        issue = Issue.get(100001)
+        self.assertEqual(issue.comment_count, 2)
+        self.assertEqual(issue.last_comment_at, datetime(2017, 1, 3, 3, 4, 5))
+        res = ctx['TEST_APP'].get('/100001/')
+        self._assert_issue_detail(
+                data=res.data.decode('utf-8'),
+                subject='test subject\.test_import_ndjson',
+                body='test body\.test_import_ndjson',
+                pub_date=datetime(2017, 1, 2, 3, 4, 5),
+                state_name='Open',
+                attached_file_name='test\.txt')
+        res = ctx['TEST_APP'].get('/download/100001/')
+        self.assertEqual(res.data, b'test content.test_import_ndjson')
+
+    def test_export_ndjson(self):
+        """Test case of streaming export to NDJSON."""
+
+        since = datetime.utcnow() + timedelta(days=30)
+        attached_file = create_attached_file(name='test.txt', data=b'test content.test_export_ndjson')
+        comment = create_comment(body='test body.test_export_ndjson', pub_date=since, attached_files=[attached_file])
+        issue = create_issue(comments=[comment])
+        issue.add()
+
+        out = io.BytesIO()
+        export_ndjson(out, since=since)
+        records = [json.loads(line.decode('utf-8')) for line in out.getvalue().splitlines()]
+        self.assertEqual([r['id'] for r in records if r['type'] == 'comment'], [comment.id])
+        self.assertEqual([r['id'] for r in records if r['type'] == 'attachment'], [attached_file.id])
+        self.assertIn(comment.user.id, [r['id'] for r in records if r['type'] == 'user'])
+        self.assertEqual(records[-1]['data'], base64.b64encode(b'test content.test_export_ndjson').decode('ascii'))
+
+        # tar.
+        out = io.BytesIO()
+        with tarfile.open(fileobj=out, mode='w|') as tar:
+            export_ndjson(io.BytesIO(), since=since, tar=tar)
+        out.seek(0)
+        with tarfile.open(fileobj=out) as tar:
+            self.assertEqual(tar.getnames(), ['attachments/{}/{}/{}'.format(
+                attached_file.sha256[0:2], attached_file.sha256[2:4], attached_file.sha256)])
+
+        # exported records can be imported again.
+        (fd, path) = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(json.dumps(records[-1]).encode('utf-8') + b'\n')
+            self.assertEqual(import_ndjson(path, out=io.StringIO()), 1)
+        finally:
+            os.unlink(path)
+        self.assertEqual(ctx['TEST_APP'].get('/download/{}/'.format(attached_file.id)).data,
+                b'test content.test_export_ndjson')
+
+        # data larger than a chunk.
+        data = os.urandom(100001)
+        large_file = create_attached_file(name='large.bin', data=data)
+        issue = create_issue(comments=[create_comment(pub_date=since, attached_files=[large_file])])
+        issue.add()
+        out = io.BytesIO()
+        export_ndjson(out, since=since)
+        record = json.loads(out.getvalue().splitlines()[-1].decode('utf-8'))
+        self.assertEqual(base64.b64decode(record['data']), data)
+
+        # rows written by others while exporting are not exported.
+        subject = 'test subject.{}'.format(uuid.uuid4())
+
+        class Writer(io.BytesIO):
+            def write(self, data):
+                if self.tell() == 0:
+                    with db.engine.connect() as connection:
+                        connection.execute('INSERT INTO issue (subject, state_id, updated_at) VALUES (?, 1, ?)',
+                                           subject, since)
+                return io.BytesIO.write(self, data)
+
+        out = Writer()
+        export_ndjson(out, since=since)
+        self.assertNotIn(subject.encode('utf-8'), out.getvalue())
+        db.session.execute('DELETE FROM issue WHERE subject = :subject', {'subject': subject})
+        db.session.commit()
+
+    def test_import_ndjson_over_compressed_attachment(self):
+        """Test case of importing exported records over compressed attached files."""
+
+        data = b'test content.test_import_ndjson_over_compressed_attachment.\n' * 1000
+        attached_files = [create_attached_file(data=data) for i in range(2)]
+        ctx['APP'].config['ATTACHMENT_STORAGE'] = 'database'
+        try:
+            attached_files.append(create_attached_file(data=data))
+        finally:
+            ctx['APP'].config['ATTACHMENT_STORAGE'] = 'filesystem'
+        issue = create_issue(comments=[create_comment(attached_files=attached_files)])
+        issue.add()
+        self.assertEqual([a.codec for a in attached_files], ['deflate'] * 3)
+        ids = [a.id for a in attached_files]
+
+        out = io.BytesIO()
+        export_ndjson(out)
+        records = [json.loads(line.decode('utf-8')) for line in out.getvalue().splitlines()]
+        records = [r for r in records if r['type'] == 'attachment' and r['id'] in ids]
+        # data is already in file system storage. e.g. extracted from 'export --tar'.
+        del records[0]['data']
+        records[0].update(sha256=attached_files[0].sha256, size=attached_files[0].size)
+        get_file_system_storage().save(io.BytesIO(data))
+
+        (fd, path) = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.writelines(json.dumps(r).encode('utf-8') + b'\n' for r in records)
+            self.assertEqual(import_ndjson(path, out=io.StringIO()), 3)
+        finally:
+            os.unlink(path)
+        for id in ids:
+            attached_file = AttachedFile.get(id)
+            self.assertEqual(attached_file.codec, 'identity')
+            self.assertIsNone(attached_file.stored_size)
+            self.assertEqual(ctx['TEST_APP'].get('/download/{}/'.format(id)).data, data)
+
+    def test_foreign_key_indexes(self):
+        """Test case of query plans using indexes of foreign keys."""
+
+        def explain(sql):
+            return ' '.join(row[3] for row in db.session.execute('EXPLAIN QUERY PLAN ' + sql))
+
+        self.assertIn('ix_comment_issue_id', explain('SELECT * FROM comment WHERE issue_id = 1 ORDER BY id'))
+        self.assertIn('ix_attached_file_comment_id', explain('SELECT id FROM attached_file WHERE comment_id = 1'))
+        self.assertIn('ix_issue_state_id', explain('SELECT id FROM issue WHERE state_id = 1'))
+        plan = explain('SELECT * FROM issue WHERE id < 100 ORDER BY id DESC LIMIT 50')
+        self.assertIn('USING INTEGER PRIMARY KEY', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+        plan = explain('SELECT * FROM issue WHERE state_id = 1 AND id > 100 ORDER BY id LIMIT 50')
+        self.assertIn('ix_issue_state_id', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_engine(self):
+        """Test case of tuned SQLite engines."""
+
+        app = ctx['APP']
+        self.assertEqual(db.session.execute('PRAGMA journal_mode').scalar(), 'wal')
+        self.assertEqual(db.session.execute('PRAGMA busy_timeout').scalar(), app.config['SQLITE_BUSY_TIMEOUT'])
+
+        db.session.commit()
+        read_engine = db.get_read_engine()
+        with app.test_request_context('/', method='GET'):
+            self.assertIs(db.session.get_bind(), read_engine)
+            # textual SQL may write.
+            VersionStamp.bump('test_engine')
+            self.assertIs(db.session.get_bind(), db.engine)
+            db.session.commit()
+        with app.test_request_context('/', method='POST'):
+            self.assertIs(db.session.get_bind(), db.engine)
+        with self.assertRaises(Exception):
+            read_engine.execute("INSERT INTO state (name, value) VALUES ('read only', 50)")
+
+        # readers do not wait for a writer.
+        connection = db.engine.connect()
+        try:
+            transaction = connection.begin()
+            connection.execute("UPDATE state SET name = name")
+            self.assertEqual(ctx['TEST_APP'].get('/').status_code, 200)
+            transaction.rollback()
+        finally:
+            connection.close()
+
+    def test_migrate(self):
+        """Test case of migrating database of the first schema."""
+
+        from sqlalchemy import create_engine
+
+        self.assertEqual(migrations.get_version(db.engine), migrations.LATEST_VERSION)
+
+        (fd, path) = tempfile.mkstemp()
+        os.close(fd)
+        engine = create_engine('sqlite:///' + path)
+        try:
+            with engine.begin() as connection:
+                for ddl in ['CREATE TABLE state (id INTEGER PRIMARY KEY, name VARCHAR(32) NOT NULL, value INTEGER NOT NULL UNIQUE)',
+                            'CREATE TABLE user (id VARCHAR(32) PRIMARY KEY, name VARCHAR(32) NOT NULL, hashed_password BLOB NOT NULL)',
+                            'CREATE TABLE issue (id INTEGER PRIMARY KEY, subject VARCHAR(256) NOT NULL, state_id INTEGER NOT NULL)',
+                            'CREATE TABLE comment (id INTEGER PRIMARY KEY, issue_id INTEGER NOT NULL, user_id VARCHAR(32) NOT NULL,'
+                            ' pub_date DATETIME NOT NULL, body TEXT NOT NULL)',
+                            'CREATE TABLE attached_file (id INTEGER PRIMARY KEY, comment_id INTEGER NOT NULL,'
+                            ' name VARCHAR(256) NOT NULL, data BLOB NOT NULL)',
+                            "INSERT INTO issue VALUES (1, 'migrated subject', 1)",
+                            "INSERT INTO comment VALUES (1, 1, 'user', '2017-01-01 00:00:00', 'migrated body')",
+                            "INSERT INTO comment VALUES (2, 1, 'user', '2017-01-02 00:00:00', 'body')"]:
+                    connection.execute(ddl)
+
+            applied = migrations.migrate(engine)
+            self.assertEqual([v for (v, _) in applied], [v for (v, _, _) in migrations.MIGRATIONS])
+            self.assertEqual(migrations.get_version(engine), migrations.LATEST_VERSION)
+            self.assertEqual(migrations.migrate(engine), [])
+
+            with engine.connect() as connection:
+                self.assertEqual(tuple(connection.execute('SELECT comment_count, last_comment_at, version FROM issue').first()),
+                        (2, '2017-01-02 00:00:00', 0))
+                self.assertEqual(connection.execute('SELECT storage FROM attached_file').fetchall(), [])
+                self.assertEqual(connection.execute(
+                        "SELECT rowid FROM comment_fts WHERE comment_fts MATCH 'migrated'").fetchall(), [(1,)])
+                indexes = [row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")]
+                self.assertIn('ix_comment_issue_id', indexes)
+                self.assertIn('ix_issue_event_issue_id', indexes)
+                self.assertIn('AUTOINCREMENT', connection.execute(
+                        "SELECT sql FROM sqlite_master WHERE name = 'issue_event'").scalar())
+
+            # events table created without AUTOINCREMENT.
+            with engine.begin() as connection:
+                for ddl in ['DROP TABLE issue_event',
+                            'CREATE TABLE issue_event (id INTEGER NOT NULL PRIMARY KEY, issue_id INTEGER NOT NULL,'
+                            ' type VARCHAR(16) NOT NULL, comment_id INTEGER, state_id INTEGER, created_at DATETIME NOT NULL)',
+                            "INSERT INTO issue_event VALUES (5, 1, 'issue', NULL, 1, '2017-01-01 00:00:00')"]:
+                    connection.execute(ddl)
+                migrations._add_issue_event_autoincrement(connection)
+                connection.execute('DELETE FROM issue_event')
+                connection.execute("INSERT INTO issue_event (issue_id, type, created_at) VALUES (1, 'issue', '2017-01-02 00:00:00')")
+                self.assertEqual(connection.execute('SELECT id FROM issue_event').fetchall(), [(6,)])
+        finally:
+            engine.dispose()
+            os.unlink(path)
+
     def test_get_login_page(self):
         """Test case of login page. (HTTP GET)"""
 
@@ -206,6 +1193,24 @@ class ZenmaiTestCase(unittest.TestCase):
         self.assertIn('<title>Zenmai - login</title>', data)
         self.assertEqual(res.status_code, 200)
 
+    def test_csrf_token_masking(self):
+        """Test case of CSRF tokens masked per response."""
+
+        def token(res):
+            return re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', res.data.decode('utf-8')).group(1)
+
+        tokens = [token(ctx['TEST_APP'].get('/user/login/?next=/token/')) for _ in range(2)]
+        self.assertNotEqual(tokens[0], tokens[1])
+        self.assertNotIn(ctx['CSRF_TOKEN'], tokens)
+
+        data = {'user_id': 'testid.test_csrf_token_masking', 'password': 'wrong'}
+        for value in [tokens[0], tokens[1], ctx['CSRF_TOKEN']]:
+            res = ctx['TEST_APP'].post('/user/login/', data=dict(data, csrf_token=value))
+            self.assertNotEqual(res.status_code, 403)
+        for value in [tokens[0][1:], tokens[0][:-4], 'wrong', '']:
+            res = ctx['TEST_APP'].post('/user/login/', data=dict(data, csrf_token=value))
+            self.assertEqual(res.status_code, 403)
+
     def test_post_login_page(self):
         """Test case of login. (HTTP POST)"""
 
@@ -220,6 +1225,73 @@ class ZenmaiTestCase(unittest.TestCase):
             self.assertEqual(res.status_code, 200)
             self.assertIn('<li><a href="/user/">{}(id:{})</a></li>'.format(user.name, user.id), data)
 
+    def test_post_login_page_rehash(self):
+        """Test case of rehashing password on login. (HTTP POST)"""
+
+        user = create_user(password='testpassword.test_post_login_page_rehash')
+        ctx['APP'].config['BCRYPT_ROUNDS'] = 5
+        try:
+            self.assertTrue(user.needs_rehash())
+            with login(user, 'testpassword.test_post_login_page_rehash'):
+                pass
+            user = User.get(user.id)
+            self.assertFalse(user.needs_rehash())
+            self.assertTrue(user.authenticate('testpassword.test_post_login_page_rehash'))
+        finally:
+            ctx['APP'].config['BCRYPT_ROUNDS'] = 4
+
+    def test_post_login_page_rehash_saturated(self):
+        """Test case of login while rehashing password is saturated. (HTTP POST)"""
+
+        user = create_user(password='testpassword.test_post_login_page_rehash_saturated')
+        ctx['APP'].config['BCRYPT_ROUNDS'] = 5
+        try:
+            with mock.patch.object(password_hasher, 'hash_password', side_effect=ZenHttpException(503)):
+                with login(user, 'testpassword.test_post_login_page_rehash_saturated') as (_, res):
+                    self.assertEqual(res.status_code, 200)
+                    self.assertIn('<a href="/user/">', res.data.decode('utf-8'))
+            self.assertTrue(User.get(user.id).needs_rehash())
+        finally:
+            ctx['APP'].config['BCRYPT_ROUNDS'] = 4
+
+    def test_post_login_page_unknown_user(self):
+        """Test case of login of unknown user. (HTTP POST)"""
+
+        password_hasher._dummy_hashes.clear()
+        # only a check, as for known users.
+        with mock.patch.object(password_hasher, 'hash_password', side_effect=AssertionError('hashed')), \
+                mock.patch.object(password_hasher, 'check_password',
+                                  wraps=password_hasher.check_password) as check_password:
+            res = ctx['TEST_APP'].post('/user/login/', data={
+                'csrf_token': ctx['CSRF_TOKEN'],
+                'user_id': 'unknown.test_post_login_page_unknown_user',
+                'password': 'testpassword.test_post_login_page_unknown_user'
+            })
+        self.assertNotEqual(res.status_code, 500)
+        self.assertEqual(check_password.call_count, 1)
+        with ctx['TEST_APP'] as client:
+            client.get('/')
+            self.assertNotIn(AUTH_USER_ID_KEY, session)
+
+    def test_post_login_page_saturated(self):
+        """Test case of login while password hashing is saturated. (HTTP POST)"""
+
+        user = create_user(password='testpassword.test_post_login_page_saturated')
+        (_, slots) = password_hasher._get_executor()
+        acquired = 0
+        while slots.acquire(blocking=False):
+            acquired += 1
+        try:
+            res = ctx['TEST_APP'].post('/user/login/', data={
+                'csrf_token': ctx['CSRF_TOKEN'],
+                'user_id': user.id,
+                'password': 'testpassword.test_post_login_page_saturated'
+            })
+            self.assertEqual(res.status_code, 503)
+        finally:
+            for i in range(acquired):
+                slots.release()
+
     def test_get_logout_page(self):
         """Test case of logout. (HTTP GET)"""
 
@@ -311,6 +1383,32 @@ class ZenmaiTestCase(unittest.TestCase):
             self.assertIn('<td>{}</td>'.format(user.name), data)
             self.assertEqual(res.status_code, 200)
 
+    def test_user_cache(self):
+        """Test case of process-local user cache."""
+
+        ctx['APP'].config['USER_CACHE_SIZE'] = 1
+        try:
+            user = create_user(name='testname.test_user_cache', password='test')
+            self.assertEqual(User.get_cached(user.id).name, 'testname.test_user_cache')
+
+            # invalidated by save().
+            user.name = 'new testname.test_user_cache'
+            user.save()
+            self.assertEqual(User.get_cached(user.id).name, 'new testname.test_user_cache')
+
+            # evicted.
+            other = create_user(password='test')
+            self.assertEqual(User.get_cached(other.id).id, other.id)
+            self.assertEqual(User.get_cached(user.id).id, user.id)
+
+            with login(user, 'test'):
+                pass
+            with login(other, 'test'):
+                res = ctx['TEST_APP'].get('/user/')
+                self.assertIn('<td>{}</td>'.format(other.id), res.data.decode('utf-8'))
+        finally:
+            ctx['APP'].config['USER_CACHE_SIZE'] = 0
+
     def test_get_user_edit_page(self):
         """Test case of user edit page. (HTTP GET)"""
 
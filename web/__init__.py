@@ -1,8 +1,12 @@
 """Initializing 'web' module."""
 
+import base64
+import hmac
+import os
 import uuid
 from os.path import join
-from flask import Flask, session
+from tempfile import SpooledTemporaryFile
+from flask import Flask, Request, current_app, session
 
 CSRF_TOKEN_KEY = 'csrf_token'
 csrf_token_for_testing = ''
@@ -11,6 +15,19 @@ AUTH_USER_ID_KEY = 'authenticated_user_id'
 
 NOT_AUTHENTICATED_MESSAGE = 'you need to login.'
 
+class ZenRequest(Request):
+    """Request class.
+
+    Spools uploaded files to temporary files in chunks
+    instead of keeping them in memory.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        return SpooledTemporaryFile(
+                max_size=current_app.config.get('UPLOAD_SPOOL_SIZE', 64 * 1024),
+                mode='rb+')
+
 def create_app():
     """Creates Flask application.
 
@@ -21,17 +38,57 @@ def create_app():
     """
 
     app = Flask(__name__)
+    app.request_class = ZenRequest
     app.logger.debug('__name__ = {name}\nroot_path = {root_path}'.format(
         name=__name__, root_path=app.root_path))
     app.config.from_pyfile(join(app.root_path, 'zenmai.config.py'))
     app.config['version'] = '0.0.1'
     return app
 
+def _xor(a, b):
+    return bytes(x ^ y for (x, y) in zip(a, b))
+
+def mask_csrf_token(token):
+    """Masks CSRF token with a random pad.
+
+    Masked tokens differ in every response, so compressed responses
+    do not reveal the token by their sizes (BREACH).
+
+    Args:
+        token (string): CSRF token in session.
+
+    Returns:
+        Masked token.
+    """
+
+    data = token.encode('utf-8')
+    pad = os.urandom(len(data))
+    return base64.urlsafe_b64encode(pad + _xor(pad, data)).decode('ascii')
+
+def unmask_csrf_token(masked):
+    """Returns CSRF token masked by 'mask_csrf_token()'. None if malformed.
+
+    Args:
+        masked (string): masked token.
+    """
+
+    try:
+        data = base64.urlsafe_b64decode(masked.encode('ascii'))
+    except ValueError:
+        return None
+    if len(data) % 2 != 0:
+        return None
+    size = len(data) // 2
+    try:
+        return _xor(data[:size], data[size:]).decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+
 def create_csrf_token():
     """Creates CSRF token and store it to session.
 
     Returns:
-        CSRF token.
+        CSRF token masked by 'mask_csrf_token()'.
     """
 
     if CSRF_TOKEN_KEY not in session:
@@ -39,10 +96,10 @@ def create_csrf_token():
             session[CSRF_TOKEN_KEY] = csrf_token_for_testing
         else:
             session[CSRF_TOKEN_KEY] = str(uuid.uuid4())
-    return session[CSRF_TOKEN_KEY]
+    return mask_csrf_token(session[CSRF_TOKEN_KEY])
 
 def validate_csrf_token(req):
-    """Validates CSRF token.
+    """Validates CSRF token. Both masked and unmasked tokens are valid.
 
     Args:
         req (flask.request): flask.request object.
@@ -53,7 +110,10 @@ def validate_csrf_token(req):
 
     if CSRF_TOKEN_KEY not in req.form or CSRF_TOKEN_KEY not in session:
         return False
-    if req.form[CSRF_TOKEN_KEY] != session[CSRF_TOKEN_KEY]:
-        return False
-    return True
+    expected = session[CSRF_TOKEN_KEY].encode('utf-8')
+    token = req.form[CSRF_TOKEN_KEY]
+    if hmac.compare_digest(token.encode('utf-8'), expected):
+        return True
+    unmasked = unmask_csrf_token(token)
+    return unmasked is not None and hmac.compare_digest(unmasked.encode('utf-8'), expected)
 
@@ -0,0 +1,252 @@
+"""JSON API version 1.
+
+All routes are under '/api/v1/'. List routes support keyset pagination
+by 'after' and 'limit', and every route supports sparse fieldsets by
+'fields' (comma separated). List responses are serialized while rows
+are fetched, so large pages are not materialized in memory.
+"""
+
+import json
+from flask import Blueprint, Response, current_app, jsonify, request, stream_with_context, url_for
+from sqlalchemy.orm import joinedload, selectinload
+from web import metrics
+from web.exceptions.zen_http_exception import ZenHttpException
+from web.models.issue import Issue
+from web.models.comment import Comment
+from web.models.state import State
+from web.models.attached_file import AttachedFile
+
+api = Blueprint('api_v1', __name__, url_prefix='/api/v1')
+
+def _format_datetime(value):
+    return value.isoformat() + 'Z' if value is not None else None
+
+def _get_state_name(issue):
+    # states added by other processes are not cached until the next version check.
+    state = State.get(issue.state_id) or issue.state
+    return state.name
+
+def _serialize(obj, fields):
+    return dict((name, serializer(obj)) for (name, serializer) in fields)
+
+ATTACHED_FILE_FIELDS = {
+    'id': lambda attached_file: attached_file.id,
+    'comment_id': lambda attached_file: attached_file.comment_id,
+    'name': lambda attached_file: attached_file.name,
+    'size': lambda attached_file: attached_file.get_size(),
+    'sha256': lambda attached_file: attached_file.sha256,
+    'download_url': lambda attached_file: url_for('download', attached_file_id=attached_file.id),
+}
+
+ISSUE_FIELDS = {
+    'id': lambda issue: issue.id,
+    'subject': lambda issue: issue.subject,
+    'state_id': lambda issue: issue.state_id,
+    'state': _get_state_name,
+    'comment_count': lambda issue: issue.comment_count,
+    'last_comment_at': lambda issue: _format_datetime(issue.last_comment_at),
+    'updated_at': lambda issue: _format_datetime(issue.updated_at),
+    'version': lambda issue: issue.version,
+}
+
+COMMENT_FIELDS = {
+    'id': lambda comment: comment.id,
+    'issue_id': lambda comment: comment.issue_id,
+    'user_id': lambda comment: comment.user_id,
+    'user_name': lambda comment: comment.user.name,
+    'pub_date': lambda comment: _format_datetime(comment.pub_date),
+    'body': lambda comment: comment.body,
+    'attached_files': lambda comment: [
+        _serialize(f, ATTACHED_FILE_FIELDS.items()) for f in comment.attached_file_list],
+}
+
+STATE_FIELDS = {
+    'id': lambda state: state.id,
+    'name': lambda state: state.name,
+    'value': lambda state: state.value,
+}
+
+def _get_fields(req, available):
+    """Returns serializers of fields specified by query parameter 'fields'.
+    All fields if not specified.
+
+    Args:
+        req (flask.request): flask.request object.
+        available (dict): field name -> serializer.
+
+    Returns:
+        A list of tuple (name, serializer).
+    """
+
+    if not req.args.get('fields'):
+        return list(available.items())
+
+    names = req.args['fields'].split(',')
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        raise ZenHttpException(400, "unknown fields '{}'".format(','.join(unknown)))
+    return [(name, available[name]) for name in names]
+
+def _get_limit(req):
+    """Returns page size from query parameter 'limit'.
+
+    Args:
+        req (flask.request): flask.request object.
+    """
+
+    default = current_app.config.get('API_PAGE_LIMIT', 100)
+    maximum = current_app.config.get('API_MAX_PAGE_LIMIT', 1000)
+    limit = req.args.get('limit', default, type=int)
+    if limit < 1:
+        raise ZenHttpException(400, "'limit' must be positive")
+    return min(limit, maximum)
+
+def _get_ids(req):
+    """Returns ids specified by query parameter 'ids'. None if not specified.
+
+    Args:
+        req (flask.request): flask.request object.
+    """
+
+    if not req.args.get('ids'):
+        return None
+    try:
+        ids = [int(id) for id in req.args['ids'].split(',')]
+    except ValueError:
+        raise ZenHttpException(400, "'ids' must be comma separated integers")
+    if len(ids) > current_app.config.get('API_MAX_PAGE_LIMIT', 1000):
+        raise ZenHttpException(400, "too many 'ids'")
+    return ids
+
+def _stream_items(rows, fields, limit):
+    """Yields JSON of items and the cursor of next page.
+
+    Args:
+        rows (iterable): models to serialize.
+        fields (list): fields returned by '_get_fields()'.
+        limit (int): page size. None if not paginated.
+    """
+
+    yield '{"items": ['
+    count = 0
+    last_id = None
+    for row in rows:
+        if count > 0:
+            yield ', '
+        yield json.dumps(_serialize(row, fields))
+        count += 1
+        last_id = row.id
+    yield ']'
+    if limit is not None:
+        next_after = last_id if count == limit else None
+        yield ', "next_after": {}'.format(json.dumps(next_after))
+    yield '}'
+
+def _create_stream_response(rows, fields, limit=None):
+    return Response(stream_with_context(_stream_items(rows, fields, limit)),
+            mimetype='application/json')
+
+def _handle_exception(err):
+    """Returns JSON error response.
+
+    Args:
+        err (Exception): raised exception.
+    """
+
+    if type(err) is ZenHttpException:
+        status = err.status
+        message = err.message
+    else:
+        current_app.logger.exception(err)
+        metrics.count_exception()
+        status = 500
+        message = None
+    res = jsonify(error={'status': status, 'message': message})
+    res.status_code = status
+    return res
+
+# GET /api/v1/issues?after=1&limit=100
+# GET /api/v1/issues?ids=1,2,3
+@api.route('/issues/', methods=['GET'])
+def get_issues():
+    """Returns issues ordered by id."""
+
+    try:
+        fields = _get_fields(request, ISSUE_FIELDS)
+        ids = _get_ids(request)
+        if ids is not None:
+            rows = Issue.query.filter(Issue.id.in_(ids)).order_by(Issue.id.asc())
+            return _create_stream_response(rows.yield_per(100), fields)
+
+        limit = _get_limit(request)
+        query = Issue.query
+        after_id = request.args.get('after', type=int)
+        if after_id is not None:
+            query = query.filter(Issue.id > after_id)
+        rows = query.order_by(Issue.id.asc()).limit(limit)
+        return _create_stream_response(rows.yield_per(100), fields, limit)
+    except Exception as err:
+        return _handle_exception(err)
+
+# GET /api/v1/issues/1
+@api.route('/issues/<int:id>/', methods=['GET'])
+def get_issue(id):
+    """Returns an issue."""
+
+    try:
+        fields = _get_fields(request, ISSUE_FIELDS)
+        issue = Issue.get(id)
+        if issue is None:
+            raise ZenHttpException(404, 'issue not found')
+        return jsonify(_serialize(issue, fields))
+    except Exception as err:
+        return _handle_exception(err)
+
+# GET /api/v1/issues/1/comments?after=1&limit=100
+@api.route('/issues/<int:id>/comments/', methods=['GET'])
+def get_comments(id):
+    """Returns comments of an issue ordered by id."""
+
+    try:
+        fields = _get_fields(request, COMMENT_FIELDS)
+        limit = _get_limit(request)
+        if Issue.get(id) is None:
+            raise ZenHttpException(404, 'issue not found')
+
+        query = Comment.query.filter(Comment.issue_id == id)
+        after_id = request.args.get('after', type=int)
+        if after_id is not None:
+            query = query.filter(Comment.id > after_id)
+        rows = query \
+            .options(joinedload(Comment.user), selectinload(Comment.attached_file_list)) \
+            .order_by(Comment.id.asc()) \
+            .limit(limit) \
+            .all()
+        return _create_stream_response(rows, fields, limit)
+    except Exception as err:
+        return _handle_exception(err)
+
+# GET /api/v1/states
+@api.route('/states/', methods=['GET'])
+def get_states():
+    """Returns all states ordered by value."""
+
+    try:
+        fields = _get_fields(request, STATE_FIELDS)
+        return _create_stream_response(State.all(), fields)
+    except Exception as err:
+        return _handle_exception(err)
+
+# GET /api/v1/attachments/1
+@api.route('/attachments/<int:id>/', methods=['GET'])
+def get_attached_file(id):
+    """Returns metadata of an attached file."""
+
+    try:
+        fields = _get_fields(request, ATTACHED_FILE_FIELDS)
+        attached_file = AttachedFile.get(id)
+        if attached_file is None:
+            raise ZenHttpException(404, 'attached file not found')
+        return jsonify(_serialize(attached_file, fields))
+    except Exception as err:
+        return _handle_exception(err)
@@ -0,0 +1,220 @@
+"""Compression of attached files and responses.
+
+Codecs are named after HTTP content codings, so compressed data can be
+sent to clients as is with 'Content-Encoding'.
+
+Attached files:
+
+    'identity'  not compressed.
+    'deflate'   zlib format (RFC 1950). always available.
+    'zstd'      Zstandard. available if 'zstandard' package is installed.
+
+Responses and static files:
+
+    'gzip'      always available.
+    'br'        Brotli. available if 'brotli' package is installed.
+"""
+
+import gzip
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+IDENTITY = 'identity'
+DEFLATE = 'deflate'
+ZSTD = 'zstd'
+GZIP = 'gzip'
+BROTLI = 'br'
+
+# compression levels of data and of probes.
+_LEVELS = {DEFLATE: (6, 1), ZSTD: (3, 1)}
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+def get_available_codecs():
+    """Returns names of codecs which can be used in this environment."""
+
+    ret = [IDENTITY, DEFLATE]
+    if zstandard is not None:
+        ret.append(ZSTD)
+    return ret
+
+def get_preferred_codec(setting):
+    """Returns codec to compress attached files.
+
+    Args:
+        setting (string): 'ATTACHMENT_COMPRESSION' in config.
+            'auto', 'zstd', 'deflate' or 'none'. 'auto' and 'zstd'
+            fall back to 'deflate' if 'zstd' is not available.
+    """
+
+    if setting in (None, 'none', IDENTITY):
+        return IDENTITY
+    if setting in ('auto', ZSTD):
+        return ZSTD if zstandard is not None else DEFLATE
+    if setting == DEFLATE:
+        return DEFLATE
+    raise ValueError("unknown compression '{}'".format(setting))
+
+class _IdentityCompressor(object):
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+def create_compressor(codec, probe=False):
+    """Creates a compressor of codec.
+
+    Args:
+        codec (string): codec name.
+        probe (bool): if True, uses a fast level for probes.
+
+    Returns:
+        An object which has 'compress(data)' and 'flush()'.
+    """
+
+    if codec == IDENTITY:
+        return _IdentityCompressor()
+    level = _LEVELS[codec][1 if probe else 0]
+    if codec == DEFLATE:
+        return zlib.compressobj(level)
+    if codec == ZSTD and zstandard is not None:
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    raise ValueError("codec '{}' is not available".format(codec))
+
+def compress(codec, data):
+    """Returns compressed data.
+
+    Args:
+        codec (string): codec name.
+        data (bytes): data to compress.
+    """
+
+    compressor = create_compressor(codec)
+    return compressor.compress(data) + compressor.flush()
+
+def choose_codec(sample, codec, min_size, max_ratio):
+    """Chooses codec of data by compressing a sample of it.
+
+    Args:
+        sample (bytes): the first bytes of data.
+        codec (string): preferred codec.
+        min_size (int): data smaller than this is not compressed.
+        max_ratio (float): data is compressed only if sample is
+            compressed to this ratio or less.
+
+    Returns:
+        'codec' or 'identity'.
+    """
+
+    if codec == IDENTITY or len(sample) < min_size:
+        return IDENTITY
+    compressor = create_compressor(codec, probe=True)
+    size = len(compressor.compress(sample)) + len(compressor.flush())
+    return codec if size <= len(sample) * max_ratio else IDENTITY
+
+def get_response_codecs():
+    """Returns codecs of responses in order of preference."""
+
+    return [BROTLI, GZIP] if brotli is not None else [GZIP]
+
+def compress_response(codec, data, best=False):
+    """Returns compressed response body.
+
+    Args:
+        codec (string): 'gzip' or 'br'.
+        data (bytes): data to compress.
+        best (bool): if True, compresses as small as possible. slow,
+            so used only for static files compressed in advance.
+    """
+
+    if codec == GZIP:
+        # no modification time, so the same data is compressed to the same bytes.
+        return gzip.compress(data, 9 if best else 6, mtime=0)
+    if codec == BROTLI and brotli is not None:
+        return brotli.compress(data, quality=11 if best else 5)
+    raise ValueError("codec '{}' is not available".format(codec))
+
+class _DeflateReader(object):
+    """Decompresses zlib stream. Output of a read is bounded by its size."""
+
+    def __init__(self, raw, chunk_size):
+        self._raw = raw
+        self._chunk_size = chunk_size
+        self._decompressor = zlib.decompressobj()
+
+    def read(self, size):
+        while True:
+            data = self._decompressor.unconsumed_tail
+            if not data:
+                if self._decompressor.eof:
+                    return b''
+                data = self._raw.read(self._chunk_size)
+                if not data:
+                    raise zlib.error('compressed data is truncated')
+            ret = self._decompressor.decompress(data, size)
+            if ret:
+                return ret
+
+class DecodingReader(object):
+    """Reads decompressed data from a compressed stream.
+
+    'seek()' decompresses data from the start to the offset,
+    so it costs as much as reading the skipped data.
+    """
+
+    def __init__(self, open_raw, codec, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Creates a instance of this class.
+
+        Args:
+            open_raw (function): opens compressed stream. called again
+                to seek backward.
+            codec (string): codec of the stream.
+            chunk_size (int): max size of a chunk to read from the stream.
+        """
+
+        self._open_raw = open_raw
+        self._codec = codec
+        self._chunk_size = chunk_size
+        self._raw = None
+        self._reader = None
+        self._offset = 0
+        self._open()
+
+    def _open(self):
+        self._raw = self._open_raw()
+        self._offset = 0
+        if self._codec == DEFLATE:
+            self._reader = _DeflateReader(self._raw, self._chunk_size)
+        elif self._codec == ZSTD and zstandard is not None:
+            self._reader = zstandard.ZstdDecompressor().stream_reader(self._raw, self._chunk_size)
+        else:
+            self._raw.close()
+            raise ValueError("codec '{}' is not available".format(self._codec))
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(self._chunk_size), b''))
+        ret = self._reader.read(size)
+        self._offset += len(ret)
+        return ret
+
+    def seek(self, offset):
+        if offset < self._offset:
+            self.close()
+            self._open()
+        while self._offset < offset:
+            if not self.read(min(self._chunk_size, offset - self._offset)):
+                break
+
+    def close(self):
+        self._raw.close()
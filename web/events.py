@@ -0,0 +1,262 @@
+"""Server of issue events.
+
+Streams events written by 'Comment.add()' and 'Issue.add()' as
+Server-Sent Events. Runs on asyncio apart from the WSGI application,
+so idle subscribers do not occupy worker threads.
+
+    GET /events        events of all issues.
+    GET /<id>/events   events of an issue.
+
+One task polls 'issue_event' table and passes new events to
+subscribers. Clients resume from 'Last-Event-ID' after reconnecting.
+
+To run: $ python -m web.events --port 5001
+Route '/events' and '/<id>/events' to this server in front of Zenmai,
+and set 'EVENTS_URL' in config to show live updates on pages.
+"""
+
+import asyncio
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+_PATH = re.compile(r'^/(?:(\d+)/)?events/?$')
+
+class _Subscriber(object):
+    """A connected client."""
+
+    def __init__(self, issue_id, queue_size):
+        self.issue_id = issue_id
+        self.queue = asyncio.Queue(queue_size)
+        self.overflowed = False
+
+    def accepts(self, event):
+        return self.issue_id is None or self.issue_id == event['issue_id']
+
+class EventBroker(object):
+    """Polls events from database and passes them to subscribers.
+
+    Database is accessed in worker threads, not to block event loop.
+    """
+
+    def __init__(self, app):
+        """Creates a instance of this class.
+
+        Args:
+            app (flask.Flask): application.
+        """
+
+        config = app.config
+        self.app = app
+        self.poll_interval = config.get('EVENTS_POLL_INTERVAL', 0.5)
+        self.heartbeat_interval = config.get('EVENTS_HEARTBEAT_INTERVAL', 15)
+        self.max_subscribers = config.get('EVENTS_MAX_SUBSCRIBERS', 10000)
+        self.queue_size = config.get('EVENTS_QUEUE_SIZE', 100)
+        self.replay_limit = config.get('EVENTS_REPLAY_LIMIT', 100)
+        self.allow_origin = config.get('EVENTS_ALLOW_ORIGIN')
+        self.last_id = None
+        self._subscribers = set()
+        self._executor = ThreadPoolExecutor(config.get('EVENTS_DB_WORKERS', 2))
+
+    def _call_in_app_context(self, function, *args):
+        with self.app.app_context():
+            return function(*args)
+
+    async def _run_db(self, function, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, self._call_in_app_context, function, *args)
+
+    @staticmethod
+    def _fetch(after_id, limit, issue_id=None):
+        from web.models.issue_event import IssueEvent
+
+        return [e.to_dict() for e in IssueEvent.fetch_after(after_id, limit, issue_id)]
+
+    @staticmethod
+    def _get_last_id():
+        from web.models.issue_event import IssueEvent
+
+        return IssueEvent.get_last_id()
+
+    def get_subscriber_count(self):
+        """Returns number of connected clients."""
+
+        return len(self._subscribers)
+
+    def publish(self, event):
+        """Passes an event to subscribers.
+
+        Subscribers which do not read events fast enough are marked as
+        overflowed and disconnected. They can resume by 'Last-Event-ID'.
+
+        Args:
+            event (dict): event.
+        """
+
+        for subscriber in list(self._subscribers):
+            if not subscriber.accepts(event):
+                continue
+            try:
+                subscriber.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                subscriber.overflowed = True
+
+    async def poll(self):
+        """Polls new events forever.
+
+        Errors of database, e.g. locked database, are logged and
+        retried in the next poll.
+        """
+
+        while True:
+            try:
+                if self.last_id is None:
+                    self.last_id = await self._run_db(self._get_last_id)
+                await asyncio.sleep(self.poll_interval)
+                events = await self._run_db(self._fetch, self.last_id, self.queue_size)
+            except Exception:
+                self.app.logger.exception('failed to poll events.')
+                await asyncio.sleep(self.poll_interval)
+                continue
+            for event in events:
+                self.last_id = event['id']
+                self.publish(event)
+
+    async def handle(self, reader, writer):
+        """Handles a HTTP connection.
+
+        Args:
+            reader (asyncio.StreamReader): reader of the connection.
+            writer (asyncio.StreamWriter): writer of the connection.
+        """
+
+        subscriber = None
+        try:
+            (method, path, headers) = await asyncio.wait_for(_read_request(reader), 10)
+            match = _PATH.match(path.split('?', 1)[0])
+            if method != 'GET':
+                return await _write_error(writer, '405 Method Not Allowed')
+            if match is None:
+                return await _write_error(writer, '404 Not Found')
+            if len(self._subscribers) >= self.max_subscribers:
+                return await _write_error(writer, '503 Service Unavailable')
+
+            issue_id = int(match.group(1)) if match.group(1) else None
+            subscriber = _Subscriber(issue_id, self.queue_size)
+            # subscribe before replay, so no events are lost between them.
+            self._subscribers.add(subscriber)
+
+            response = ['HTTP/1.1 200 OK',
+                        'Content-Type: text/event-stream; charset=utf-8',
+                        'Cache-Control: no-cache',
+                        'Connection: keep-alive',
+                        'X-Accel-Buffering: no']
+            if self.allow_origin:
+                response.append('Access-Control-Allow-Origin: ' + self.allow_origin)
+            writer.write(('\r\n'.join(response) + '\r\n\r\nretry: 3000\n\n').encode('ascii'))
+
+            sent_id = 0
+            last_event_id = headers.get('last-event-id', '')
+            if last_event_id.isdigit():
+                for event in await self._run_db(self._fetch, int(last_event_id), self.replay_limit, issue_id):
+                    writer.write(_format_event(event))
+                    sent_id = event['id']
+            await writer.drain()
+
+            # clients send nothing more. EOF means closed.
+            closed = asyncio.ensure_future(reader.read())
+            try:
+                while not subscriber.overflowed:
+                    get = asyncio.ensure_future(subscriber.queue.get())
+                    (done, _) = await asyncio.wait([get, closed], timeout=self.heartbeat_interval,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                    if closed in done:
+                        get.cancel()
+                        break
+                    if get not in done:
+                        # detects connections lost without EOF.
+                        get.cancel()
+                        writer.write(b': heartbeat\n\n')
+                    elif get.result()['id'] > sent_id:
+                        writer.write(_format_event(get.result()))
+                        sent_id = get.result()['id']
+                    await writer.drain()
+            finally:
+                closed.cancel()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                asyncio.TimeoutError, ValueError):
+            pass
+        finally:
+            self._subscribers.discard(subscriber)
+            writer.close()
+
+async def _read_request(reader):
+    """Reads request line and headers.
+
+    Returns:
+        (method, path, headers). Names of headers are lower case.
+    """
+
+    (method, path, _) = (await reader.readuntil(b'\r\n')).decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = (await reader.readuntil(b'\r\n')).decode('latin-1').strip()
+        if not line:
+            return (method, path, headers)
+        (name, value) = line.split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+
+async def _write_error(writer, status):
+    writer.write('HTTP/1.1 {}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'.format(status).encode('ascii'))
+    await writer.drain()
+
+def _format_event(event):
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+            event['id'], event['type'], json.dumps(event)).encode('utf-8')
+
+async def start(app, host, port):
+    """Starts event server.
+
+    Args:
+        app (flask.Flask): application.
+        host (string): address to listen.
+        port (int): port to listen. 0 for any free port.
+
+    Returns:
+        (asyncio.Server, EventBroker, polling task).
+    """
+
+    broker = EventBroker(app)
+    server = await asyncio.start_server(broker.handle, host, port)
+    task = asyncio.ensure_future(broker.poll())
+    return (server, broker, task)
+
+def main(argv):
+    """Runs event server until interrupted."""
+
+    import argparse
+    from web import create_app
+
+    parser = argparse.ArgumentParser(prog='python -m web.events', description='Event server of Zenmai.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5001)
+    args = parser.parse_args(argv)
+
+    app = create_app()
+    with app.app_context():
+        import web.models.issue
+        import web.models.issue_event
+
+    async def serve():
+        (server, _, task) = await start(app, args.host, args.port)
+        async with server:
+            await asyncio.gather(server.serve_forever(), task)
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    import sys
+    main(sys.argv[1:])
@@ -1,12 +1,15 @@
 class ZenHttpException(Exception):
     """Exception with HTTP status code."""
 
-    def __init__(self, status):
+    def __init__(self, status, message=None):
         """Creates an instance.
 
         Args:
             status (int): HTTP status code.
+            message (string): description of the error.
         """
 
+        super().__init__(status, message)
         self.status = status
+        self.message = message
 
@@ -3,6 +3,7 @@
 from werkzeug.utils import secure_filename
 from flask import session
 from web import AUTH_USER_ID_KEY
+from web.exceptions.zen_http_exception import ZenHttpException
 from web.models.comment import Comment
 from web.models.attached_file import AttachedFile
 from web.models.user import User
@@ -45,7 +46,7 @@ def create_new_comment(req, issue, user):
         body = None
 
     attached_files = [
-            AttachedFile(None, secure_filename(v.filename), v.read())
+            AttachedFile(None, secure_filename(v.filename), v.stream)
             for k, v in req.files.items()
             if v.filename]
     if len(attached_files) < 1:
@@ -71,11 +72,19 @@ def do_login(req):
 
     user = User.get(user_id)
     if user is None:
-        return False
+        return User.authenticate_unknown(password)
 
     authenticated = user.authenticate(password)
 
     if authenticated:
+        if user.needs_rehash():
+            try:
+                user.change_password(password)
+                user.save()
+            except ZenHttpException as err:
+                # hasher is saturated. rehashed on next login.
+                if err.status != 503:
+                    raise
         session[AUTH_USER_ID_KEY] = user_id
 
     return authenticated
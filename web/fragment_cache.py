@@ -0,0 +1,185 @@
+"""Cache of rendered template fragments.
+
+A fragment is identified by a key like 'issue:1:header' and cached
+with the version of data it is rendered from. A cached fragment of
+other version is treated as a miss, and model write paths delete
+fragments of changed issues by 'invalidate_issue()'.
+
+Hits, misses and evictions are counted in 'metrics', so '/stats/' and
+'/metrics' report the same numbers.
+
+In templates:
+
+    {% call cached_fragment('issue', issue.id, 'header', issue.version) %}
+        ...
+    {% endcall %}
+"""
+
+import threading
+from collections import OrderedDict
+from flask import current_app
+from markupsafe import Markup
+from . import metrics
+
+ISSUE_FRAGMENTS = ['header', 'comments', 'row']
+
+_backend = None
+_backend_lock = threading.Lock()
+
+class CacheBackend(object):
+    """Base of fragment cache backends. Caches nothing by itself,
+    so used as is if 'FRAGMENT_CACHE_BACKEND' is 'none'.
+
+    Keys and values are strings.
+    """
+
+    def get(self, key):
+        """Returns a cached value. None if not cached."""
+
+        return None
+
+    def set(self, key, value):
+        """Caches a value."""
+
+        pass
+
+    def delete(self, key):
+        """Deletes a cached value."""
+
+        pass
+
+    def get_size(self):
+        """Returns number of cached values."""
+
+        return 0
+
+class LRUBackend(CacheBackend):
+    """In-process LRU cache. Holds at most 'max_size' values."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            ret = self._values.get(key)
+            if ret is not None:
+                self._values.move_to_end(key)
+            return ret
+
+    def set(self, key, value):
+        with self._lock:
+            self._values[key] = value
+            self._values.move_to_end(key)
+            while len(self._values) > self.max_size:
+                self._values.popitem(last=False)
+                metrics.count('fragment_cache_evictions')
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+    def get_size(self):
+        with self._lock:
+            return len(self._values)
+
+class MemcachedBackend(CacheBackend):
+    """Cache on a memcached compatible server. Shared by processes.
+    Requires 'pymemcache'. Evictions are counted by the server, not in 'metrics'.
+    """
+
+    def __init__(self, server):
+        from pymemcache.client.base import PooledClient
+
+        (host, port) = server.rsplit(':', 1)
+        self._client = PooledClient((host, int(port)))
+
+    def get(self, key):
+        ret = self._client.get(key)
+        return ret.decode('utf-8') if ret is not None else None
+
+    def set(self, key, value):
+        self._client.set(key, value.encode('utf-8'), noreply=True)
+
+    def delete(self, key):
+        self._client.delete(key, noreply=True)
+
+    def get_size(self):
+        return int(self._client.stats().get(b'curr_items', 0))
+
+def get_backend():
+    """Returns backend of this process. Created on first call from config.
+
+    'FRAGMENT_CACHE_BACKEND' is 'lru' (default), 'memcached' or 'none'.
+    """
+
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            name = current_app.config.get('FRAGMENT_CACHE_BACKEND', 'lru')
+            if name == 'lru':
+                _backend = LRUBackend(current_app.config.get('FRAGMENT_CACHE_SIZE', 1024))
+            elif name == 'memcached':
+                _backend = MemcachedBackend(
+                        current_app.config.get('FRAGMENT_CACHE_SERVER', 'localhost:11211'))
+            elif name == 'none':
+                _backend = CacheBackend()
+            else:
+                raise ValueError("unknown FRAGMENT_CACHE_BACKEND '{}'".format(name))
+        return _backend
+
+def get_stats():
+    """Returns a dictionary of hits, misses and evictions of fragment
+    cache in this process, and number of cached fragments.
+    """
+
+    counters = metrics.get_counters()
+    ret = {key: counters.get('fragment_cache_' + key, 0) for key in ['hits', 'misses', 'evictions']}
+    ret['size'] = get_backend().get_size()
+    return ret
+
+def _get_key(kind, id, name):
+    return 'zenmai:{}:{}:{}'.format(kind, id, name)
+
+def cached_fragment(kind, id, name, version, caller):
+    """Returns a cached fragment, or renders and caches it.
+    Called from templates by '{% call %}'.
+
+    Args:
+        kind (string): kind of data. e.g. 'issue'.
+        id (int): id of data.
+        name (string): name of fragment.
+        version: version of data. fragments of other version are ignored.
+        caller (callable): renders the fragment.
+
+    Returns:
+        Markup of the fragment.
+    """
+
+    backend = get_backend()
+    key = _get_key(kind, id, name)
+    version = str(version)
+
+    value = backend.get(key)
+    if value is not None:
+        (cached_version, html) = value.split('\n', 1)
+        if cached_version == version:
+            metrics.count('fragment_cache_hits')
+            return Markup(html)
+
+    metrics.count('fragment_cache_misses')
+    html = caller()
+    backend.set(key, version + '\n' + html)
+    return Markup(html)
+
+def invalidate_issue(id):
+    """Deletes cached fragments of an issue.
+
+    Args:
+        id (int): issue id.
+    """
+
+    backend = get_backend()
+    for name in ISSUE_FRAGMENTS:
+        backend.delete(_get_key('issue', id, name))
@@ -0,0 +1,197 @@
+"""Helper functions for HTTP response."""
+
+import hashlib
+from flask import Response, current_app, session, stream_with_context
+from werkzeug.datastructures import ContentRange
+from web import AUTH_USER_ID_KEY, CSRF_TOKEN_KEY
+from web.compression import IDENTITY
+
+def _read_chunks(stream, start, stop, chunk_size):
+    """Yields data of stream[start:stop] in chunks, then closes the stream.
+
+    Args:
+        stream (file-like object): stream to read.
+        start (int): first byte position.
+        stop (int): last byte position (exclusive).
+        chunk_size (int): max size of a chunk.
+    """
+
+    try:
+        stream.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = stream.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        stream.close()
+
+def _set_stream(res, stream, start, stop, chunk_size):
+    """Sets stream[start:stop] to body of response.
+
+    The stream is closed at the end of data, and also with the response,
+    so it is closed even if the body is never read, e.g. for HEAD requests.
+    Streams must allow to be closed twice.
+
+    Args:
+        res (flask.Response): response to set body.
+        stream (file-like object): stream to read.
+        start (int): first byte position.
+        stop (int): last byte position (exclusive).
+        chunk_size (int): max size of a chunk.
+    """
+
+    # not 'direct_passthrough', which skips closing the response on GET.
+    res.call_on_close(stream.close)
+    res.response = stream_with_context(_read_chunks(stream, start, stop, chunk_size))
+    res.content_length = stop - start
+
+def _is_if_range_satisfied(req, etag):
+    """Returns True if 'If-Range' is absent or matches 'etag'.
+
+    Args:
+        req (flask.request): flask.request object.
+        etag (string): current entity tag.
+    """
+
+    if_range = req.if_range
+    if if_range.date is not None:
+        return False # attached files have no modification date.
+    return if_range.etag is None or if_range.etag == etag
+
+def accepts_encoding(req, codec):
+    """Returns True if client accepts 'codec' as content coding.
+
+    Args:
+        req (flask.request): flask.request object.
+        codec (string): codec name.
+    """
+
+    return any(value == codec and quality > 0 for (value, quality) in req.accept_encodings)
+
+def create_download_response(req, attached_file, chunk_size):
+    """Creates a response which streams an attached file.
+
+    Supports a single byte range ('Range' and 'If-Range')
+    and conditional requests ('If-None-Match').
+    Compressed data is sent as is with 'Content-Encoding' if client
+    accepts it and requests no range, otherwise it is decompressed.
+
+    Args:
+        req (flask.request): flask.request object.
+        attached_file (AttachedFile): attached file to download.
+        chunk_size (int): max size of a chunk to read from storage.
+
+    Returns:
+        flask.Response object.
+    """
+
+    size = attached_file.get_size()
+    etag = attached_file.get_etag()
+
+    codec = attached_file.get_codec()
+    res = Response(mimetype='application/octet-stream')
+    res.headers['Accept-Ranges'] = 'bytes'
+    res.headers.set('Content-Disposition', 'attachment', filename=attached_file.name)
+
+    if codec != IDENTITY:
+        res.vary.add('Accept-Encoding')
+        if req.range is None and accepts_encoding(req, codec):
+            # another representation needs another entity tag.
+            etag = '{}-{}'.format(etag, codec)
+            res.set_etag(etag)
+            if req.if_none_match.contains(etag):
+                res.status_code = 304
+                return res
+            res.content_encoding = codec
+            _set_stream(res, attached_file.open_stored(), 0, attached_file.get_stored_size(), chunk_size)
+            return res
+
+    res.set_etag(etag)
+    if req.if_none_match.contains(etag):
+        res.status_code = 304
+        return res
+
+    start, stop = 0, size
+    if req.range is not None and _is_if_range_satisfied(req, etag):
+        byte_range = req.range.range_for_length(size)
+        if byte_range is None:
+            res.status_code = 416
+            res.headers['Content-Range'] = 'bytes */{}'.format(size)
+            return res
+        start, stop = byte_range
+        res.status_code = 206
+        res.content_range = ContentRange('bytes', start, stop, size)
+
+    _set_stream(res, attached_file.open(), start, stop, chunk_size)
+    return res
+
+def create_page_etag(*parts):
+    """Creates entity tag of a rendered page.
+
+    Rendered pages also depend on the session (login user, CSRF token),
+    so a fingerprint of them is mixed with 'parts'.
+
+    Args:
+        parts: values which identify the version of page content.
+
+    Returns:
+        Entity tag string. None if the page must not be cached,
+        e.g. flashed messages are waiting to be rendered.
+    """
+
+    if '_flashes' in session:
+        return None
+
+    values = [current_app.config['version'],
+              session.get(AUTH_USER_ID_KEY),
+              session.get(CSRF_TOKEN_KEY)]
+    values.extend(parts)
+    source = '\n'.join(str(v) for v in values)
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+def is_not_modified(req, etag):
+    """Returns True if client's cached page matches 'etag'.
+
+    Only 'If-None-Match' is evaluated. 'If-Modified-Since' is not,
+    because pages vary by session while modification date does not.
+
+    Args:
+        req (flask.request): flask.request object.
+        etag (string): entity tag created by 'create_page_etag()'.
+    """
+
+    return etag is not None and req.if_none_match.contains_weak(etag)
+
+def set_page_validators(res, etag, last_modified):
+    """Sets validators of a rendered page to response.
+
+    Args:
+        res (flask.Response): response to modify.
+        etag (string): entity tag created by 'create_page_etag()'.
+        last_modified (datetime): modification date in UTC. may be None.
+
+    Returns:
+        'res'.
+    """
+
+    if etag is None:
+        return res
+    res.set_etag(etag, weak=True)
+    if last_modified is not None:
+        res.last_modified = last_modified
+    # cached only by browser, and always revalidated.
+    res.headers['Cache-Control'] = 'private, no-cache'
+    return res
+
+def create_not_modified_response(etag, last_modified):
+    """Creates '304 Not Modified' response.
+
+    Args:
+        etag (string): entity tag created by 'create_page_etag()'.
+        last_modified (datetime): modification date in UTC. may be None.
+    """
+
+    return set_page_validators(Response(status=304), etag, last_modified)
@@ -0,0 +1,264 @@
+"""Request metrics.
+
+Records latency, SQL query count and time, response size and errors
+per endpoint, and exports them in Prometheus text format. Other modules
+add their own counters by 'count()', e.g. hits of fragment cache.
+
+Each thread records to its own counters without locks. Counters of
+all threads are summed up only when they are exported. Counters of
+finished threads are folded into shared totals at that time, so
+thread-per-request servers do not accumulate them.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# upper bounds of latency histogram buckets in seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_local = threading.local()
+# (thread, counters of the thread).
+_all_thread_metrics = []
+_all_thread_metrics_lock = threading.Lock()
+
+class _EndpointMetrics(object):
+    """Counters of an endpoint and a method in a thread."""
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.seconds = 0.0
+        self.sql_queries = 0
+        self.sql_seconds = 0.0
+        self.response_bytes = 0
+        self.statuses = {}
+        self.exceptions = 0
+
+    def observe(self, seconds, status, size, sql_queries, sql_seconds):
+        self.buckets[bisect_left(BUCKETS, seconds)] += 1
+        self.seconds += seconds
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.response_bytes += size
+        self.sql_queries += sql_queries
+        self.sql_seconds += sql_seconds
+
+class _ThreadMetrics(object):
+    """Counters of a thread."""
+
+    def __init__(self):
+        # (endpoint, method) and '_EndpointMetrics'.
+        self.endpoints = {}
+        # name and value of counters added by 'count()'.
+        self.counters = {}
+
+# counters of finished threads.
+_finished_thread_metrics = _ThreadMetrics()
+
+def _get_thread_metrics():
+    """Returns counters of current thread. Registered on first call."""
+
+    metrics = getattr(_local, 'metrics', None)
+    if metrics is None:
+        metrics = _local.metrics = _ThreadMetrics()
+        _local.sql_queries = 0
+        _local.sql_seconds = 0.0
+        with _all_thread_metrics_lock:
+            _all_thread_metrics.append((threading.current_thread(), metrics))
+    return metrics
+
+def _get_endpoint_metrics():
+    key = (request.endpoint or 'none', request.method)
+    endpoints = _get_thread_metrics().endpoints
+    ret = endpoints.get(key)
+    if ret is None:
+        ret = endpoints[key] = _EndpointMetrics()
+    return ret
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stack = conn.info.get('metrics_started')
+    if not stack:
+        return
+    started = stack.pop()
+    if getattr(_local, 'metrics', None) is not None:
+        _local.sql_queries += 1
+        _local.sql_seconds += time.perf_counter() - started
+
+def _before_request():
+    _get_thread_metrics()
+    _local.sql_queries = 0
+    _local.sql_seconds = 0.0
+    g.metrics_started = time.perf_counter()
+
+def _after_request(response):
+    started = g.pop('metrics_started', None)
+    if started is not None:
+        # streamed responses have no length. their rest is not counted.
+        _get_endpoint_metrics().observe(
+                time.perf_counter() - started,
+                response.status_code,
+                response.content_length or 0,
+                _local.sql_queries,
+                _local.sql_seconds)
+    return response
+
+def init_app(app):
+    """Starts recording metrics of 'app'.
+
+    Call this before other 'before_request' functions are registered,
+    so requests rejected by them are also recorded.
+    Does nothing if 'METRICS_ENABLED' is False.
+
+    Args:
+        app (flask.Flask): application.
+    """
+
+    if not app.config.get('METRICS_ENABLED', True):
+        return
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+
+def count_exception():
+    """Counts an unexpected exception of current request."""
+
+    _get_endpoint_metrics().exceptions += 1
+
+def count(name, value=1):
+    """Adds to a counter which is not per endpoint.
+
+    Counted even if 'METRICS_ENABLED' is False.
+
+    Args:
+        name (string): name of counter. e.g. 'fragment_cache_hits'.
+        value (int): value to add.
+    """
+
+    counters = _get_thread_metrics().counters
+    counters[name] = counters.get(name, 0) + value
+
+def get_counters():
+    """Returns a dictionary of names and values of counters added by 'count()'."""
+
+    return _collect().counters
+
+def _merge(total, metrics):
+    """Adds counters of 'metrics' to 'total'.
+
+    Args:
+        total (_ThreadMetrics): counters to add to.
+        metrics (_ThreadMetrics): counters to add.
+    """
+
+    # other threads may add keys while iterating.
+    for (name, value) in list(metrics.counters.items()):
+        total.counters[name] = total.counters.get(name, 0) + value
+    for (key, m) in list(metrics.endpoints.items()):
+        t = total.endpoints.get(key)
+        if t is None:
+            t = total.endpoints[key] = _EndpointMetrics()
+        for i, count in enumerate(m.buckets):
+            t.buckets[i] += count
+        t.seconds += m.seconds
+        t.sql_queries += m.sql_queries
+        t.sql_seconds += m.sql_seconds
+        t.response_bytes += m.response_bytes
+        t.exceptions += m.exceptions
+        for (status, count) in list(m.statuses.items()):
+            t.statuses[status] = t.statuses.get(status, 0) + count
+
+def _collect():
+    """Sums up counters of all threads.
+
+    Counters of finished threads are moved to '_finished_thread_metrics'.
+
+    Returns:
+        A '_ThreadMetrics'.
+    """
+
+    with _all_thread_metrics_lock:
+        alive = []
+        for (thread, metrics) in _all_thread_metrics:
+            if thread.is_alive():
+                alive.append((thread, metrics))
+            else:
+                _merge(_finished_thread_metrics, metrics)
+        _all_thread_metrics[:] = alive
+        ret = _ThreadMetrics()
+        _merge(ret, _finished_thread_metrics)
+
+    for (_, metrics) in alive:
+        _merge(ret, metrics)
+    return ret
+
+def _format_labels(labels):
+    return ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                    for (k, v) in labels)
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def export(fragment_cache_size=None):
+    """Exports metrics in Prometheus text format.
+
+    Args:
+        fragment_cache_size (int): number of cached fragments.
+
+    Returns:
+        A string.
+    """
+
+    lines = []
+
+    def metric(name, type, help, samples):
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} {}'.format(name, type))
+        for (suffix, labels, value) in samples:
+            if labels:
+                lines.append('{}{}{{{}}} {}'.format(name, suffix, _format_labels(labels), _format_value(value)))
+            else:
+                lines.append('{}{} {}'.format(name, suffix, _format_value(value)))
+
+    total = _collect()
+    collected = sorted(total.endpoints.items())
+
+    def per_endpoint(attr):
+        return [('', [('endpoint', e), ('method', m)], getattr(v, attr)) for ((e, m), v) in collected]
+
+    metric('zenmai_http_requests_total', 'counter', 'Number of responses.',
+           [('', [('endpoint', e), ('method', m), ('status', s)], count)
+            for ((e, m), v) in collected for (s, count) in sorted(v.statuses.items())])
+
+    samples = []
+    for ((e, m), v) in collected:
+        count = 0
+        for (bound, n) in zip(BUCKETS + ('+Inf',), v.buckets):
+            count += n
+            samples.append(('_bucket', [('endpoint', e), ('method', m), ('le', bound)], count))
+        samples.append(('_sum', [('endpoint', e), ('method', m)], v.seconds))
+        samples.append(('_count', [('endpoint', e), ('method', m)], count))
+    metric('zenmai_http_request_duration_seconds', 'histogram', 'Time to create responses.', samples)
+
+    metric('zenmai_http_response_bytes_total', 'counter', 'Size of response bodies.',
+           per_endpoint('response_bytes'))
+    metric('zenmai_http_exceptions_total', 'counter', 'Number of unexpected exceptions.',
+           per_endpoint('exceptions'))
+    metric('zenmai_sql_queries_total', 'counter', 'Number of SQL statements.',
+           per_endpoint('sql_queries'))
+    metric('zenmai_sql_duration_seconds_total', 'counter', 'Time spent in SQL statements.',
+           per_endpoint('sql_seconds'))
+
+    for key in ['hits', 'misses', 'evictions']:
+        metric('zenmai_fragment_cache_{}_total'.format(key), 'counter', 'Fragment cache {}.'.format(key),
+               [('', [], total.counters.get('fragment_cache_' + key, 0))])
+    if fragment_cache_size is not None:
+        metric('zenmai_fragment_cache_size', 'gauge', 'Fragment cache size.', [('', [], fragment_cache_size)])
+
+    return '\n'.join(lines) + '\n'
@@ -1,12 +1,15 @@
 """Initializing 'models' module."""
 
 from flask import current_app, g
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+from .engine import ZenSQLAlchemy
 
 def get_db():
     """Creates a 'SQLAlchemy' instance.
 
     Creates a 'SQLAlchemy' instance and store it to 'flask.g.db'.
+    Its engines are tuned by 'SQLITE_*' and 'DB_*' settings. See 'engine.py'.
     Before this function is called, Flask's application context must be exist.
 
     Returns:
@@ -15,6 +18,27 @@ def get_db():
 
     if 'db' not in g:
         current_app.logger.debug('construct SQLAlchemy instance.')
-        db = SQLAlchemy(current_app)
+        db = ZenSQLAlchemy(current_app)
         g.db = db
     return g.db
+
+def detached_copy(instance):
+    """Creates a detached copy of a model instance.
+
+    Only column attributes are copied. The copy is not bound to any
+    session, so it can be kept across requests and attached to a
+    session by 'session.merge(copy, load=False)' without a query.
+
+    Args:
+        instance (db.Model): model instance to copy.
+
+    Returns:
+        a detached model instance.
+    """
+
+    mapper = inspect(instance).mapper
+    ret = mapper.class_manager.new_instance()
+    for attr in mapper.column_attrs:
+        setattr(ret, attr.key, getattr(instance, attr.key))
+    make_transient_to_detached(ret)
+    return ret
@@ -1,6 +1,12 @@
 """Attached file class definition."""
 
+import hashlib
+import io
+import sqlite3
+from flask import current_app
 from . import get_db
+from ..compression import IDENTITY, DecodingReader, choose_codec, compress, get_preferred_codec
+from ..storage import get_file_system_storage
 
 db = get_db()
 
@@ -11,20 +17,38 @@ class AttachedFile(db.Model):
     """
 
     id = db.Column(db.Integer, primary_key=True)
-    comment_id = db.Column(db.Integer, db.ForeignKey('comment.id'), nullable=False)
+    comment_id = db.Column(db.Integer, db.ForeignKey('comment.id'), nullable=False, index=True)
     name = db.Column(db.String(256), nullable=False)
-    data = db.Column(db.LargeBinary, nullable=False)
+    # empty if data is stored in file system.
+    data = db.deferred(db.Column(db.LargeBinary, nullable=False))
+    # 'database' or 'filesystem'.
+    storage = db.Column(db.String(16), nullable=False, server_default='database')
+    # of uncompressed data.
+    sha256 = db.Column(db.String(64))
+    size = db.Column(db.Integer)
+    # 'identity', 'deflate' or 'zstd'. see 'web/compression.py'.
+    codec = db.Column(db.String(16), nullable=False, server_default=IDENTITY)
+    # size of compressed data. None if not compressed.
+    stored_size = db.Column(db.Integer)
 
     def __init__(self, comment_id, name, data):
-        """Creates a instance of this class."""
+        """Creates a instance of this class.
+
+        'data' is stored to the storage specified by
+        'ATTACHMENT_STORAGE' in config. 'data' is bytes or a
+        file-like object, which is read in chunks.
+        Compressible data is compressed as 'ATTACHMENT_COMPRESSION'.
+        """
 
         self.comment_id = comment_id
         self.name = name
-        self.data = data
+        if isinstance(data, bytes):
+            data = io.BytesIO(data)
+        self.store(data)
 
     def __repr__(self):
         return 'id={}, comment_id={}, name = {}, data size={}'.format(
-                self.id, self.comment_id, self.name, len(self.data))
+                self.id, self.comment_id, self.name, self.get_size())
 
     @classmethod
     def get(cls, id):
@@ -36,3 +60,176 @@ class AttachedFile(db.Model):
         """
 
         return cls.query.get(id)
+
+    def store(self, stream):
+        """Stores data read from stream.
+
+        Codec is chosen by compressing the first
+        'ATTACHMENT_COMPRESSION_PROBE_SIZE' bytes of data.
+
+        Args:
+            self (AttachedFile): this instance.
+            stream (file-like object): data to store.
+        """
+
+        config = current_app.config
+        sample = stream.read(config.get('ATTACHMENT_COMPRESSION_PROBE_SIZE', 64 * 1024))
+        codec = choose_codec(sample,
+                             get_preferred_codec(config.get('ATTACHMENT_COMPRESSION', 'none')),
+                             config.get('ATTACHMENT_COMPRESSION_MIN_SIZE', 1024),
+                             config.get('ATTACHMENT_COMPRESSION_MAX_RATIO', 0.9))
+        stream = _PrefixedStream(sample, stream)
+
+        if config.get('ATTACHMENT_STORAGE', 'database') == 'filesystem':
+            (self.sha256, self.size, stored_size) = get_file_system_storage().save(
+                    stream, config.get('UPLOAD_CHUNK_SIZE', 64 * 1024), codec)
+            self.storage = 'filesystem'
+            self.data = b''
+        else:
+            # database storage needs whole data in a column.
+            data = stream.read()
+            self.sha256 = hashlib.sha256(data).hexdigest()
+            self.size = len(data)
+            self.data = compress(codec, data)
+            stored_size = len(self.data)
+            self.storage = 'database'
+        self.codec = codec
+        self.stored_size = stored_size if codec != IDENTITY else None
+
+    def move_to_file_system(self):
+        """Moves data from database to file system. Codec is not changed.
+        Changes are not committed.
+        """
+
+        if self.storage == 'filesystem':
+            return
+
+        stream = self.open()
+        try:
+            (self.sha256, self.size, stored_size) = get_file_system_storage().save(
+                    stream, codec=self.get_codec())
+        finally:
+            stream.close()
+        if self.get_codec() != IDENTITY:
+            self.stored_size = stored_size
+        self.storage = 'filesystem'
+        self.data = b''
+
+    def get_size(self):
+        """Returns size of data in bytes without loading it."""
+
+        if self.size is not None:
+            return self.size
+        return db.session.query(db.func.length(AttachedFile.data)) \
+            .filter(AttachedFile.id == self.id) \
+            .scalar()
+
+    def get_codec(self):
+        """Returns codec of stored data."""
+
+        return self.codec or IDENTITY
+
+    def get_stored_size(self):
+        """Returns size of stored data in bytes without loading it."""
+
+        if self.get_codec() == IDENTITY:
+            return self.get_size()
+        return self.stored_size
+
+    def get_etag(self):
+        """Returns entity tag of data. Attached files are never modified."""
+
+        if self.sha256 is not None:
+            return self.sha256
+        return 'af-{}-{}'.format(self.id, self.get_size())
+
+    def open(self):
+        """Opens data for reading in chunks. Compressed data is decompressed.
+
+        Returns:
+            A file-like object which has 'read()', 'seek()' and 'close()'.
+        """
+
+        if self.get_codec() == IDENTITY:
+            return self.open_stored()
+        return DecodingReader(self.open_stored, self.get_codec(),
+                              current_app.config.get('DOWNLOAD_CHUNK_SIZE', 64 * 1024))
+
+    def open_stored(self):
+        """Opens stored data for reading in chunks. Compressed data is not decompressed.
+
+        Returns:
+            A file-like object which has 'read()', 'seek()' and 'close()'.
+        """
+
+        if self.storage == 'filesystem':
+            return get_file_system_storage().open(self.sha256, self.get_codec())
+        if hasattr(sqlite3.Connection, 'blobopen') and db.engine.name == 'sqlite':
+            return _SQLiteBlobReader(self.id)
+        return _SubstrBlobReader(self.id)
+
+class _PrefixedStream(object):
+    """Reads 'prefix', then the rest of 'stream'."""
+
+    def __init__(self, prefix, stream):
+        self._prefix = prefix
+        self._stream = stream
+
+    def read(self, size=-1):
+        if not self._prefix:
+            return self._stream.read(size)
+        if size is None or size < 0:
+            ret = self._prefix + self._stream.read()
+            self._prefix = b''
+            return ret
+        ret = self._prefix[:size]
+        self._prefix = self._prefix[size:]
+        return ret
+
+class _SQLiteBlobReader(object):
+    """Reads data using SQLite incremental blob I/O."""
+
+    def __init__(self, id):
+        self._raw_connection = db.session.get_bind().raw_connection()
+        try:
+            self._blob = self._raw_connection.connection.blobopen(
+                    AttachedFile.__tablename__, 'data', id, readonly=True)
+        except Exception:
+            self._raw_connection.close()
+            raise
+
+    def read(self, size=-1):
+        return self._blob.read(size)
+
+    def seek(self, offset):
+        self._blob.seek(offset)
+
+    def close(self):
+        # downloads close streams at the end of data and again with the response.
+        if self._raw_connection is None:
+            return
+        self._blob.close()
+        self._raw_connection.close()
+        self._raw_connection = None
+
+class _SubstrBlobReader(object):
+    """Reads data by 'substr()' queries. Used if incremental blob I/O is not available."""
+
+    def __init__(self, id):
+        self._id = id
+        self._offset = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            column = db.func.substr(AttachedFile.data, self._offset + 1)
+        else:
+            column = db.func.substr(AttachedFile.data, self._offset + 1, size)
+        ret = db.session.query(column).filter(AttachedFile.id == self._id).scalar()
+        self._offset += len(ret)
+        return ret
+
+    def seek(self, offset):
+        self._offset = offset
+
+    def close(self):
+        pass
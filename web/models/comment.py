@@ -2,7 +2,9 @@
 
 from datetime import datetime
 from . import get_db
+from .. import fragment_cache
 from .attached_file import AttachedFile
+from .issue_event import IssueEvent
 from .user import User
 
 db = get_db()
@@ -14,12 +16,14 @@ class Comment(db.Model):
     """
 
     id = db.Column(db.Integer, primary_key=True)
-    issue_id = db.Column(db.Integer, db.ForeignKey('issue.id'), nullable=False)
-    user_id = db.Column(db.String(32), db.ForeignKey('user.id'), nullable=False)
+    issue_id = db.Column(db.Integer, db.ForeignKey('issue.id'), nullable=False, index=True)
+    user_id = db.Column(db.String(32), db.ForeignKey('user.id'), nullable=False, index=True)
     pub_date = db.Column(db.DateTime, nullable=False)
     body = db.Column(db.Text, nullable=False)
 
     attached_files = db.relationship('AttachedFile', lazy='dynamic')
+    # read-only, eager-loadable view of 'attached_files'. see 'Issue.get_detail()'.
+    attached_file_list = db.relationship('AttachedFile', viewonly=True, order_by='AttachedFile.id')
     user = db.relationship('User', uselist=False, foreign_keys=[user_id])
 
     def __init__(self, issue, user, body, pub_date=None, attached_files=None):
@@ -40,7 +44,30 @@ class Comment(db.Model):
                 self.id, self.issue_id, self.user.id, self.pub_date, self.attached_files.count())
 
     def add(self):
-        """Inserts this instance to database."""
+        """Inserts this instance to database.
+
+        Also updates denormalized counters and version of the issue,
+        numbers of issues per state, and writes events of this comment
+        and state change of the issue.
+        """
+
+        issue = self.issue
+        issue_id = issue.id if issue is not None else None
+        state_change = None
+        if issue_id is not None:
+            state_change = issue.get_state_change()
+            # evaluated in SQL so concurrent comments are not lost.
+            issue.comment_count = type(issue).comment_count + 1
+            if issue.last_comment_at is None or issue.last_comment_at < self.pub_date:
+                issue.last_comment_at = self.pub_date
+            issue.touch()
 
         db.session.add(self)
+        if issue_id is not None:
+            db.session.flush()
+            db.session.add(IssueEvent(issue_id, 'comment', comment_id=self.id))
+            if state_change is not None:
+                issue.apply_state_change(state_change)
         db.session.commit()
+        if issue_id is not None:
+            fragment_cache.invalidate_issue(issue_id)
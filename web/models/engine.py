@@ -0,0 +1,143 @@
+"""Database engine configuration.
+
+Tunes SQLite connections by the settings in 'zenmai.config.py',
+and routes queries of GET and HEAD requests to a read-only engine
+so that reading pages does not wait for writers.
+"""
+
+import threading
+from urllib.parse import quote
+from flask import has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import TextClause, UpdateBase
+
+READ_METHODS = ('GET', 'HEAD')
+
+def _is_file_database(sa_url):
+    return sa_url.drivername == 'sqlite' and sa_url.database not in (None, '', ':memory:')
+
+def _get_pragmas(config, read_only):
+    """Returns PRAGMA statements executed on connect.
+
+    Args:
+        config (flask.Config): application config.
+        read_only (bool): True if connection is read-only.
+
+    Returns:
+        A list of PRAGMA statements.
+    """
+
+    pragmas = []
+    if not read_only:
+        if config.get('SQLITE_JOURNAL_MODE'):
+            pragmas.append('PRAGMA journal_mode = {}'.format(config['SQLITE_JOURNAL_MODE']))
+        if config.get('SQLITE_SYNCHRONOUS'):
+            pragmas.append('PRAGMA synchronous = {}'.format(config['SQLITE_SYNCHRONOUS']))
+    for (key, pragma) in [('SQLITE_BUSY_TIMEOUT', 'busy_timeout'),
+                          ('SQLITE_MMAP_SIZE', 'mmap_size'),
+                          ('SQLITE_CACHE_SIZE', 'cache_size')]:
+        if config.get(key) is not None:
+            pragmas.append('PRAGMA {} = {:d}'.format(pragma, config[key]))
+    return pragmas
+
+def _listen_pragmas(engine, pragmas):
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma in pragmas:
+                cursor.execute(pragma)
+        finally:
+            cursor.close()
+
+    event.listen(engine, 'connect', on_connect)
+
+class RoutingSession(SignallingSession):
+    """Session which routes reads of GET and HEAD requests to read-only engine.
+
+    Flushes, INSERT/UPDATE/DELETE statements and textual SQL, which may
+    also write, always use the default engine.
+    Once the default engine is used in a transaction, the transaction keeps
+    using it to see its own changes.
+    """
+
+    def __init__(self, db, **options):
+        self._db = db
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing \
+                and not isinstance(clause, (UpdateBase, TextClause)) \
+                and has_request_context() \
+                and request.method in READ_METHODS \
+                and not self._uses_default_engine():
+            read_engine = self._db.get_read_engine()
+            if read_engine is not None:
+                return read_engine
+        return SignallingSession.get_bind(self, mapper, clause)
+
+    def _uses_default_engine(self):
+        transaction = self.transaction
+        return transaction is not None and self._db.engine in transaction._connections
+
+class ZenSQLAlchemy(SQLAlchemy):
+    """'SQLAlchemy' with tuned SQLite engines."""
+
+    def __init__(self, *args, **kwargs):
+        self._read_engine = None
+        self._read_engine_lock = threading.Lock()
+        SQLAlchemy.__init__(self, *args, **kwargs)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        if _is_file_database(sa_url):
+            options.setdefault('poolclass', QueuePool)
+            options.setdefault('pool_size', app.config.get('DB_POOL_SIZE', 5))
+            options.setdefault('max_overflow', app.config.get('DB_MAX_OVERFLOW', 10))
+            # pooled connections are shared by threads, one at a time.
+            options.setdefault('connect_args', {})['check_same_thread'] = False
+        return SQLAlchemy.apply_driver_hacks(self, app, sa_url, options)
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = SQLAlchemy.create_engine(self, sa_url, engine_opts)
+        if sa_url.drivername == 'sqlite':
+            _listen_pragmas(engine, _get_pragmas(self.get_app().config, False))
+        return engine
+
+    def get_read_engine(self):
+        """Returns read-only engine.
+
+        Read-only engine opens the same database file with 'mode=ro'.
+        It is created at the first call.
+
+        Returns:
+            An engine, or None if disabled by 'DB_READ_POOL_SIZE = 0'
+            or database is not a SQLite file.
+        """
+
+        if self._read_engine is None:
+            with self._read_engine_lock:
+                if self._read_engine is None:
+                    self._read_engine = self._create_read_engine() or False
+        return self._read_engine or None
+
+    def _create_read_engine(self):
+        config = self.get_app().config
+        pool_size = config.get('DB_READ_POOL_SIZE', 10)
+        sa_url = self.engine.url
+        if not pool_size or not _is_file_database(sa_url):
+            return None
+
+        # read-only connections cannot change journal mode, so let a writer do it first.
+        self.engine.connect().close()
+        engine = create_engine(
+                'sqlite:///file:{}?mode=ro&uri=true'.format(quote(sa_url.database)),
+                poolclass=QueuePool,
+                pool_size=pool_size,
+                max_overflow=config.get('DB_MAX_OVERFLOW', 10),
+                connect_args={'check_same_thread': False})
+        _listen_pragmas(engine, _get_pragmas(config, True))
+        return engine
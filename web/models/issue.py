@@ -1,10 +1,19 @@
 """Issue class definition."""
 
+from datetime import datetime
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload, selectinload
 from . import get_db
 from .comment import Comment
+from .issue_event import IssueEvent
+from .state import State
+from .version_stamp import VersionStamp
+from .. import fragment_cache
 
 db = get_db()
 
+VERSION_KEY = 'issues'
+
 class Issue(db.Model):
     """Issue class.
 
@@ -13,7 +22,16 @@ class Issue(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     subject = db.Column(db.String(256), nullable=False)
-    state_id = db.Column(db.Integer, db.ForeignKey('state.id'), nullable=False)
+    state_id = db.Column(db.Integer, db.ForeignKey('state.id'), nullable=False, index=True)
+
+    # denormalized from 'comment' table. maintained by 'add()' and 'Comment.add()'.
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    last_comment_at = db.Column(db.DateTime)
+
+    # taken from version stamp 'issues' on every change, so it is
+    # unique among all issues. used as entity tag.
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    updated_at = db.Column(db.DateTime)
 
     comments = db.relationship('Comment', backref='issue', lazy='dynamic')
     state = db.relationship('State', uselist=False, foreign_keys=[state_id])
@@ -29,12 +47,113 @@ class Issue(db.Model):
         return 'id={}, subject={}, state_id={}, comment length={}'.format(
                 self.id, self.subject, self.state_id, self.comments.count())
 
+    @classmethod
+    def get_list_version(cls):
+        """Returns version stamp which is bumped on any change of issues.
+        None if issues are never changed.
+
+        Args:
+            cls (Issue): this class.
+        """
+
+        return VersionStamp.get(VERSION_KEY)
+
+    def touch(self):
+        """Updates version and modification date. Changes are not committed."""
+
+        self.version = VersionStamp.bump(VERSION_KEY)
+        self.updated_at = datetime.utcnow()
+
+    def get_state_change(self):
+        """Returns (old state id, new state id) if state of this stored
+        issue is changed and not flushed yet. Otherwise None.
+        """
+
+        if self.id is None:
+            return None
+        history = inspect(self).attrs.state_id.history
+        if not history.added or not history.deleted:
+            return None
+        # states from forms are strings.
+        (old, new) = (int(history.deleted[0]), int(history.added[0]))
+        return (old, new) if old != new else None
+
+    def apply_state_change(self, state_change):
+        """Updates numbers of issues per state and writes an event.
+        Changes are not committed.
+
+        Args:
+            state_change (tuple): returned by 'get_state_change()' before flush.
+        """
+
+        (old, new) = state_change
+        State.adjust_issue_count(old, -1)
+        State.adjust_issue_count(new, 1)
+        db.session.add(IssueEvent(self.id, 'state', state_id=new))
+
     @classmethod
     def all(cls):
         """Returns all issues."""
 
         return cls.query.all()
 
+    @classmethod
+    def page(cls, after_id=None, limit=50, before_id=None, state_id=None):
+        """Returns a page of issues. Ordered by 'id'.
+
+        Uses keyset pagination (WHERE id > cursor LIMIT n) instead of
+        OFFSET, so the cost of a page does not depend on its position.
+        Issues of a state are read by index on 'state_id', whose entries
+        are ordered by 'id' in each state.
+
+        Args:
+            cls (Issue): this class.
+            after_id (int): returns issues whose id is greater than this.
+            limit (int): max number of issues.
+            before_id (int): returns issues whose id is less than this.
+                Ignored if 'after_id' is specified.
+            state_id (int): returns only issues of this state if specified.
+
+        Returns:
+            A tuple (issues, has_previous, has_next).
+        """
+
+        base = cls.query
+        if state_id is not None:
+            base = base.filter(cls.state_id == state_id)
+
+        if after_id is None and before_id is not None:
+            # fetch backward and reverse.
+            rows = base \
+                .filter(cls.id < before_id) \
+                .order_by(cls.id.desc()) \
+                .limit(limit + 1) \
+                .all()
+            has_previous = len(rows) > limit
+            issues = list(reversed(rows[:limit]))
+            has_next = cls._exists(base.filter(cls.id >= before_id))
+            return (issues, has_previous, has_next)
+
+        query = base
+        if after_id is not None:
+            query = query.filter(cls.id > after_id)
+        rows = query.order_by(cls.id.asc()).limit(limit + 1).all()
+        has_next = len(rows) > limit
+        issues = rows[:limit]
+        has_previous = after_id is not None and cls._exists(base.filter(cls.id <= after_id))
+        return (issues, has_previous, has_next)
+
+    @classmethod
+    def _exists(cls, query):
+        """Returns True if 'query' matches any issue.
+
+        Args:
+            cls (Issue): this class.
+            query: query of issues.
+        """
+
+        return db.session.query(query.exists()).scalar()
+
     @classmethod
     def get(cls, id):
         """Returns an issue of specified id.
@@ -46,8 +165,97 @@ class Issue(db.Model):
 
         return cls.query.get(id)
 
+    @classmethod
+    def get_detail(cls, id):
+        """Returns an issue of specified id and its comments.
+
+        Comments, their users and metadata of their attached files
+        are loaded in a fixed number of queries regardless of the
+        number of comments. Contents of attached files are not loaded.
+
+        Args:
+            cls (Issue): this class.
+            id (int): issue id.
+
+        Returns:
+            A tuple (issue, comments). 'issue' is None if not found.
+        """
+
+        issue = cls.query.options(joinedload(cls.state)).get(id)
+        if issue is None:
+            return (None, [])
+        return (issue, cls.get_comments(id))
+
+    @classmethod
+    def get_comments(cls, id, after_id=None, before_id=None, limit=None, last=False):
+        """Returns comments of an issue with their users and
+        metadata of their attached files. See 'get_detail()'.
+        Ordered by 'id'.
+
+        Args:
+            cls (Issue): this class.
+            id (int): issue id.
+            after_id (int): returns comments whose id is greater than this.
+            before_id (int): returns comments whose id is less than this.
+            limit (int): max number of comments.
+            last (bool): returns the last 'limit' comments instead of the first.
+        """
+
+        query = Comment.query \
+            .filter(Comment.issue_id == id) \
+            .options(joinedload(Comment.user), selectinload(Comment.attached_file_list))
+        if after_id is not None:
+            query = query.filter(Comment.id > after_id)
+        if before_id is not None:
+            query = query.filter(Comment.id < before_id)
+        if not last:
+            return query.order_by(Comment.id.asc()).limit(limit).all()
+        return list(reversed(query.order_by(Comment.id.desc()).limit(limit).all()))
+
+    def get_comment_window(self, size):
+        """Returns the first and the last comments of this issue.
+
+        Comments between them are not loaded, so the number of queries
+        and the size of page do not depend on the number of comments.
+        Load them by 'get_comments(id, after_id=head[-1].id, before_id=tail[0].id)'.
+
+        Args:
+            size (int): max number of comments of each end.
+
+        Returns:
+            A tuple (head, tail, number of comments between them).
+            'tail' is empty if all comments are in 'head'.
+        """
+
+        if self.comment_count <= size * 2:
+            return (self.get_comments(self.id), [], 0)
+        head = self.get_comments(self.id, limit=size)
+        # 'after_id' keeps head and tail apart even if 'comment_count' is stale.
+        tail = self.get_comments(self.id, after_id=head[-1].id if head else None, limit=size, last=True)
+        return (head, tail, max(0, self.comment_count - len(head) - len(tail)))
+
     def add(self):
-        """Inserts this instance to database."""
+        """Inserts this instance to database.
+
+        Also updates numbers of issues per state, and writes an event of
+        creation or state change of this issue.
+        """
+
+        created = self.id is None
+        if created:
+            comments = list(self.comments)
+            self.comment_count = len(comments)
+            if comments:
+                self.last_comment_at = max(c.pub_date for c in comments)
+        state_change = self.get_state_change()
 
+        self.touch()
         db.session.add(self)
+        db.session.flush()
+        if created:
+            State.adjust_issue_count(self.state_id, 1)
+            db.session.add(IssueEvent(self.id, 'issue', state_id=self.state_id))
+        elif state_change is not None:
+            self.apply_state_change(state_change)
         db.session.commit()
+        fragment_cache.invalidate_issue(self.id)
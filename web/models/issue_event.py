@@ -0,0 +1,92 @@
+"""Issue event class definition."""
+
+from datetime import datetime
+from . import get_db
+
+db = get_db()
+
+class IssueEvent(db.Model):
+    """Issue event class.
+
+    A change of an issue, written in the same transaction as the change.
+    Read by the event stream server ('web/events.py') in order of 'id'.
+
+    Extends Model of 'Flask-SQLAlchemy'.
+    """
+
+    __tablename__ = 'issue_event'
+    # ids of pruned events are not reused, so readers after the last id see new events.
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    TYPES = ('issue', 'comment', 'state')
+
+    id = db.Column(db.Integer, primary_key=True)
+    issue_id = db.Column(db.Integer, db.ForeignKey('issue.id'), nullable=False, index=True)
+    type = db.Column(db.String(16), nullable=False)
+    comment_id = db.Column(db.Integer)
+    state_id = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    def __init__(self, issue_id, type, comment_id=None, state_id=None):
+        """Creates a instance of this class."""
+
+        self.issue_id = issue_id
+        self.type = type
+        self.comment_id = comment_id
+        self.state_id = state_id
+        self.created_at = datetime.utcnow()
+
+    def __repr__(self):
+        return 'id={}, issue_id={}, type={}'.format(self.id, self.issue_id, self.type)
+
+    def to_dict(self):
+        """Returns a dictionary to be serialized to JSON."""
+
+        return {'id': self.id,
+                'issue_id': self.issue_id,
+                'type': self.type,
+                'comment_id': self.comment_id,
+                'state_id': self.state_id,
+                'created_at': self.created_at.isoformat() + 'Z'}
+
+    @classmethod
+    def get_last_id(cls):
+        """Returns id of the last event. 0 if no events.
+
+        Args:
+            cls (IssueEvent): this class.
+        """
+
+        return db.session.query(db.func.max(cls.id)).scalar() or 0
+
+    @classmethod
+    def fetch_after(cls, after_id, limit=100, issue_id=None):
+        """Returns events after specified id. Ordered by 'id'.
+
+        Args:
+            cls (IssueEvent): this class.
+            after_id (int): id of the last event already read.
+            limit (int): maximum number of events.
+            issue_id (int): returns only events of this issue if specified.
+        """
+
+        query = cls.query.filter(cls.id > after_id)
+        if issue_id is not None:
+            query = query.filter(cls.issue_id == issue_id)
+        return query.order_by(cls.id.asc()).limit(limit).all()
+
+    @classmethod
+    def prune(cls, before):
+        """Deletes events created before specified date and commits.
+
+        Args:
+            cls (IssueEvent): this class.
+            before (datetime): events older than this are deleted.
+
+        Returns:
+            Number of deleted events.
+        """
+
+        ret = cls.query.filter(cls.created_at < before).delete(synchronize_session=False)
+        db.session.commit()
+        return ret
@@ -0,0 +1,169 @@
+"""Schema migrations.
+
+Schema version of a database is stored in 'PRAGMA user_version'.
+'init_db()' creates the latest schema and marks it with the latest
+version, and 'migrate()' applies newer migrations to older databases.
+
+Each migration runs in its own transaction and only adds columns,
+tables and indexes, which SQLite does without rewriting tables.
+The only exception is 'issue_event', a small table of recent events,
+which is copied to a new table to add AUTOINCREMENT.
+Migrations check the current schema before changing it, because
+some databases got a part of a change from 'create_all()'.
+"""
+
+from sqlalchemy import text
+from .search import SEARCH_INDEX_DDL
+
+def _get_columns(connection, table):
+    return [row[1] for row in connection.execute(text('PRAGMA table_info("{}")'.format(table)))]
+
+def _has_table(connection, table):
+    return connection.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+            {'name': table}).first() is not None
+
+def _add_column(connection, table, column, ddl):
+    """Adds a column if not exists.
+
+    Args:
+        connection: SQLAlchemy connection.
+        table (string): table name.
+        column (string): column name.
+        ddl (string): column definition without name.
+    """
+
+    if column not in _get_columns(connection, table):
+        connection.execute(text('ALTER TABLE "{}" ADD COLUMN "{}" {}'.format(table, column, ddl)))
+
+def _add_comment_counters(connection):
+    _add_column(connection, 'issue', 'comment_count', 'INTEGER NOT NULL DEFAULT 0')
+    _add_column(connection, 'issue', 'last_comment_at', 'DATETIME')
+    connection.execute(text(
+            'UPDATE issue SET'
+            ' comment_count = (SELECT COUNT(*) FROM comment WHERE comment.issue_id = issue.id),'
+            ' last_comment_at = (SELECT MAX(pub_date) FROM comment WHERE comment.issue_id = issue.id)'))
+
+def _add_attached_file_storage(connection):
+    _add_column(connection, 'attached_file', 'storage', "VARCHAR(16) NOT NULL DEFAULT 'database'")
+    _add_column(connection, 'attached_file', 'sha256', 'VARCHAR(64)')
+    _add_column(connection, 'attached_file', 'size', 'INTEGER')
+
+def _add_search_index(connection):
+    created = not _has_table(connection, 'issue_fts')
+    for ddl in SEARCH_INDEX_DDL:
+        connection.execute(text(ddl))
+    if created:
+        connection.execute(text("INSERT INTO issue_fts(issue_fts) VALUES ('rebuild')"))
+        connection.execute(text("INSERT INTO comment_fts(comment_fts) VALUES ('rebuild')"))
+
+def _add_version_stamps(connection):
+    connection.execute(text(
+            'CREATE TABLE IF NOT EXISTS version_stamp ('
+            ' "key" VARCHAR(32) NOT NULL PRIMARY KEY,'
+            ' value INTEGER NOT NULL,'
+            ' updated_at DATETIME)'))
+    _add_column(connection, 'issue', 'version', 'INTEGER NOT NULL DEFAULT 0')
+    _add_column(connection, 'issue', 'updated_at', 'DATETIME')
+
+def _add_foreign_key_indexes(connection):
+    for (table, column) in [('comment', 'issue_id'),
+                            ('comment', 'user_id'),
+                            ('attached_file', 'comment_id'),
+                            ('issue', 'state_id')]:
+        connection.execute(text('CREATE INDEX IF NOT EXISTS ix_{0}_{1} ON "{0}" ({1})'.format(table, column)))
+
+_ISSUE_EVENT_DDL = (
+        'CREATE TABLE IF NOT EXISTS issue_event ('
+        ' id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,'
+        ' issue_id INTEGER NOT NULL REFERENCES issue (id),'
+        ' type VARCHAR(16) NOT NULL,'
+        ' comment_id INTEGER,'
+        ' state_id INTEGER,'
+        ' created_at DATETIME NOT NULL)')
+
+def _add_issue_events(connection):
+    connection.execute(text(_ISSUE_EVENT_DDL))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_issue_event_issue_id ON issue_event (issue_id)'))
+
+def _add_state_counters(connection):
+    _add_column(connection, 'state', 'issue_count', 'INTEGER NOT NULL DEFAULT 0')
+    connection.execute(text(
+            'UPDATE state SET issue_count = (SELECT COUNT(*) FROM issue WHERE issue.state_id = state.id)'))
+
+def _add_attached_file_codec(connection):
+    _add_column(connection, 'attached_file', 'codec', "VARCHAR(16) NOT NULL DEFAULT 'identity'")
+    _add_column(connection, 'attached_file', 'stored_size', 'INTEGER')
+
+def _add_issue_event_autoincrement(connection):
+    sql = connection.execute(
+            text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'issue_event'")).scalar()
+    if 'AUTOINCREMENT' in sql.upper():
+        return
+    # copied rows keep their ids, and the next id continues from the largest of them.
+    connection.execute(text('ALTER TABLE issue_event RENAME TO issue_event_old'))
+    connection.execute(text(_ISSUE_EVENT_DDL))
+    connection.execute(text(
+            'INSERT INTO issue_event (id, issue_id, type, comment_id, state_id, created_at)'
+            ' SELECT id, issue_id, type, comment_id, state_id, created_at FROM issue_event_old'))
+    connection.execute(text('DROP TABLE issue_event_old'))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_issue_event_issue_id ON issue_event (issue_id)'))
+
+# (version, description, function). append new migrations to the end.
+MIGRATIONS = [
+    (1, 'add comment counters to issue', _add_comment_counters),
+    (2, 'add storage, sha256 and size to attached_file', _add_attached_file_storage),
+    (3, 'add full-text search index', _add_search_index),
+    (4, 'add version_stamp table and version of issue', _add_version_stamps),
+    (5, 'add indexes of foreign keys', _add_foreign_key_indexes),
+    (6, 'add issue_event table', _add_issue_events),
+    (7, 'add issue counters to state', _add_state_counters),
+    (8, 'add codec and stored_size to attached_file', _add_attached_file_codec),
+    (9, 'add AUTOINCREMENT to id of issue_event', _add_issue_event_autoincrement),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def get_version(engine):
+    """Returns schema version of database.
+
+    Args:
+        engine: SQLAlchemy engine.
+    """
+
+    with engine.connect() as connection:
+        return connection.execute(text('PRAGMA user_version')).scalar()
+
+def set_version(connection, version):
+    """Sets schema version of database.
+
+    Args:
+        connection: SQLAlchemy connection.
+        version (int): schema version.
+    """
+
+    connection.execute(text('PRAGMA user_version = {:d}'.format(version)))
+
+def migrate(engine):
+    """Applies migrations newer than schema version of database.
+
+    Args:
+        engine: SQLAlchemy engine.
+
+    Returns:
+        A list of applied (version, description).
+    """
+
+    with engine.connect() as connection:
+        if not _has_table(connection, 'issue'):
+            raise RuntimeError('database is not created. run \'python dbutil.py create\'.')
+
+    applied = []
+    for (version, description, function) in MIGRATIONS:
+        if version <= get_version(engine):
+            continue
+        with engine.begin() as connection:
+            function(connection)
+            set_version(connection, version)
+        applied.append((version, description))
+    return applied
@@ -0,0 +1,126 @@
+"""Full-text search of issues and comments.
+
+Uses SQLite FTS5 tables which refer to 'issue' and 'comment' tables
+as external content. Triggers keep them up to date, so 'Issue.add()'
+and 'Comment.add()' update the index in the same transaction.
+"""
+
+from collections import namedtuple
+from markupsafe import Markup, escape
+from . import get_db
+
+db = get_db()
+
+SearchResult = namedtuple('SearchResult', ['issue_id', 'subject', 'snippet'])
+
+_SNIPPET_OPEN = '\x02'
+_SNIPPET_CLOSE = '\x03'
+
+SEARCH_INDEX_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS issue_fts USING fts5("
+    "subject, content='issue', content_rowid='id')",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS comment_fts USING fts5("
+    "body, content='comment', content_rowid='id')",
+
+    "CREATE TRIGGER IF NOT EXISTS issue_fts_insert AFTER INSERT ON issue BEGIN"
+    " INSERT INTO issue_fts(rowid, subject) VALUES (new.id, new.subject);"
+    " END",
+    "CREATE TRIGGER IF NOT EXISTS issue_fts_delete AFTER DELETE ON issue BEGIN"
+    " INSERT INTO issue_fts(issue_fts, rowid, subject) VALUES ('delete', old.id, old.subject);"
+    " END",
+    "CREATE TRIGGER IF NOT EXISTS issue_fts_update AFTER UPDATE OF subject ON issue BEGIN"
+    " INSERT INTO issue_fts(issue_fts, rowid, subject) VALUES ('delete', old.id, old.subject);"
+    " INSERT INTO issue_fts(rowid, subject) VALUES (new.id, new.subject);"
+    " END",
+
+    "CREATE TRIGGER IF NOT EXISTS comment_fts_insert AFTER INSERT ON comment BEGIN"
+    " INSERT INTO comment_fts(rowid, body) VALUES (new.id, new.body);"
+    " END",
+    "CREATE TRIGGER IF NOT EXISTS comment_fts_delete AFTER DELETE ON comment BEGIN"
+    " INSERT INTO comment_fts(comment_fts, rowid, body) VALUES ('delete', old.id, old.body);"
+    " END",
+    "CREATE TRIGGER IF NOT EXISTS comment_fts_update AFTER UPDATE OF body ON comment BEGIN"
+    " INSERT INTO comment_fts(comment_fts, rowid, body) VALUES ('delete', old.id, old.body);"
+    " INSERT INTO comment_fts(rowid, body) VALUES (new.id, new.body);"
+    " END",
+]
+
+# hits of subject and comments are merged per issue. bm25() is
+# negative and smaller is better, so subject hits are weighted by 2.
+# with MIN(), SQLite takes 'hits.snippet' from the best hit.
+_SEARCH_SQL = """
+SELECT issue.id, issue.subject, hits.snippet, MIN(hits.rank) AS best_rank
+FROM (
+    SELECT rowid AS issue_id,
+           snippet(issue_fts, 0, :open, :close, '...', 16) AS snippet,
+           bm25(issue_fts) * 2 AS rank
+    FROM issue_fts WHERE issue_fts MATCH :query
+    UNION ALL
+    SELECT comment.issue_id AS issue_id,
+           snippet(comment_fts, 0, :open, :close, '...', 16) AS snippet,
+           bm25(comment_fts) AS rank
+    FROM comment_fts JOIN comment ON comment.id = comment_fts.rowid
+    WHERE comment_fts MATCH :query
+) AS hits JOIN issue ON issue.id = hits.issue_id
+GROUP BY hits.issue_id
+ORDER BY best_rank
+LIMIT :limit
+"""
+
+def create_search_index():
+    """Creates full-text search tables and triggers if not exist."""
+
+    for ddl in SEARCH_INDEX_DDL:
+        db.session.execute(ddl)
+    db.session.commit()
+
+def rebuild_search_index():
+    """Rebuilds full-text search tables from 'issue' and 'comment' tables."""
+
+    create_search_index()
+    db.session.execute("INSERT INTO issue_fts(issue_fts) VALUES ('rebuild')")
+    db.session.execute("INSERT INTO comment_fts(comment_fts) VALUES ('rebuild')")
+    db.session.commit()
+
+def _to_match_query(query):
+    """Converts user input to FTS5 query.
+    Each word is quoted, so FTS5 operators in input are not interpreted.
+
+    Args:
+        query (string): user input.
+    """
+
+    return ' '.join('"{}"'.format(word.replace('"', '""')) for word in query.split())
+
+def _to_snippet_markup(snippet):
+    """Escapes snippet and highlights matched words with '<mark>'.
+
+    Args:
+        snippet (string): snippet returned by FTS5.
+    """
+
+    return Markup(escape(snippet)
+            .replace(_SNIPPET_OPEN, Markup('<mark>'))
+            .replace(_SNIPPET_CLOSE, Markup('</mark>')))
+
+def search(query, limit=50):
+    """Searches issues by subject and comment body.
+
+    Args:
+        query (string): words to search.
+        limit (int): max number of results.
+
+    Returns:
+        A list of SearchResult ordered by relevance.
+    """
+
+    match_query = _to_match_query(query)
+    if not match_query:
+        return []
+
+    rows = db.session.execute(_SEARCH_SQL, {
+        'query': match_query,
+        'open': _SNIPPET_OPEN,
+        'close': _SNIPPET_CLOSE,
+        'limit': limit})
+    return [SearchResult(id, subject, _to_snippet_markup(snippet)) for (id, subject, snippet, _) in rows]
@@ -1,9 +1,31 @@
 """State class definition."""
 
-from . import get_db
+import threading
+import time
+from flask import current_app
+from . import get_db, detached_copy
+from .version_stamp import VersionStamp
 
 db = get_db()
 
+VERSION_KEY = 'state'
+
+# process-wide cache of all states.
+_registry = None
+_registry_lock = threading.Lock()
+
+# process-wide cache of (version of issue list, {state id: number of issues}).
+_issue_counts = None
+
+class _Registry(object):
+    """Detached copies of all states and their version."""
+
+    def __init__(self, version, states):
+        self.version = version
+        self.states = states
+        self.states_by_id = dict((state.id, state) for state in states)
+        self.checked_at = time.monotonic()
+
 class State(db.Model):
     """State class.
 
@@ -14,6 +36,9 @@ class State(db.Model):
     name = db.Column(db.String(32), nullable=False)
     value = db.Column(db.Integer, unique=True, nullable=False)
 
+    # denormalized from 'issue' table. maintained by 'Issue.add()' and 'Comment.add()'.
+    issue_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
     def __init__(self, name, value):
         """Creates a instance of this class."""
 
@@ -23,8 +48,122 @@ class State(db.Model):
     def __repr(self):
         return '{}([])'.format(self.name, self.value)
 
+    @classmethod
+    def _get_registry(cls):
+        """Returns cached states.
+
+        The version stamp in database is checked at most once per
+        'STATE_CACHE_CHECK_INTERVAL' seconds, and states are reloaded
+        if other process changed them.
+
+        Args:
+            cls (State): this class.
+        """
+
+        global _registry
+        with _registry_lock:
+            registry = _registry
+            interval = current_app.config.get('STATE_CACHE_CHECK_INTERVAL', 5)
+            if registry is not None and time.monotonic() - registry.checked_at < interval:
+                return registry
+
+            version = VersionStamp.get_value(VERSION_KEY)
+            if registry is not None and registry.version == version:
+                registry.checked_at = time.monotonic()
+                return registry
+
+            states = cls.query.order_by(cls.value.asc()).all()
+            _registry = _Registry(version, [detached_copy(state) for state in states])
+            return _registry
+
+    @classmethod
+    def invalidate_cache(cls):
+        """Discards cached states of this process.
+
+        Args:
+            cls (State): this class.
+        """
+
+        global _registry
+        with _registry_lock:
+            _registry = None
+
+    @classmethod
+    def get_version(cls):
+        """Returns version of cached states.
+
+        Args:
+            cls (State): this class.
+        """
+
+        return cls._get_registry().version
+
     @classmethod
     def all(cls):
-        """Returns all states. Ordered by 'value'."""
+        """Returns all states. Ordered by 'value'.
+
+        Returned instances are cached and detached from session.
+        """
+
+        return cls._get_registry().states
+
+    @classmethod
+    def get(cls, id):
+        """Returns a state of specified id. Cached like 'all()'.
+
+        Args:
+            cls (State): this class.
+            id (int): state id.
+        """
+
+        return cls._get_registry().states_by_id.get(id)
+
+    @classmethod
+    def get_issue_counts(cls, list_version):
+        """Returns numbers of issues per state.
+
+        Counts are cached per process while version of issue list
+        (see 'Issue.get_list_version()') is not changed.
+
+        Args:
+            cls (State): this class.
+            list_version (int): current version of issue list.
+
+        Returns:
+            A dictionary of state id and number of issues.
+        """
+
+        global _issue_counts
+        cached = _issue_counts
+        if cached is not None and cached[0] == list_version:
+            return cached[1]
+        counts = dict(db.session.query(cls.id, cls.issue_count))
+        _issue_counts = (list_version, counts)
+        return counts
+
+    @classmethod
+    def adjust_issue_count(cls, id, delta):
+        """Adds 'delta' to number of issues of a state. Changes are not committed.
+
+        Args:
+            cls (State): this class.
+            id (int): state id.
+            delta (int): number to add.
+        """
+
+        # evaluated in SQL so concurrent changes are not lost.
+        cls.query.filter(cls.id == id) \
+            .update({cls.issue_count: cls.issue_count + delta}, synchronize_session=False)
+
+    def add(self):
+        """Inserts this instance to database."""
+
+        db.session.add(self)
+        self.save()
+
+    def save(self):
+        """Commits changes of states and invalidates caches."""
 
-        return cls.query.order_by(cls.value.asc()).all()
+        VersionStamp.bump(VERSION_KEY)
+        db.session.commit()
+        self.invalidate_cache()
@@ -1,10 +1,20 @@
 """User class definition."""
 
-import bcrypt
-from . import get_db
+import threading
+from collections import OrderedDict
+from flask import current_app
+from . import get_db, detached_copy
+from .version_stamp import VersionStamp
+from .. import password_hasher
 
 db = get_db()
 
+VERSION_KEY = 'users'
+
+# process-local LRU cache of users. id -> detached User.
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
 class User(db.Model):
     """User class.
 
@@ -36,18 +46,72 @@ class User(db.Model):
 
         return cls.query.get(id)
 
+    @classmethod
+    def get_cached(cls, id):
+        """Returns a user of specified id using process-local LRU cache.
+        The cache size is 'USER_CACHE_SIZE' in config. 0 disables it.
+
+        Args:
+            cls (User): this class.
+            id (string): user id.
+        """
+
+        size = current_app.config.get('USER_CACHE_SIZE', 0)
+        if size < 1:
+            return cls.get(id)
+
+        with _cache_lock:
+            cached = _cache.get(id)
+            if cached is not None:
+                _cache.move_to_end(id)
+        if cached is not None:
+            return db.session.merge(cached, load=False)
+
+        ret = cls.get(id)
+        if ret is not None:
+            with _cache_lock:
+                _cache[id] = detached_copy(ret)
+                while len(_cache) > size:
+                    _cache.popitem(last=False)
+        return ret
+
+    @classmethod
+    def get_version(cls):
+        """Returns version stamp which is bumped when any user is saved.
+
+        Args:
+            cls (User): this class.
+        """
+
+        return VersionStamp.get_value(VERSION_KEY)
+
+    @classmethod
+    def invalidate_cache(cls, id):
+        """Removes a user of specified id from cache.
+
+        Args:
+            cls (User): this class.
+            id (string): user id.
+        """
+
+        with _cache_lock:
+            _cache.pop(id, None)
+
     def add(self):
         """Inserts this instance to database."""
 
         db.session.add(self)
         db.session.commit()
+        self.invalidate_cache(self.id)
 
     def save(self):
         """Save session."""
 
         # TODO: not good. fix this.
 
+        VersionStamp.bump(VERSION_KEY) # user names are rendered in issues.
         db.session.commit()
+        self.invalidate_cache(self.id)
 
     def _encode_password(self, password):
         """Encode password string.
@@ -73,9 +137,8 @@ class User(db.Model):
             Hashed password.
         """
 
-        salt = bcrypt.gensalt(rounds=12)
         bpassword = self._encode_password(password)
-        return bcrypt.hashpw(bpassword, salt)
+        return password_hasher.hash_password(bpassword)
 
     def authenticate(self, password):
         """Authenticate user.
@@ -89,10 +152,30 @@ class User(db.Model):
         """
 
         bpassword = self._encode_password(password)
-        return bcrypt.checkpw(bpassword, self.hashed_password)
+        return password_hasher.check_password(bpassword, self.hashed_password)
+
+    @classmethod
+    def authenticate_unknown(cls, password):
+        """Authenticate unknown user. Takes as long as 'authenticate()'.
+
+        Args:
+            cls (User): this class.
+            password (string): plain text password.
+
+        Returns:
+            False.
+        """
+
+        return password_hasher.check_dummy_password(password.encode('utf-8'))
+
+    def needs_rehash(self):
+        """Returns True if password hash was created with other cost than config."""
+
+        return password_hasher.needs_rehash(self.hashed_password)
 
     def change_password(self, password):
         """Change user password."""
 
         self.hashed_password = self._create_hashed_password(password)
+        self.invalidate_cache(self.id)
 
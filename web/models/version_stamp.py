@@ -0,0 +1,63 @@
+"""Version stamp class definition."""
+
+from datetime import datetime
+from . import get_db
+
+db = get_db()
+
+class VersionStamp(db.Model):
+    """Version stamp class.
+
+    A named counter which is bumped when data of the name is changed.
+    Caches compare it to detect changes made by other processes.
+
+    Extends Model of 'Flask-SQLAlchemy'.
+    """
+
+    key = db.Column(db.String(32), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return '{}={}'.format(self.key, self.value)
+
+    @classmethod
+    def get_value(cls, key):
+        """Returns current value of specified key. 0 if never bumped.
+
+        Args:
+            cls (VersionStamp): this class.
+            key (string): name of the counter.
+        """
+
+        ret = db.session.query(cls.value).filter(cls.key == key).scalar()
+        return ret or 0
+
+    @classmethod
+    def get(cls, key):
+        """Returns a version stamp of specified key. None if never bumped.
+
+        Args:
+            cls (VersionStamp): this class.
+            key (string): name of the counter.
+        """
+
+        return cls.query.get(key)
+
+    @classmethod
+    def bump(cls, key):
+        """Increments value of specified key. Changes are not committed.
+
+        Args:
+            cls (VersionStamp): this class.
+            key (string): name of the counter.
+
+        Returns:
+            New value.
+        """
+
+        db.session.execute(
+                'INSERT INTO version_stamp (key, value, updated_at) VALUES (:key, 1, :now)'
+                ' ON CONFLICT (key) DO UPDATE SET value = value + 1, updated_at = :now',
+                {'key': key, 'now': datetime.utcnow()})
+        return cls.get_value(key)
@@ -0,0 +1,99 @@
+"""Password hashing on a bounded thread pool.
+
+bcrypt is CPU bound. Hashing runs on a dedicated executor so that
+the number of concurrent hashes is bounded by 'PASSWORD_HASH_WORKERS',
+and requests beyond 'PASSWORD_HASH_QUEUE_LIMIT' waiting hashes are
+rejected with 503 instead of piling up.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import bcrypt
+from flask import current_app
+from web.exceptions.zen_http_exception import ZenHttpException
+
+_executor = None
+_slots = None
+_dummy_hashes = {}
+_lock = threading.Lock()
+
+def _get_executor():
+    """Returns a tuple (executor, slots). Created on first call."""
+
+    global _executor
+    global _slots
+    with _lock:
+        if _executor is None:
+            workers = current_app.config.get('PASSWORD_HASH_WORKERS', 2)
+            queue_limit = current_app.config.get('PASSWORD_HASH_QUEUE_LIMIT', 16)
+            _executor = ThreadPoolExecutor(max_workers=workers)
+            _slots = threading.BoundedSemaphore(workers + queue_limit)
+        return (_executor, _slots)
+
+def _run(fn, *args):
+    """Runs fn(*args) on the executor and waits for the result.
+    Raises ZenHttpException(503) if the executor is saturated.
+    """
+
+    (executor, slots) = _get_executor()
+    if not slots.acquire(blocking=False):
+        raise ZenHttpException(503) # Service Unavailable
+    try:
+        future = executor.submit(fn, *args)
+    except Exception:
+        slots.release()
+        raise
+    future.add_done_callback(lambda f: slots.release())
+    return future.result()
+
+def get_rounds():
+    """Returns bcrypt cost from 'BCRYPT_ROUNDS' in config."""
+
+    return current_app.config.get('BCRYPT_ROUNDS', 12)
+
+def hash_password(bpassword):
+    """Creates password hash.
+
+    Args:
+        bpassword (bytes): encoded password.
+
+    Returns:
+        Hashed password.
+    """
+
+    return _run(bcrypt.hashpw, bpassword, bcrypt.gensalt(rounds=get_rounds()))
+
+def check_password(bpassword, hashed_password):
+    """Returns True if password matches hash.
+
+    Args:
+        bpassword (bytes): encoded password.
+        hashed_password (bytes): hashed password.
+    """
+
+    return _run(bcrypt.checkpw, bpassword, hashed_password)
+
+def check_dummy_password(bpassword):
+    """Spends as much time as 'check_password()'. Always returns False.
+    Used for unknown user ids, so they can not be told by response time.
+
+    Args:
+        bpassword (bytes): encoded password.
+    """
+
+    rounds = get_rounds()
+    if rounds not in _dummy_hashes:
+        # a hash of random salt and no password. made without hashing,
+        # so the first call takes as long as others.
+        _dummy_hashes[rounds] = bcrypt.gensalt(rounds=rounds) + b'.' * 31
+    check_password(bpassword, _dummy_hashes[rounds])
+    return False
+
+def needs_rehash(hashed_password):
+    """Returns True if hash was created with other cost than current.
+
+    Args:
+        hashed_password (bytes): hashed password like b'$2b$12$...'.
+    """
+
+    return int(hashed_password.split(b'$')[2]) != get_rounds()
@@ -0,0 +1,192 @@
+"""SQL statement counting for debugging and tests.
+
+In debug or test mode, statements of each request are recorded and
+statements of the same shape repeated many times (a typical N+1
+query pattern) are logged as warnings with the template line or
+source line which executed them.
+
+In tests:
+
+    with query_budget(5):
+        client.get('/1/')
+"""
+
+import contextlib
+import os
+import re
+import sys
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import flask
+import jinja2
+import sqlalchemy
+import werkzeug
+from flask import g
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_local = threading.local()
+_listen_lock = threading.Lock()
+
+_IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_NUMBER = re.compile(r'\b\d+\b')
+_SPACES = re.compile(r'\s+')
+
+# frames in these directories are not reported as location.
+_IGNORED_DIRS = tuple(os.path.dirname(m.__file__) + os.sep
+                      for m in [flask, jinja2, sqlalchemy, werkzeug, contextlib])
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised if more statements than the budget are executed."""
+
+    pass
+
+def get_shape(statement):
+    """Returns shape of SQL statement.
+
+    Literal numbers and lengths of 'IN' lists are removed, so statements
+    which differ only in parameters have the same shape.
+
+    Args:
+        statement (string): SQL statement.
+    """
+
+    shape = _IN_LIST.sub('(?)', statement)
+    shape = _NUMBER.sub('?', shape)
+    return _SPACES.sub(' ', shape).strip()
+
+def _get_location():
+    """Returns 'template:line' or 'file:line' which is executing a statement."""
+
+    frame = sys._getframe(2)
+    fallback = None
+    while frame is not None:
+        template = frame.f_globals.get('__jinja_template__')
+        if template is not None:
+            return '{}:{}'.format(template.name or '<template>',
+                                  template.get_corresponding_lineno(frame.f_lineno))
+        filename = frame.f_code.co_filename
+        if fallback is None and not filename.startswith(_IGNORED_DIRS + ('<',)) and filename != __file__:
+            fallback = '{}:{}'.format(filename, frame.f_lineno)
+        frame = frame.f_back
+    return fallback
+
+class QueryRecorder(object):
+    """Records statements executed in current thread."""
+
+    def __init__(self):
+        self.count = 0
+        # shape -> [count, location of first statement]
+        self.shapes = OrderedDict()
+
+    def record(self, statement, location):
+        self.count += 1
+        shape = get_shape(statement)
+        entry = self.shapes.get(shape)
+        if entry is None:
+            self.shapes[shape] = [1, location]
+        else:
+            entry[0] += 1
+
+    def get_repeated(self, threshold):
+        """Returns statements of the same shape executed 'threshold' times or more.
+
+        Args:
+            threshold (int): minimum number of statements.
+
+        Returns:
+            A list of (shape, count, location).
+        """
+
+        return [(shape, count, location)
+                for (shape, (count, location)) in self.shapes.items()
+                if count >= threshold]
+
+    def format(self):
+        """Returns a human readable list of recorded shapes."""
+
+        return '\n'.join('  {} x {} (at {})'.format(count, shape, location)
+                         for (shape, (count, location)) in self.shapes.items())
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    recorders = getattr(_local, 'recorders', None)
+    if recorders:
+        location = _get_location()
+        for recorder in recorders:
+            recorder.record(statement, location)
+
+def _listen():
+    with _listen_lock:
+        if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+
+def _push(recorder):
+    _listen()
+    if getattr(_local, 'recorders', None) is None:
+        _local.recorders = []
+    _local.recorders.append(recorder)
+
+def _remove(recorder):
+    _local.recorders.remove(recorder)
+
+@contextmanager
+def record_queries():
+    """Records statements executed in the block.
+
+    Yields:
+        A 'QueryRecorder'.
+    """
+
+    recorder = QueryRecorder()
+    _push(recorder)
+    try:
+        yield recorder
+    finally:
+        _remove(recorder)
+
+@contextmanager
+def query_budget(budget):
+    """Fails if more than 'budget' statements are executed in the block.
+
+    Args:
+        budget (int): maximum number of statements.
+
+    Raises:
+        QueryBudgetExceeded: if budget is exceeded.
+    """
+
+    with record_queries() as recorder:
+        yield recorder
+    if recorder.count > budget:
+        raise QueryBudgetExceeded('{} statements executed. budget is {}.\n{}'.format(
+                recorder.count, budget, recorder.format()))
+
+def init_app(app):
+    """Detects repeated statements in each request.
+
+    Enabled if 'QUERY_DEBUG' is True or the app is in debug or test mode.
+    Statements of the same shape executed 'QUERY_REPEAT_THRESHOLD' times
+    or more in a request are logged as warnings.
+
+    Args:
+        app (flask.Flask): application.
+    """
+
+    if not (app.config.get('QUERY_DEBUG') or app.debug or app.testing):
+        return
+    threshold = app.config.get('QUERY_REPEAT_THRESHOLD', 5)
+
+    @app.before_request
+    def start_recording_queries():
+        g.query_recorder = QueryRecorder()
+        _push(g.query_recorder)
+
+    @app.teardown_request
+    def stop_recording_queries(exc):
+        recorder = g.pop('query_recorder', None)
+        if recorder is None:
+            return
+        _remove(recorder)
+        for (shape, count, location) in recorder.get_repeated(threshold):
+            app.logger.warning('{} statements of the same shape at {}: {}'.format(count, location, shape))
@@ -0,0 +1,61 @@
+"""Compression of responses.
+
+Rendered pages and JSON larger than 'COMPRESS_MIN_SIZE' are compressed
+by Brotli or gzip, as accepted by the client. Streamed responses,
+such as downloads and event streams, are not compressed.
+"""
+
+from flask import request
+from .compression import compress_response, get_response_codecs
+from .http_helper import accepts_encoding
+
+DEFAULT_MIMETYPES = ('text/html', 'application/json')
+
+def _is_compressible(response, mimetypes, min_size):
+    if response.status_code < 200 or response.status_code in (204, 206, 304):
+        return False
+    if response.direct_passthrough or response.is_streamed:
+        return False
+    if 'Content-Encoding' in response.headers:
+        return False
+    if response.mimetype not in mimetypes:
+        return False
+    return response.content_length is not None and response.content_length >= min_size
+
+def _choose_codec():
+    for codec in get_response_codecs():
+        if accepts_encoding(request, codec):
+            return codec
+    return None
+
+def _after_request(response, mimetypes, min_size):
+    if not _is_compressible(response, mimetypes, min_size):
+        return response
+    response.vary.add('Accept-Encoding')
+    codec = _choose_codec()
+    if codec is None:
+        return response
+
+    response.set_data(compress_response(codec, response.get_data()))
+    response.content_encoding = codec
+    (etag, weak) = response.get_etag()
+    if etag is not None and not weak:
+        # compressed bytes are another representation.
+        response.set_etag('{}-{}'.format(etag, codec))
+    return response
+
+def init_app(app):
+    """Compresses responses of 'app'.
+
+    Call this after 'metrics.init_app()', so compressed sizes are recorded.
+    Does nothing if 'COMPRESS_ENABLED' is False.
+
+    Args:
+        app (flask.Flask): application.
+    """
+
+    if not app.config.get('COMPRESS_ENABLED', True):
+        return
+    mimetypes = tuple(app.config.get('COMPRESS_MIMETYPES', DEFAULT_MIMETYPES))
+    min_size = app.config.get('COMPRESS_MIN_SIZE', 1024)
+    app.after_request(lambda response: _after_request(response, mimetypes, min_size))
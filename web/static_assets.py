@@ -0,0 +1,202 @@
+"""Fingerprinted static files.
+
+Files under 'web/static' are copied to 'STATIC_BUILD_DIR' with a hash of
+their content in the name, e.g. 'style.0123456789ab.css', along with
+precompressed '.gz' (and '.br' if 'brotli' is installed) siblings.
+A changed file gets a new name, so the copies are served at
+'/assets/<name>' with far-future 'Cache-Control: immutable'.
+
+Templates refer to static files by 'static_url(filename)'.
+
+Files are built on start-up if missing. To build in advance, e.g. for
+servers which can not write to 'STATIC_BUILD_DIR':
+$ python -m web.static_assets
+"""
+
+import hashlib
+import mimetypes
+import os
+import re
+import tempfile
+from os.path import exists, isabs, join, relpath, splitext
+from flask import abort, current_app, request, send_file, url_for
+from werkzeug.security import safe_join
+from .compression import BROTLI, GZIP, compress_response, get_response_codecs
+from .http_helper import accepts_encoding
+
+HASH_LENGTH = 12
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# files of other extensions are not precompressed, e.g. images are already compressed.
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.svg', '.json', '.txt', '.html')
+
+_SUFFIXES = {GZIP: '.gz', BROTLI: '.br'}
+
+# names written by 'build()', with or without suffix of precompressed files.
+_BUILT_NAME = re.compile(r'\.[0-9a-f]{%d}(\.[^./]*)?(\.gz|\.br)?$' % HASH_LENGTH)
+
+def get_fingerprinted_name(filename, data):
+    """Returns file name which contains hash of data.
+
+    Args:
+        filename (string): original file name.
+        data (bytes): content of file.
+    """
+
+    (base, ext) = splitext(filename)
+    return '{}.{}{}'.format(base, hashlib.sha256(data).hexdigest()[:HASH_LENGTH], ext)
+
+def _get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+def _write_file(path, data):
+    """Writes a file atomically, so servers never read a part of it."""
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        # temporary files are readable only by owner, but servers may run as another user.
+        os.chmod(tmp_path, 0o666 & ~_get_umask())
+        os.replace(tmp_path, path)
+    except Exception:
+        if exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+def build(static_dir, build_dir):
+    """Copies static files to fingerprinted names.
+
+    Files already built are not written again. Files built from old
+    versions of static files are deleted.
+
+    Args:
+        static_dir (string): directory of static files.
+        build_dir (string): directory to write.
+
+    Returns:
+        A dictionary of original names and fingerprinted names,
+        relative to the directories with '/' as separator.
+    """
+
+    manifest = {}
+    for (dir, _, filenames) in os.walk(static_dir):
+        for filename in filenames:
+            path = join(dir, filename)
+            name = relpath(path, static_dir).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                data = f.read()
+            built_name = get_fingerprinted_name(name, data)
+            built_path = join(build_dir, *built_name.split('/'))
+            if not exists(built_path):
+                _write_file(built_path, data)
+            if splitext(name)[1].lower() in COMPRESSIBLE_EXTENSIONS:
+                for codec in get_response_codecs():
+                    compressed_path = built_path + _SUFFIXES[codec]
+                    if exists(compressed_path):
+                        continue
+                    compressed = compress_response(codec, data, best=True)
+                    if len(compressed) < len(data):
+                        _write_file(compressed_path, compressed)
+            manifest[name] = built_name
+    _prune(build_dir, manifest.values())
+    return manifest
+
+def _prune(build_dir, built_names):
+    """Deletes built files which are not in 'built_names', and their precompressed siblings."""
+
+    keep = set()
+    for built_name in built_names:
+        path = join(build_dir, *built_name.split('/'))
+        keep.add(path)
+        keep.update(path + suffix for suffix in _SUFFIXES.values())
+    for (dir, _, filenames) in os.walk(build_dir):
+        for filename in filenames:
+            path = join(dir, filename)
+            if _BUILT_NAME.search(filename) and path not in keep:
+                os.unlink(path)
+
+def get_build_dir(app):
+    """Returns 'STATIC_BUILD_DIR'. A relative path is resolved from the application root.
+
+    Args:
+        app (flask.Flask): application.
+    """
+
+    build_dir = app.config.get('STATIC_BUILD_DIR', '../static_build')
+    if not isabs(build_dir):
+        build_dir = join(app.root_path, build_dir)
+    return build_dir
+
+def init_app(app):
+    """Builds static files and adds 'static_url()' and '/assets/<name>' to 'app'.
+
+    If 'STATIC_FINGERPRINT' is False or the app is in debug mode,
+    'static_url()' returns usual URLs of static files.
+
+    Args:
+        app (flask.Flask): application.
+    """
+
+    manifest = {}
+    built_names = set()
+    build_dir = get_build_dir(app)
+    if app.config.get('STATIC_FINGERPRINT', True):
+        manifest = build(app.static_folder, build_dir)
+        built_names = set(manifest.values())
+
+    def static_url(filename):
+        """Returns URL of a static file.
+
+        Args:
+            filename (string): file name relative to static directory.
+        """
+
+        name = manifest.get(filename)
+        if name is None or current_app.debug:
+            return url_for('static', filename=filename)
+        return url_for('static_asset', filename=name)
+
+    def static_asset(filename):
+        """Sends a fingerprinted static file, precompressed if client accepts it.
+
+        Args:
+            filename (string): fingerprinted file name.
+        """
+
+        if filename not in built_names:
+            abort(404)
+        path = safe_join(build_dir, filename)
+        encoding = None
+        for codec in get_response_codecs():
+            if accepts_encoding(request, codec) and exists(path + _SUFFIXES[codec]):
+                (path, encoding) = (path + _SUFFIXES[codec], codec)
+                break
+
+        res = send_file(path, mimetype=mimetypes.guess_type(filename)[0], conditional=True)
+        if encoding is not None:
+            res.content_encoding = encoding
+        if splitext(filename)[1].lower() in COMPRESSIBLE_EXTENSIONS:
+            res.vary.add('Accept-Encoding')
+        res.headers['Cache-Control'] = CACHE_CONTROL
+        return res
+
+    app.jinja_env.globals['static_url'] = static_url
+    app.add_url_rule('/assets/<path:filename>', 'static_asset', static_asset)
+
+def main(argv):
+    """Builds static files of the application."""
+
+    from web import create_app
+
+    app = create_app()
+    build_dir = get_build_dir(app)
+    for (name, built_name) in sorted(build(app.static_folder, build_dir).items()):
+        print('{} -> {}'.format(name, join(build_dir, built_name)))
+
+if __name__ == '__main__':
+    import sys
+    main(sys.argv[1:])
@@ -0,0 +1,121 @@
+"""File system storage of attached files."""
+
+import hashlib
+import os
+import tempfile
+from os.path import exists, isabs, join
+from flask import current_app
+from .compression import IDENTITY, create_compressor
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+class FileSystemStorage(object):
+    """Content-addressed storage of attached files.
+
+    Data is stored at '<root>/<aa>/<bb>/<sha256>' where 'aa' and 'bb'
+    are the first four hex digits of SHA-256 of the data.
+    Identical data is stored only once.
+
+    Compressed data is stored at the same path with the codec name as
+    extension, e.g. '<sha256>.deflate'. SHA-256 is always of the
+    uncompressed data.
+    """
+
+    def __init__(self, root):
+        """Creates a instance of this class.
+
+        Args:
+            root (string): root directory of the storage.
+        """
+
+        self.root = root
+
+    def get_path(self, sha256, codec=IDENTITY):
+        """Returns the path of data.
+
+        Args:
+            sha256 (string): hex digest of the data.
+            codec (string): codec of the stored data.
+        """
+
+        path = join(self.root, sha256[0:2], sha256[2:4], sha256)
+        return path if codec == IDENTITY else path + '.' + codec
+
+    def exists(self, sha256, codec=IDENTITY):
+        """Returns True if data is stored.
+
+        Args:
+            sha256 (string): hex digest of the data.
+            codec (string): codec of the stored data.
+        """
+
+        return exists(self.get_path(sha256, codec))
+
+    def save(self, stream, chunk_size=DEFAULT_CHUNK_SIZE, codec=IDENTITY):
+        """Stores data read from stream in chunks.
+
+        Args:
+            stream (file-like object): data to store.
+            chunk_size (int): max size of a chunk.
+            codec (string): data is compressed by this codec.
+
+        Returns:
+            A tuple (sha256, size, stored size). Sizes are of
+            uncompressed and of stored data.
+        """
+
+        tmp_dir = join(self.root, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        hash = hashlib.sha256()
+        compressor = create_compressor(codec)
+        size = 0
+        (fd, tmp_path) = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    hash.update(chunk)
+                    size += len(chunk)
+                    f.write(compressor.compress(chunk))
+                f.write(compressor.flush())
+                stored_size = f.tell()
+
+            sha256 = hash.hexdigest()
+            path = self.get_path(sha256, codec)
+            if exists(path):
+                os.unlink(tmp_path) # deduplicated.
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+        except Exception:
+            if exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+        return (sha256, size, stored_size)
+
+    def open(self, sha256, codec=IDENTITY):
+        """Opens stored data for reading. Compressed data is not decompressed.
+
+        Args:
+            sha256 (string): hex digest of the data.
+            codec (string): codec of the stored data.
+
+        Returns:
+            A file object.
+        """
+
+        return open(self.get_path(sha256, codec), 'rb')
+
+def get_file_system_storage():
+    """Returns FileSystemStorage of 'ATTACHMENT_DIR'.
+    A relative path is resolved from the application root.
+    """
+
+    root = current_app.config.get('ATTACHMENT_DIR', '../attachments')
+    if not isabs(root):
+        root = join(current_app.root_path, root)
+    return FileSystemStorage(root)
@@ -1,3 +1,49 @@
 SQLALCHEMY_DATABASE_URI = 'sqlite:///../develop.db'
 SECRET_KEY = 'your_own_secret_key'
 MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB
+ISSUES_PER_PAGE = 50
+MAX_ISSUES_PER_PAGE = 200
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+ATTACHMENT_STORAGE = 'filesystem'  # 'filesystem' or 'database'
+ATTACHMENT_DIR = '../attachments'  # relative to 'web' directory
+UPLOAD_CHUNK_SIZE = 64 * 1024
+UPLOAD_SPOOL_SIZE = 64 * 1024  # larger uploads are spooled to temporary files
+SEARCH_RESULTS_LIMIT = 50
+BCRYPT_ROUNDS = 12  # passwords are rehashed on login when changed
+PASSWORD_HASH_WORKERS = 2
+PASSWORD_HASH_QUEUE_LIMIT = 16  # 503 if more hashes are waiting
+USER_CACHE_SIZE = 256  # per process. other processes see changes after eviction. 0 disables
+STATE_CACHE_CHECK_INTERVAL = 5  # seconds between checks for states changed by other processes
+FRAGMENT_CACHE_BACKEND = 'lru'  # 'lru', 'memcached' (requires pymemcache) or 'none'
+FRAGMENT_CACHE_SIZE = 1024  # number of fragments. 'lru' only
+FRAGMENT_CACHE_SERVER = 'localhost:11211'  # 'memcached' only
+API_PAGE_LIMIT = 100
+API_MAX_PAGE_LIMIT = 1000
+SQLITE_JOURNAL_MODE = 'WAL'  # readers do not block writers
+SQLITE_SYNCHRONOUS = 'NORMAL'  # safe with WAL. commits may be lost on power failure
+SQLITE_BUSY_TIMEOUT = 5000  # milliseconds to wait for locks before 'database is locked'
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+SQLITE_CACHE_SIZE = -16 * 1024  # negative is KiB per connection
+DB_POOL_SIZE = 5
+DB_MAX_OVERFLOW = 10
+DB_READ_POOL_SIZE = 10  # read-only connections for GET requests. 0 disables
+METRICS_ENABLED = True  # per-endpoint metrics at '/metrics'
+QUERY_DEBUG = False  # warn repeated SQL statements per request. always on in debug and test mode
+QUERY_REPEAT_THRESHOLD = 5
+EVENTS_URL = ''  # URL of event server ('python -m web.events') seen from browsers. empty disables
+EVENTS_POLL_INTERVAL = 0.5  # seconds
+EVENTS_HEARTBEAT_INTERVAL = 15  # seconds
+EVENTS_MAX_SUBSCRIBERS = 10000
+EVENTS_QUEUE_SIZE = 100  # slow subscribers are disconnected and resume by 'Last-Event-ID'
+EVENTS_REPLAY_LIMIT = 100
+EVENTS_ALLOW_ORIGIN = None  # 'Access-Control-Allow-Origin' if event server is on other origin
+COMMENTS_WINDOW = 50  # first and last comments rendered on detail page. others are loaded on demand
+COMMENTS_PAGE_SIZE = 100
+ATTACHMENT_COMPRESSION = 'auto'  # 'auto', 'zstd', 'deflate' or 'none'
+ATTACHMENT_COMPRESSION_MIN_SIZE = 1024  # smaller attached files are not compressed
+ATTACHMENT_COMPRESSION_PROBE_SIZE = 64 * 1024  # compressibility is probed with this many first bytes
+ATTACHMENT_COMPRESSION_MAX_RATIO = 0.9  # compressed only if the probe shrinks to this ratio
+COMPRESS_ENABLED = True  # gzip (or Brotli if installed) compression of pages and JSON
+COMPRESS_MIN_SIZE = 1024  # smaller responses are not compressed
+STATIC_FINGERPRINT = True  # serve static files at content-hashed URLs with long cache
+STATIC_BUILD_DIR = '../static_build'  # relative to 'web' directory
@@ -3,9 +3,9 @@
 To run in debug mode: $ FLASK_APP=web/zenmai.py FLASK_DEBUG=1 flask run
 """
 
-from flask import abort, current_app, flash, has_app_context, \
-                  redirect, render_template, request, \
-                  session, send_file, url_for
+from flask import abort, current_app, flash, g, has_app_context, jsonify, \
+                  make_response, redirect, render_template, request, \
+                  session, url_for
 from . import create_app, create_csrf_token, validate_csrf_token, \
               CSRF_TOKEN_KEY, AUTH_USER_ID_KEY, NOT_AUTHENTICATED_MESSAGE
 
@@ -16,16 +16,20 @@ else:
     app = current_app
 
 with app.app_context():
-    import io
     from urllib.parse import urlparse, urljoin, quote
     from web.models.issue import Issue
     from web.models.comment import Comment
     from web.models.state import State
     from web.models.attached_file import AttachedFile
     from web.models.user import User
+    from web.models.search import search as search_issues
     from web.exceptions.zen_http_exception import ZenHttpException
+    from web import fragment_cache, metrics, query_budget, response_compression, static_assets
+    from web.api import api
     from web.form_helper import create_new_comment, create_new_user, do_login, \
                                 edit_user_information
+    from web.http_helper import create_download_response, create_not_modified_response, \
+                                create_page_etag, is_not_modified, set_page_validators
 
     def is_authenticated():
         """Return true if user is authenticated."""
@@ -43,7 +47,10 @@ with app.app_context():
         if not is_authenticated():
             raise ZenHttpException(403) # Forbidden
 
-        ret = User.get(session[AUTH_USER_ID_KEY])
+        # memoized per request. cleared by 'before_request()'.
+        if 'login_user' not in g:
+            g.login_user = User.get_cached(session[AUTH_USER_ID_KEY])
+        ret = g.login_user
         if ret is None:
             raise ZenHttpException(404) # Not Found
 
@@ -77,23 +84,46 @@ with app.app_context():
 
         return next
 
+    def get_page_limit(req):
+        """Returns page size from query parameter 'limit'.
+        The value is clamped to 'MAX_ISSUES_PER_PAGE'.
+
+        Args:
+            req (flask.request): flask.request object.
+        """
+
+        default = app.config.get('ISSUES_PER_PAGE', 50)
+        maximum = app.config.get('MAX_ISSUES_PER_PAGE', 200)
+        limit = req.args.get('limit', default, type=int)
+        if limit < 1:
+            return default
+        return min(limit, maximum)
+
+    metrics.init_app(app)
+    query_budget.init_app(app)
+    response_compression.init_app(app)
+    static_assets.init_app(app)
+    app.register_blueprint(api)
+
     app.jinja_env.globals['csrf_token_key'] = CSRF_TOKEN_KEY
     app.jinja_env.globals['create_csrf_token'] = create_csrf_token
     app.jinja_env.globals['get_login_user'] = get_login_user
     app.jinja_env.globals['quote_url'] = lambda url: quote(url, safe='')
+    app.jinja_env.globals['cached_fragment'] = fragment_cache.cached_fragment
 
     def _handle_exception(err):
         t = type(err)
 
-        # TODO: write log
-
         if t is ZenHttpException:
             abort(err.status)
         else:
+            app.logger.exception('unexpected error on {} {}'.format(request.method, request.path))
+            metrics.count_exception()
             abort(500)
 
     @app.before_request
     def before_request():
+        g.pop('login_user', None)
         if request.method == "POST":
             if not validate_csrf_token(request):
                 abort(403)
@@ -103,11 +133,38 @@ with app.app_context():
     def index():
         """Rendering top page.
 
-        Renders all issues.
+        Renders a page of issues. The page is specified by query
+        parameters 'after' (or 'before') and 'limit'. Issues are
+        filtered by query parameter 'state' (state id) if specified.
         """
 
         try:
-            return render_template('issues.html', issues=Issue.all())
+            after_id = request.args.get('after', type=int)
+            before_id = request.args.get('before', type=int)
+            state_id = request.args.get('state', type=int)
+            limit = get_page_limit(request)
+
+            stamp = Issue.get_list_version()
+            (version, last_modified) = (stamp.value, stamp.updated_at) if stamp else (0, None)
+            state_version = State.get_version()
+            # navbar shows name of login user.
+            user_version = User.get_version() if is_authenticated() else None
+            etag = create_page_etag('issues', version, state_version, user_version,
+                                    after_id, before_id, state_id, limit)
+            if is_not_modified(request, etag):
+                return create_not_modified_response(etag, last_modified)
+
+            (issues, has_previous, has_next) = Issue.page(after_id, limit, before_id, state_id)
+            res = make_response(render_template('issues.html',
+                    issues=issues,
+                    limit=limit,
+                    has_previous=has_previous,
+                    has_next=has_next,
+                    state=State.get(state_id),
+                    state_id=state_id,
+                    states=State.all(),
+                    state_counts=State.get_issue_counts(version)))
+            return set_page_validators(res, etag, last_modified)
         except Exception as err:
             _handle_exception(err)
 
@@ -125,16 +182,106 @@ with app.app_context():
         """
 
         try:
-            issue = Issue.get(id)
-            states = State.all()
-            if issue is None:
-                raise ZenHttpException(404)
             if request.method == 'POST':
+                issue = Issue.get(id)
+                if issue is None:
+                    raise ZenHttpException(404)
                 # TODO: message flash
                 new_comment = create_new_comment(request, issue, get_login_user())
                 new_comment.add()
                 return redirect(url_for('detail', id=id))
-            return render_template('detail.html', issue=issue, states=states)
+
+            issue = Issue.get(id)
+            if issue is None:
+                raise ZenHttpException(404)
+            state_version = State.get_version()
+            user_version = User.get_version()
+            etag = create_page_etag('detail', issue.id, issue.version, state_version, user_version)
+            if is_not_modified(request, etag):
+                return create_not_modified_response(etag, issue.updated_at)
+
+            # comments are loaded only if they are not cached.
+            window = app.config.get('COMMENTS_WINDOW', 50)
+            res = make_response(render_template('detail.html',
+                    issue=issue,
+                    load_comment_window=lambda: issue.get_comment_window(window),
+                    states=State.all(),
+                    header_version='{}.{}'.format(issue.version, state_version),
+                    comments_version='{}.{}'.format(issue.version, user_version)))
+            return set_page_validators(res, etag, issue.updated_at)
+        except Exception as err:
+            _handle_exception(err)
+
+    # GET /1/comments?after=10&before=100
+    @app.route('/<int:id>/comments/', methods=['GET'])
+    def comments(id):
+        """Rendering comments of an issue as a fragment of detail page.
+
+        Renders at most 'COMMENTS_PAGE_SIZE' comments whose id is
+        between query parameters 'after' and 'before', and a link
+        to the next comments if more.
+
+        Args:
+            id (int): issue id.
+        """
+
+        try:
+            after_id = request.args.get('after', type=int)
+            before_id = request.args.get('before', type=int)
+            limit = app.config.get('COMMENTS_PAGE_SIZE', 100)
+
+            issue = Issue.get(id)
+            if issue is None:
+                raise ZenHttpException(404)
+            etag = create_page_etag('comments', issue.id, issue.version, User.get_version(),
+                                    after_id, before_id, limit)
+            if is_not_modified(request, etag):
+                return create_not_modified_response(etag, issue.updated_at)
+
+            rows = Issue.get_comments(id, after_id, before_id, limit + 1)
+            res = make_response(render_template('comments.html',
+                    issue=issue,
+                    comments=rows[:limit],
+                    has_more=len(rows) > limit,
+                    before_id=before_id))
+            return set_page_validators(res, etag, issue.updated_at)
+        except Exception as err:
+            _handle_exception(err)
+
+    # GET /search?q=word
+    @app.route('/search/', methods=['GET'])
+    def search():
+        """Rendering search result page.
+
+        Searches issues by subject and comment body.
+        """
+
+        try:
+            query = request.args.get('q', '')
+            results = search_issues(query, app.config.get('SEARCH_RESULTS_LIMIT', 50))
+            return render_template('search.html', query=query, results=results)
+        except Exception as err:
+            _handle_exception(err)
+
+    # GET /stats
+    @app.route('/stats/', methods=['GET'])
+    def stats():
+        """Returns counters of caches of this process as JSON."""
+
+        try:
+            return jsonify(fragment_cache=fragment_cache.get_stats())
+        except Exception as err:
+            _handle_exception(err)
+
+    # GET /metrics
+    @app.route('/metrics', methods=['GET'])
+    def export_metrics():
+        """Returns metrics of this process in Prometheus text format."""
+
+        try:
+            res = make_response(metrics.export(fragment_cache.get_backend().get_size()))
+            res.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+            return res
         except Exception as err:
             _handle_exception(err)
 
@@ -152,11 +299,9 @@ with app.app_context():
             if attached_file is None:
                 raise ZenHttpException(404)
 
-            return send_file(
-                    io.BytesIO(attached_file.data),
-                    as_attachment = True,
-                    attachment_filename=attached_file.name,
-                    mimetype='application/octet-stream')
+            return create_download_response(
+                    request, attached_file,
+                    app.config.get('DOWNLOAD_CHUNK_SIZE', 64 * 1024))
         except Exception as err:
             _handle_exception(err)
 